@@ -1,7 +1,7 @@
+import asyncio
 import json
 import os
 import chainlit as cl
-import base64
 from time import time_ns
 
 from opentelemetry import trace
@@ -18,7 +18,12 @@ from opentelemetry.sdk._logs import LoggerProvider
 from opentelemetry.sdk._logs.export import SimpleLogRecordProcessor, ConsoleLogExporter
 from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter, AzureMonitorTraceExporter
 
-from assistant_flow.chat import chat_completion
+from assistant_flow.admission import AdmissionRejected
+from assistant_flow.attributes import set_attribute
+from assistant_flow.chat import async_chat_completion, chat_completion
+from assistant_flow.core import get_active_run
+from assistant_flow.events import ImageEvent
+from telemetry import BatchLogExportProcessor, BatchSpanExportProcessor, spans_file
 
 from promptflow.tracing import start_trace
 from dotenv import load_dotenv
@@ -44,22 +49,24 @@ def setup_app_insights():
         connection_string=os.getenv('APPLICATIONINSIGHTS_CONNECTION_STRING')
     )
 
-    # Add the Azure exporter to the tracer provider
+    # Add the Azure exporter to the tracer provider; exporters are batched off the request path, see telemetry.py
     trace.get_tracer_provider().add_span_processor(
-        SimpleSpanProcessor(trace_exporter)
+        BatchSpanExportProcessor("spans.azure_monitor", trace_exporter)
     )
 
     # Configure Console as the Exporter
-    file = open('spans.json', 'w')
+    file = spans_file()
 
-    console_exporter = ConsoleSpanExporter(out=file)
-    trace.get_tracer_provider().add_span_processor(SimpleSpanProcessor(console_exporter))
+    if file is not None:
+        console_exporter = ConsoleSpanExporter(out=file)
+        trace.get_tracer_provider().add_span_processor(BatchSpanExportProcessor("spans.file", console_exporter))
 
     provider = LoggerProvider()
     _logs.set_logger_provider(provider)
-    console_exporter = ConsoleLogExporter(out=file)
-    provider.add_log_record_processor(SimpleLogRecordProcessor(console_exporter))
-    provider.add_log_record_processor(SimpleLogRecordProcessor(AzureMonitorLogExporter(connection_string=os.getenv('APPLICATIONINSIGHTS_CONNECTION_STRING'))))
+    if file is not None:
+        console_exporter = ConsoleLogExporter(out=file)
+        provider.add_log_record_processor(BatchLogExportProcessor("logs.file", console_exporter))
+    provider.add_log_record_processor(BatchLogExportProcessor("logs.azure_monitor", AzureMonitorLogExporter(connection_string=os.getenv('APPLICATIONINSIGHTS_CONNECTION_STRING'))))
 
     # Get a tracer
     return trace.get_tracer(__name__) 
@@ -72,6 +79,31 @@ def start_chat():
     cl.user_session.set("session_state", {})    
 
 
+async def cancel_active_run():
+    """Cancel the run still answering in this session and wait (up to 10s) for it to stop."""
+    session_state = cl.user_session.get("session_state") or {}
+    handler = get_active_run(session_state.get("thread_id"))
+    if handler is None:
+        return
+    print("cancelling the active run of thread", handler.thread_id)
+    handler.cancel()
+    if hasattr(handler, "task"):
+        await asyncio.wait([handler.task], timeout=10)
+    else:
+        await asyncio.to_thread(handler.finished.wait, 10)
+
+
+@cl.on_stop
+async def stop_chat():
+    await cancel_active_run()
+
+
+@cl.on_chat_end
+async def end_chat():
+    # the client disconnected, don't keep the run and its tool calls going
+    await cancel_active_run()
+
+
 @cl.action_callback("upvote")
 async def on_action(action):
     span_context = json.loads(action.value)
@@ -103,20 +135,29 @@ async def call_promptflow(message):
         TraceContextTextMapPropagator().inject(carrier)
         cl.user_session.set("last_message_context", carrier)
 
-        span.set_attribute("inputs", json.dumps({"question": message.content}))
+        set_attribute(span, "inputs", json.dumps({"question": message.content}))
         span.set_attribute("span_type", "function")
         span.set_attribute("framework", "promptflow")
         span.set_attribute("function", "call_promptflow")
 
         session_state = cl.user_session.get("session_state")
-
-        response = await cl.make_async(chat_completion)(question=message.content,
-                                                        session_state=session_state)
+        # admission control limits the runs per user, anonymous users count per chat session
+        user = cl.user_session.get("user")
+        user = user.identifier if user else cl.user_session.get("id")
+
+        # the async flow runs on the event loop, the sync flow in a worker thread
+        if os.getenv("ASSISTANT_ASYNC", "1") != "0":
+            response = await async_chat_completion(question=message.content,
+                                                   session_state=session_state,
+                                                   user=user)
+        else:
+            response = await cl.make_async(chat_completion)(question=message.content,
+                                                            session_state=session_state,
+                                                            user=user)
         
-        try:            
-            span.set_attribute("output", json.dumps(response))
-        except Exception as e:
-            span.set_attribute("output", str(e))
+        # chat_output is a stream that is traced by the stream span, keep the rest of the response
+        output = {key: value for key, value in response.items() if key != "chat_output"}
+        set_attribute(span, "output", json.dumps(output, default=str))
 
     return response
 
@@ -168,26 +209,27 @@ async def run_conversation(message: cl.Message):
 
     from chainlit import make_async, run_sync
 
+    # a new question replaces the answer still streaming
+    await cancel_active_run()
+
     msg = cl.Message(content="")
     await msg.send()
 
-    reply = await call_promptflow(message)
+    try:
+        reply = await call_promptflow(message)
+    except AdmissionRejected as e:
+        # fast rejection under load, the user is told when to retry
+        await msg.stream_token(str(e))
+        await msg.update()
+        return
     if "session_state" in reply:
         cl.user_session.set("session_state", reply["session_state"])
-    stream = reply["chat_output"]
-    response = ""
-    images = []
-    for thing in stream:
-
-        if thing.strip().startswith("!["):
-            image = parse_image(thing.strip())
-            images.append(image)
-            msg.elements = images
-        else:
-            response += thing
-            msg.content = response
-        
-        await msg.update()
+    # tokens are sent in batches, images as their own elements of the message
+    async for text, images in coalesce(aiter_stream(reply["chat_output"])):
+        if text:
+            await msg.stream_token(text)
+        for image in images:
+            await image.send(for_id=msg.id)
     await msg.stream_token("🏁")
     await msg.update()
 
@@ -201,13 +243,92 @@ async def run_conversation(message: cl.Message):
 
     await cl.Message(content="Rate the Chatbot's answer:", actions=actions).send()
 
-        
-def parse_image(thing):
-    # parse the image data from this inline markdown image
-    # ![](data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAABgAAAAYCAYAAADgdz34AAABjElEQVRIS+2VvUoDQRSGv)
-    image = thing.split("(data:image/png;base64,")[1].split(")")[0]
-    data = base64.b64decode(image)
-    return cl.Image(content=data, name="generated image", display="inline", size="large")
+
+async def aiter_stream(stream):
+    """
+    Iterate a chat_output stream without blocking the event loop. A sync stream is read
+    at most UI_STREAM_QUEUE_SIZE items (default 64) ahead of the consumer.
+    """
+    if hasattr(stream, "__aiter__"):
+        async for thing in stream:
+            yield thing
+        return
+
+    # a sync generator is drained in a worker thread and handed over through a bounded
+    # queue, the thread waits while the queue is full
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=int(os.getenv("UI_STREAM_QUEUE_SIZE", "64")))
+    done = object()
+    closed = False
+
+    def put(thing):
+        asyncio.run_coroutine_threadsafe(queue.put(thing), loop).result()
+
+    def pump():
+        try:
+            for thing in stream:
+                if closed:
+                    break
+                put(thing)
+        finally:
+            if not closed:
+                put(done)
+
+    loop.run_in_executor(None, pump)
+    try:
+        while (thing := await queue.get()) is not done:
+            yield thing
+    finally:
+        # the consumer stopped early: make room for the put the thread may be waiting on
+        closed = True
+        while not queue.empty():
+            queue.get_nowait()
+
+
+async def coalesce(stream):
+    """
+    Batch a token stream into (text, images) updates. A batch is sent after UI_FLUSH_INTERVAL
+    seconds (default 0.1) or once it has UI_FLUSH_CHARS characters (default 200).
+    """
+    interval = float(os.getenv("UI_FLUSH_INTERVAL", "0.1"))
+    max_chars = int(os.getenv("UI_FLUSH_CHARS", "200"))
+    loop = asyncio.get_running_loop()
+
+    iterator = stream.__aiter__()
+    pending_next = None
+    text, images = [], []
+    size = 0
+    deadline = None
+    while True:
+        if pending_next is None:
+            pending_next = asyncio.ensure_future(iterator.__anext__())
+        timeout = None if deadline is None else max(deadline - loop.time(), 0)
+        done, _ = await asyncio.wait({pending_next}, timeout=timeout)
+
+        if done:
+            try:
+                thing = pending_next.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending_next = None
+            if isinstance(thing, ImageEvent):
+                images.append(cl.Image(content=thing.content, name="generated image", display="inline", size="large"))
+            else:
+                # every other event is shown as its text
+                thing = str(thing)
+                text.append(thing)
+                size += len(thing)
+            if deadline is None:
+                deadline = loop.time() + interval
+
+        if images or size >= max_chars or (deadline is not None and loop.time() >= deadline):
+            yield "".join(text), images
+            text, images, size, deadline = [], [], 0, None
+
+    if text or images:
+        yield "".join(text), images
+
 
 if __name__ == "__main__":
     start_trace()
@@ -0,0 +1,219 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# Admission control of assistant runs. At most ASSISTANT_MAX_CONCURRENT_RUNS runs are in
+# flight in the process; further runs wait in a FIFO queue of ASSISTANT_MAX_QUEUED_RUNS
+# and are rejected right away, with a retry-after hint, once the queue is full or after
+# waiting ASSISTANT_ADMISSION_TIMEOUT seconds. A user has at most ASSISTANT_MAX_RUNS_PER_USER
+# runs in flight or waiting. Defaults: 16 runs, 64 queued, 30 seconds, 4 per user.
+#
+# Metrics (OpenTelemetry meter "assistant_flow.admission"):
+#   assistant.admission.active       runs in flight (up-down counter)
+#   assistant.admission.queue_depth  runs waiting (up-down counter)
+#   assistant.admission.wait_time    seconds waited before a run started (histogram)
+#   assistant.admission.rejected     rejected runs by reason (counter)
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from opentelemetry import metrics
+
+meter = metrics.get_meter(__name__)
+_active_counter = meter.create_up_down_counter(
+    "assistant.admission.active", unit="{run}", description="Assistant runs in flight"
+)
+_queue_counter = meter.create_up_down_counter(
+    "assistant.admission.queue_depth", unit="{run}", description="Assistant runs waiting for a slot"
+)
+_wait_histogram = meter.create_histogram(
+    "assistant.admission.wait_time", unit="s", description="Time an assistant run waited for a slot"
+)
+_rejected_counter = meter.create_counter(
+    "assistant.admission.rejected", unit="{run}", description="Assistant runs rejected by admission control"
+)
+
+
+class AdmissionRejected(Exception):
+    """The run was not admitted, the caller should retry after retry_after seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"The assistant is busy ({reason}), please retry in {retry_after} seconds.")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission:
+    """A slot of a run, release it when the run is done (releasing twice is a no-op)."""
+
+    def __init__(self, controller: AdmissionController, user: str):
+        self.controller = controller
+        self.user = user
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        self.controller._release(self)
+
+
+class _Waiter:
+    def __init__(self, user: str, loop: asyncio.AbstractEventLoop = None):
+        self.user = user
+        self.enqueued = time.monotonic()
+        self.admission = None
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self, admission: Admission) -> None:
+        # called with the controller lock held, possibly from another thread
+        self.admission = admission
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_concurrency: int = None,
+        max_queue: int = None,
+        max_per_user: int = None,
+        queue_timeout: float = None,
+    ):
+        self.max_concurrency = max_concurrency or int(os.getenv("ASSISTANT_MAX_CONCURRENT_RUNS", "16"))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("ASSISTANT_MAX_QUEUED_RUNS", "64"))
+        self.max_per_user = max_per_user or int(os.getenv("ASSISTANT_MAX_RUNS_PER_USER", "4"))
+        self.queue_timeout = queue_timeout or float(os.getenv("ASSISTANT_ADMISSION_TIMEOUT", "30"))
+        self._lock = threading.Lock()
+        self._waiters: deque[_Waiter] = deque()
+        self._per_user: dict[str, int] = {}
+        self.active = 0
+        self.rejected = 0
+        # moving average of how long a run holds its slot, for the retry-after hint
+        self._average_run_time = 10.0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(active=self.active, queued=len(self._waiters), rejected=self.rejected)
+
+    def _retry_after(self) -> int:
+        runs_ahead = len(self._waiters) + 1
+        return max(1, math.ceil(self._average_run_time * runs_ahead / self.max_concurrency))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        # called with the lock held
+        self.rejected += 1
+        _rejected_counter.add(1, {"reason": reason})
+        error = AdmissionRejected(reason, self._retry_after())
+        logging.warning(str(error))
+        return error
+
+    def _enter(self, user: str, loop: asyncio.AbstractEventLoop = None) -> Admission | _Waiter:
+        """An admission if a slot is free, else a waiter in the queue."""
+        with self._lock:
+            if user is not None and self._per_user.get(user, 0) >= self.max_per_user:
+                raise self._reject("too many runs for this user")
+            if self.active < self.max_concurrency and not self._waiters:
+                return self._admit(user, 0)
+            if len(self._waiters) >= self.max_queue:
+                raise self._reject("queue full")
+            waiter = _Waiter(user, loop)
+            self._waiters.append(waiter)
+            self._count_user(user, 1)
+            _queue_counter.add(1)
+            return waiter
+
+    def _admit(self, user: str, waited: float) -> Admission:
+        # called with the lock held; a waiter was already counted for its user
+        self.active += 1
+        if waited == 0:
+            self._count_user(user, 1)
+        _active_counter.add(1)
+        _wait_histogram.record(waited)
+        return Admission(self, user)
+
+    def _count_user(self, user: str, delta: int) -> None:
+        if user is None:
+            return
+        count = self._per_user.get(user, 0) + delta
+        if count > 0:
+            self._per_user[user] = count
+        else:
+            self._per_user.pop(user, None)
+
+    def _grant_next(self) -> None:
+        # called with the lock held
+        while self._waiters and self.active < self.max_concurrency:
+            waiter = self._waiters.popleft()
+            _queue_counter.add(-1)
+            waiter.grant(self._admit(waiter.user, time.monotonic() - waiter.enqueued))
+
+    def _release(self, admission: Admission) -> None:
+        with self._lock:
+            if admission.released:
+                return
+            admission.released = True
+            self.active -= 1
+            self._count_user(admission.user, -1)
+            _active_counter.add(-1)
+            run_time = time.monotonic() - admission.started
+            self._average_run_time = 0.8 * self._average_run_time + 0.2 * run_time
+            self._grant_next()
+
+    def _abandon(self, waiter: _Waiter) -> Admission | None:
+        """Take a waiter out of the queue; returns its admission if it was granted meanwhile."""
+        with self._lock:
+            if waiter.admission is not None:
+                return waiter.admission
+            self._waiters.remove(waiter)
+            self._count_user(waiter.user, -1)
+            _queue_counter.add(-1)
+            return None
+
+    def admit(self, user: str = None, timeout: float = None) -> Admission:
+        """Wait for a slot, raises AdmissionRejected when there is none in time."""
+        entered = self._enter(user)
+        if isinstance(entered, Admission):
+            return entered
+        entered.event.wait(timeout or self.queue_timeout)
+        admission = self._abandon(entered)
+        if admission is None:
+            with self._lock:
+                raise self._reject("timed out in queue")
+        return admission
+
+    async def admit_async(self, user: str = None, timeout: float = None) -> Admission:
+        """admit without blocking the event loop."""
+        entered = self._enter(user, asyncio.get_running_loop())
+        if isinstance(entered, Admission):
+            return entered
+        try:
+            await asyncio.wait_for(asyncio.shield(entered.future), timeout or self.queue_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            admission = self._abandon(entered)
+            if admission is not None:
+                admission.release()
+            raise
+        admission = self._abandon(entered)
+        if admission is None:
+            with self._lock:
+                raise self._reject("timed out in queue")
+        return admission
+
+
+# process-wide admission of the runs of chat_completion and async_chat_completion
+admission = AdmissionController()
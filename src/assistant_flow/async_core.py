@@ -0,0 +1,544 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# asyncio variant of core.AssistantAPI built on AsyncAzureOpenAI. The run is an
+# asyncio task instead of a thread per conversation, the tokens are read from an
+# async generator, and the OpenTelemetry context travels with the task through
+# contextvars, so no explicit attach/detach is needed.
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+
+import httpx
+from openai import AsyncAssistantEventHandler, AsyncAzureOpenAI
+from openai.types.beta.threads import ImageFile, Message
+from typing_extensions import override
+
+from opentelemetry import trace as otel_trace
+from promptflow.tracing import trace
+
+from assistant_flow.admission import Admission
+from assistant_flow.attributes import image_reference, set_attribute
+from assistant_flow.compaction import (
+    SUMMARY_INSTRUCTIONS, compaction_timeout, should_compact, summary_message, summary_text,
+)
+from assistant_flow.core import (
+    TERMINAL_RUN_STATUSES, SpeculativeToolCalls, _tool_executor, register_active_run, unregister_active_run,
+)
+from assistant_flow.deadline import RunDeadline
+from assistant_flow.metrics import record_turn, timed_tool_call, tool_duration
+from assistant_flow.threads import anew_thread_id, aresume_thread_id, validated_threads
+from assistant_flow.events import (
+    AsyncEventChannel, ErrorEvent, ImageEvent, TextDelta, ToolCallArguments, ToolCallDone, ToolCallStarted,
+)
+
+tracer = otel_trace.get_tracer(__name__)
+
+
+class AsyncFileContentCache:
+    """core.FileContentCache for the async client, downloads are tasks on the running loop."""
+    def __init__(self, client):
+        self.client = client
+        self._files: dict[str, asyncio.Task] = {}
+
+    def prefetch(self, file_id: str) -> asyncio.Task:
+        task = self._files.get(file_id)
+        if task is None:
+            task = self._files[file_id] = asyncio.ensure_future(self._download(file_id))
+        return task
+
+    async def _download(self, file_id: str) -> bytes:
+        response = await self.client.files.content(file_id)
+        return await response.aread()
+
+    async def get(self, file_id: str) -> bytes:
+        return await self.prefetch(file_id)
+
+    async def reference(self, file_id: str) -> dict:
+        """The reference of a file for the spans, the blob is written off the loop (see attributes.py)."""
+        return image_reference(await self.get(file_id), file_id)
+
+
+# the compaction tasks in flight by thread id, the next turn on the thread stops them
+_compactions: dict[str, asyncio.Task] = {}
+
+
+async def astop_compaction(thread_id: str) -> None:
+    """Cancel the compaction of a thread, if any, and wait for it to be done, see core.stop_compaction."""
+    task = _compactions.pop(thread_id, None)
+    if task is not None:
+        task.cancel()
+        await asyncio.wait([task])
+
+
+class AsyncAssistantAPI:
+    def __init__(
+        self,
+        client: AsyncAzureOpenAI,
+        thread_id: str,
+        tools: dict[str, callable] = None,
+        turns: int = 0,
+    ):
+        self.client = client
+        self.thread_id = thread_id
+        self.tools = tools or {}
+        # turns on the thread so far, for compaction
+        self.turns = turns
+
+        # budget of a whole turn, the phase budgets are in deadline.py
+        self.max_waiting_time = float(os.getenv("ASSISTANT_TURN_TIMEOUT", "120"))
+        # start function calls while the run is still streaming, see core.SpeculativeToolCalls
+        self.speculative = os.getenv("ASSISTANT_SPECULATIVE_TOOLS", "0") == "1"
+
+        if "OPENAI_ASSISTANT_ID" in os.environ:
+            self.assistant_id = os.getenv("OPENAI_ASSISTANT_ID")
+        else:
+            raise Exception(
+                "You need to provide OPENAI_ASSISTANT_ID in the environment variables"
+            )
+
+    @classmethod
+    async def create(
+        cls,
+        client: AsyncAzureOpenAI,
+        session_state: dict[str, any] = None,
+        tools: dict[str, callable] = None,
+    ) -> AsyncAssistantAPI:
+        session_state = session_state or {}
+        # a compaction of the last turn may still move the session to a new thread
+        await astop_compaction(session_state.get("thread_id"))
+        if "thread_id" in session_state:
+            logging.info(f"Using thread_id from session_stat: {session_state['thread_id']}")
+            thread_id = await aresume_thread_id(client, session_state["thread_id"])
+        else:
+            logging.info("Creating a new thread")
+            thread_id = await anew_thread_id(client)
+        return cls(client, thread_id, tools, turns=session_state.get("turns", 0))
+
+    def start(self, question: str, admission: Admission = None) -> dict:
+        """
+        Start the run as a task on the running loop; must be called from a coroutine.
+        The admission slot, if any, is released when the run is done.
+        """
+        self.admission = admission
+        self.queue = AsyncEventChannel()
+        # create_task copies the current contextvars, including the OpenTelemetry context
+        self.task = asyncio.create_task(self.run(question))
+        register_active_run(self.thread_id, self)
+        # the run updates the session state in place, e.g. when it compacts the thread
+        self.session_state = {"thread_id": self.thread_id, "turns": self.turns + 1}
+
+        return dict(
+            chat_output=self.queue.iter(),
+            session_state=self.session_state,
+            planner_raw_output=None,
+        )
+
+    async def _stream(self, phase_name, open_stream):
+        """
+        Consume a run stream within the budget of a phase and return the run (None if it
+        was never created). On expiry the stream is cancelled, which closes the HTTP stream.
+        """
+        with self.deadline.phase(phase_name) as phase:
+            async with open_stream(phase.http_timeout()) as stream:
+                try:
+                    async with asyncio.timeout(phase.remaining()):
+                        async for event in stream:
+                            if self.queue.cancelled:
+                                logging.info("the consumer cancelled the stream")
+                                break
+                except (TimeoutError, httpx.TimeoutException) as e:
+                    phase.timed_out = True
+                    # a read timeout before the phase deadline is a stalled stream
+                    phase.idle = isinstance(e, httpx.TimeoutException) and not phase.expired()
+                    logging.info(f"{phase_name} timed out (idle: {phase.idle}): {e!r}")
+                run = stream.current_run
+                if run is not None:
+                    self.run_id = run.id
+                logging.info(f"done streaming, run status: {run.status if run else None}")
+                return run
+
+    @trace
+    async def run(self, question: str):
+        # shared by the event handlers of all the streams of this run
+        self.files = AsyncFileContentCache(self.client)
+        self.deadline = RunDeadline(turn_budget=self.max_waiting_time)
+        self.speculation = SpeculativeToolCalls(self._submit_tool_call) if self.speculative else None
+        self.run_id = None
+        self.completed = False
+        self.model = None
+
+        span = otel_trace.get_current_span()
+        span.set_attribute("promptflow.assistant.message", question)
+        span.set_attribute("promptflow.assistant.thread_id", self.thread_id)
+        span.set_attribute("promptflow.assistant.assistant_id", self.assistant_id)
+
+        try:
+            await self._run(question, span)
+        except asyncio.CancelledError:
+            logging.info(f"The run on thread {self.thread_id} was cancelled")
+            await self.cancel_run()
+            raise
+        except Exception as e:
+            logging.error(f"Run failed: {e}")
+            await self.queue.send(ErrorEvent(f"Run failed: {e}"))
+            # the thread may be gone, retrieve it again next turn
+            validated_threads.discard(self.thread_id)
+            await self.cancel_run()
+        finally:
+            self.deadline.report(span)
+            status = "completed" if self.completed else "cancelled" if self.queue.cancelled else (
+                "timeout" if self.deadline.timed_out else "failed"
+            )
+            record_turn(self.deadline.start, self.queue.first_token_at, status, self.model)
+            if self.speculation is not None:
+                self.speculation.report(span)
+            self.queue.end()
+            unregister_active_run(self.thread_id, self)
+            if self.admission is not None:
+                self.admission.release()
+            # the answer is out, compact the thread before the next turn if it grew too long;
+            # in a task of its own, after the admission slot was given back
+            if self.completed and should_compact(self.session_state.get("prompt_tokens"), self.session_state["turns"]):
+                task = _compactions[self.thread_id] = asyncio.create_task(self.compact())
+                task.add_done_callback(
+                    lambda task: _compactions.pop(self.thread_id) if _compactions.get(self.thread_id) is task else None
+                )
+
+    def cancel(self) -> None:
+        """
+        Stop the run, e.g. when the user leaves or sends a new message. Must be called on the
+        loop of the run; cancelling the task closes the stream, drops the pending tool calls
+        and cancels the Assistants run.
+        """
+        logging.info(f"Cancelling the run on thread {self.thread_id}")
+        self.queue.cancel()
+        if not self.task.done():
+            self.task.cancel()
+
+    async def _run(self, question: str, span):
+        logging.info("Submitting the message")
+        with self.deadline.phase("submit_message") as phase:
+            await self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role="user",
+                content=question,
+                timeout=phase.http_timeout(),
+            )
+
+        logging.info("Streaming the run")
+        run = await self._stream("stream", lambda timeout: self.client.beta.threads.runs.stream(
+            thread_id=self.thread_id,
+            assistant_id=self.assistant_id,
+            event_handler=AsyncEventHandler(self.client, self.queue, self.files, self.speculation),
+            timeout=timeout,
+        ))
+        if run is not None:
+            span.set_attribute("promptflow.assistant.run_id", run.id)
+
+        while run is not None and run.status == "requires_action" and not self.deadline.expired() and not self.queue.cancelled:
+            logging.info(
+                f"Run status: {run.status} (time={int(time.monotonic() - self.deadline.start)}s, max_waiting_time={self.max_waiting_time})"
+            )
+            with self.deadline.phase("tool_calls") as phase:
+                tool_call_outputs = await self.run_tool_calls(
+                    run.required_action.submit_tool_outputs.tool_calls,
+                    timeout=phase.remaining(),
+                )
+            if self.queue.cancelled:
+                # cancelled while the tools ran, the outputs are not submitted
+                logging.info("the run was cancelled during the tool calls")
+                break
+
+            logging.info("Resuming streaming the run")
+            run_id = run.id
+            run = await self._stream("tool_outputs_stream", lambda timeout: self.client.beta.threads.runs.submit_tool_outputs_stream(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                tool_outputs=tool_call_outputs,
+                event_handler=AsyncEventHandler(self.client, self.queue, self.files, self.speculation),
+                timeout=timeout,
+            ))
+
+        if run is None:
+            # the stream ended before the run was created
+            await self.cancel_run()
+            await self.queue.send(ErrorEvent(self.deadline.timeout_message()))
+
+        elif run.status == "completed":
+            self.completed = True
+            self.model = run.model
+            self.session_state["prompt_tokens"] = run.usage.prompt_tokens
+            span.set_attribute("llm.response.model", run.model)
+            span.set_attribute("llm.usage.completion_tokens", run.usage.completion_tokens)
+            span.set_attribute("llm.usage.prompt_tokens", run.usage.prompt_tokens)
+            span.set_attribute("llm.usage.total_tokens", run.usage.total_tokens)
+
+        elif self.queue.cancelled:
+            # nobody is listening any more, only the run is left to stop
+            if run.status not in TERMINAL_RUN_STATUSES:
+                await self.cancel_run()
+
+        elif run.status in ["cancelled", "expired", "failed"]:
+            await self.queue.send(ErrorEvent(f"Run failed with status: {run.status}"))
+
+        elif run.status in ["in_progress", "queued", "requires_action"]:
+            logging.info(f"Run status: {run.status}. The run has timed out.")
+            await self.cancel_run()
+            await self.queue.send(ErrorEvent(self.deadline.timeout_message()))
+
+        else:
+            raise ValueError(f"Unknown run status: {run.status}")
+
+    async def compact(self) -> None:
+        """Summarize the thread into a new thread and continue the session there, see core.AssistantAPI.compact."""
+        with tracer.start_as_current_span("assistant.compact_thread") as span:
+            span.set_attribute("promptflow.assistant.thread_id", self.thread_id)
+            span.set_attribute("promptflow.assistant.turns", self.session_state["turns"])
+            span.set_attribute("promptflow.assistant.prompt_tokens", self.session_state.get("prompt_tokens") or 0)
+            run = None
+            try:
+                # a new message cancels the compaction task, see astop_compaction
+                async with asyncio.timeout(compaction_timeout()):
+                    run = await self.client.beta.threads.runs.create(
+                        thread_id=self.thread_id,
+                        assistant_id=self.assistant_id,
+                        additional_instructions=SUMMARY_INSTRUCTIONS,
+                        tool_choice="none",
+                        timeout=10,
+                    )
+                    self.run_id = run.id
+                    while run.status in ("queued", "in_progress"):
+                        await asyncio.sleep(1)
+                        run = await self.client.beta.threads.runs.retrieve(
+                            thread_id=self.thread_id, run_id=run.id, timeout=10
+                        )
+                if run.status != "completed":
+                    raise RuntimeError(f"run status {run.status}")
+
+                messages = await self.client.beta.threads.messages.list(
+                    thread_id=self.thread_id, run_id=run.id, timeout=10
+                )
+                thread = await self.client.beta.threads.create(
+                    messages=[summary_message(summary_text(messages.data))], timeout=10
+                )
+            except (Exception, asyncio.CancelledError) as e:
+                logging.error(f"Thread compaction failed: {e!r}")
+                if run is not None and run.status in ("queued", "in_progress"):
+                    # the next message can only be added once the run stopped
+                    await self.cancel_run()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                return
+
+            logging.info(f"Compacted thread {self.thread_id} into {thread.id}")
+            span.set_attribute("promptflow.assistant.compacted_thread_id", thread.id)
+            validated_threads.add(thread.id)
+            self.session_state.update(thread_id=thread.id, turns=0, prompt_tokens=0, compacted_from=self.thread_id)
+
+    async def cancel_run(self) -> None:
+        """Cancel the run of this turn if it is still active and wait for it to stop, see core.AssistantAPI.cancel_run."""
+        try:
+            run_id = self.run_id
+            if run_id is None:
+                runs = await self.client.beta.threads.runs.list(thread_id=self.thread_id, limit=1, timeout=10)
+                active = [run for run in runs.data if run.status in ("queued", "in_progress", "requires_action")]
+                if not active:
+                    return
+                run_id = active[0].id
+            # the run could have complete by now, so do this in a try/except block
+            run = await self.client.beta.threads.runs.cancel(thread_id=self.thread_id, run_id=run_id, timeout=10)
+        except Exception as e:
+            logging.error(f"Failed to cancel the run: {e}")
+            return
+
+        deadline = time.monotonic() + float(os.getenv("ASSISTANT_CANCEL_TIMEOUT", "10"))
+        try:
+            while run.status not in TERMINAL_RUN_STATUSES and time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+                run = await self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run_id, timeout=10)
+        except Exception as e:
+            logging.error(f"Failed to wait for the run to stop: {e}")
+            return
+        if run.status not in TERMINAL_RUN_STATUSES:
+            logging.warning(f"The run {run_id} is still {run.status} after cancelling it")
+
+    def _submit_tool_call(self, tool_call) -> asyncio.Task:
+        """Run a function call as a task on the running loop."""
+        submitted = time.monotonic()
+
+        async def call():
+            name = tool_call.function.name
+            tool_func = self.tools[name]
+            arguments = json.loads(tool_call.function.arguments)
+            if inspect.iscoroutinefunction(tool_func) or inspect.iscoroutinefunction(
+                getattr(tool_func, "__call__", None)
+            ):
+                started = time.monotonic()
+                status = "error"
+                try:
+                    result = await tool_func(**arguments)
+                    status = "ok"
+                    return result
+                finally:
+                    tool_duration.record(time.monotonic() - started, {"tool": name, "status": status})
+            # sync tools (like SalesDataInsights) run on the shared tool pool, in a copy of
+            # the current context so their spans stay in the trace of the run
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(
+                _tool_executor, functools.partial(context.run, timed_tool_call, name, submitted, tool_func, **arguments)
+            )
+
+        return asyncio.ensure_future(call())
+
+    async def run_tool_calls(self, tool_calls, timeout: float) -> list[dict]:
+        """Run the function calls concurrently, returns the outputs in the order of the calls."""
+        for tool_call in tool_calls:
+            if tool_call.type != "function":
+                raise ValueError(f"Unsupported tool call type: {tool_call.type}")
+
+        tasks = [
+            (self.speculation and self.speculation.take(tool_call)) or self._submit_tool_call(tool_call)
+            for tool_call in tool_calls
+        ]
+        try:
+            if tasks:
+                await asyncio.wait(tasks, timeout=max(timeout, 0))
+        except asyncio.CancelledError:
+            # the run was cancelled, drop the calls that have not started
+            for task in tasks:
+                task.cancel()
+            raise
+
+        tool_call_outputs = []
+        for tool_call, task in zip(tool_calls, tasks):
+            if not task.done():
+                task.cancel()
+                logging.warning(f"tool call {tool_call.id} timed out after {timeout:.0f}s")
+                tool_call_output = {"error": f"The tool call timed out after {timeout:.0f} seconds"}
+            elif task.exception() is not None:
+                logging.error(f"tool call {tool_call.id} failed: {task.exception()}")
+                tool_call_output = {"error": str(task.exception())}
+            else:
+                tool_call_output = task.result()
+
+            tool_call_outputs.append(
+                {
+                    "tool_call_id": tool_call.id,
+                    # compact separators, the output counts against the prompt tokens
+                    "output": json.dumps(tool_call_output, separators=(",", ":"), default=str),
+                }
+            )
+        return tool_call_outputs
+
+
+class AsyncEventHandler(AsyncAssistantEventHandler):
+    def __init__(
+        self,
+        client,
+        queue: AsyncEventChannel,
+        files: AsyncFileContentCache = None,
+        speculation: SpeculativeToolCalls = None,
+    ):
+        self.client = client
+        self.queue = queue
+        self.files = files or AsyncFileContentCache(client)
+        self.speculation = speculation
+        self.tool_calls_done = []
+        super().__init__()
+
+    @override
+    async def on_text_created(self, text) -> None:
+        await self.queue.send(TextDelta("\n"))
+
+    @override
+    async def on_text_delta(self, delta, snapshot):
+        await self.queue.send(TextDelta(delta.value))
+
+    @override
+    async def on_tool_call_created(self, tool_call):
+        name = tool_call.function.name if tool_call.type == "function" else None
+        await self.queue.send(ToolCallStarted(tool_call.id, tool_call.type, name))
+
+    @override
+    async def on_tool_call_delta(self, delta, snapshot):
+        if delta.type == "code_interpreter":
+            # start downloading charts as soon as their ids show up
+            for output in delta.code_interpreter.outputs or []:
+                if output.type == "image" and output.image and output.image.file_id:
+                    self.files.prefetch(output.image.file_id)
+        elif delta.type == "function":
+            await self.queue.send(ToolCallArguments(snapshot.id, delta.function.arguments))
+        else:
+            await self.queue.send(TextDelta(str(delta)))
+
+    @override
+    async def on_message_done(self, message: Message) -> None:
+        for content in message.content:
+            if content.type == "text":
+                with tracer.start_as_current_span("assistant.text_message") as span:
+                    span.set_attribute("framework", "promptflow")
+                    span.set_attribute("span_type", "Function")
+                    span.set_attribute("function", "assistant.text_message")
+                    set_attribute(span, "inputs", json.dumps(content.text.value.split("\n")))
+            elif content.type == "image_file":
+                reference = await self.files.reference(content.image_file.file_id)
+                with tracer.start_as_current_span("assistant.image_message") as span:
+                    span.set_attribute("framework", "promptflow")
+                    span.set_attribute("span_type", "Function")
+                    span.set_attribute("function", "assistant.image_message")
+                    span.set_attribute("inputs", json.dumps(reference))
+
+    @override
+    async def on_image_file_done(self, image_file: ImageFile):
+        await self.queue.send(ImageEvent(image_file.file_id, await self.files.get(image_file.file_id)))
+
+    @override
+    async def on_tool_call_done(self, tool_call):
+        # events seem to be duplicated, so we need to keep track of the tool calls that have been processed
+        if tool_call.id in self.tool_calls_done:
+            return
+        self.tool_calls_done.append(tool_call.id)
+
+        await self.queue.send(ToolCallDone(tool_call.id))
+
+        # the arguments are complete, no need to wait for requires_action
+        if tool_call.type == "function" and self.speculation is not None:
+            self.speculation.start(tool_call)
+
+        if tool_call.type == "function":
+            with tracer.start_as_current_span("assistant.function_call") as span:
+                span.set_attribute("framework", "promptflow")
+                span.set_attribute("span_type", "Function")
+                span.set_attribute("function", "function_call")
+                set_attribute(span, "inputs", json.dumps(dict(name=tool_call.function.name,
+                                                              arguments=json.loads(tool_call.function.arguments),
+                                                              tool_call_id=tool_call.id)))
+
+        elif tool_call.type == "code_interpreter":
+            output_dict = {}
+            for output in tool_call.code_interpreter.outputs or []:
+                if output.type == "logs":
+                    output_dict["logs"] = output.logs.split("\n")
+                elif output.type == "image":
+                    output_dict["image_file_id"] = output.image.file_id
+                    output_dict["image"] = await self.files.reference(output.image.file_id)
+
+            with tracer.start_as_current_span("code_interpreter_call") as span:
+                span.set_attribute("framework", "promptflow")
+                span.set_attribute("span_type", "Function")
+                span.set_attribute("function", "code_interpreter_call")
+                if tool_call.code_interpreter.input:
+                    set_attribute(span, "inputs", json.dumps(dict(code=tool_call.code_interpreter.input.split("\n"),
+                                                                  tool_call_id=tool_call.id)))
+                if output_dict:
+                    set_attribute(span, "output", json.dumps(output_dict))
+        else:
+            with tracer.start_as_current_span("tool_call") as span:
+                span.set_attribute("promptflow.assistant.tool_call", str(tool_call))
@@ -0,0 +1,128 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# Size budget of span attributes. Values over ASSISTANT_ATTRIBUTE_MAX_CHARS (default 8192)
+# are written to a local content-addressed blob store and the span keeps a reference:
+#
+#   {"blob": "blob://sha256/9f86d0...", "sha256": "9f86d0...", "size": 123456, "preview": "first characters"}
+#
+# The reference is JSON, like the inputs and output attributes it replaces. Images never go
+# into attributes, only their reference. The store is a directory of files named by the
+# sha256 of their content, TELEMETRY_BLOB_DIR (default .blobs); an empty value disables the
+# store and oversized values are only truncated and hashed.
+#
+# Only the hash is computed on the request path: the blobs are queued to a batch exporter
+# thread (see telemetry.py) that writes them, so a span may refer to a blob a little before
+# it is on disk. The queue is bounded by the TELEMETRY_* settings, a dropped blob is logged
+# and its reference dangles. Pending blobs are written at exit.
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from telemetry import BatchExporter
+
+# characters of an oversized value kept in its reference
+PREVIEW_CHARS = 256
+
+
+class BlobStore:
+    """Files named by the sha256 of their content, each written once."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, data: bytes) -> str:
+        """Store data and return its sha256."""
+        digest = hashlib.sha256(data).hexdigest()
+        self.write(digest, data)
+        return digest
+
+    def write(self, digest: str, data: bytes) -> None:
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first so readers never see a partial blob
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(tmp, path)
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path(digest), "rb") as file:
+            return file.read()
+
+
+def get_blob_store() -> BlobStore | None:
+    root = os.getenv("TELEMETRY_BLOB_DIR", ".blobs")
+    return BlobStore(root) if root else None
+
+
+class _BlobWriter:
+    """Exporter of the blob queue, writes (store, digest, data) items."""
+
+    def export(self, batch: list) -> None:
+        for store, digest, data in batch:
+            try:
+                store.write(digest, data)
+            except OSError as e:
+                logging.warning(f"Failed to store a blob: {e}")
+
+    def shutdown(self) -> None:
+        pass
+
+
+_writer: BatchExporter | None = None
+_writer_lock = threading.Lock()
+
+
+def _blob_writer() -> BatchExporter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BatchExporter("blobs", _BlobWriter())
+            atexit.register(_writer.shutdown)
+        return _writer
+
+
+def flush_blobs(timeout_millis: int = 30000) -> bool:
+    """Wait for the queued blobs to be written."""
+    return _writer is None or _writer.force_flush(timeout_millis)
+
+
+def blob_reference(data: bytes, preview: str = None, **extra) -> dict:
+    """The reference of data, queued for the blob store when there is one."""
+    store = get_blob_store()
+    digest = hashlib.sha256(data).hexdigest()
+    reference = {"sha256": digest, "size": len(data), **extra}
+    if store is not None:
+        _blob_writer().put((store, digest, data))
+        reference = {"blob": f"blob://sha256/{digest}", **reference}
+    if preview is not None:
+        reference["preview"] = preview
+    return reference
+
+
+def budget(value: str, max_chars: int = None) -> str:
+    """value if it fits the attribute budget, else its blob reference."""
+    max_chars = max_chars or int(os.getenv("ASSISTANT_ATTRIBUTE_MAX_CHARS", "8192"))
+    if len(value) <= max_chars:
+        return value
+    return json.dumps(blob_reference(value.encode("utf-8"), preview=value[:PREVIEW_CHARS]))
+
+
+def set_attribute(span, key: str, value: str, max_chars: int = None) -> None:
+    """span.set_attribute within the attribute budget."""
+    span.set_attribute(key, budget(value, max_chars))
+
+
+def image_reference(content: bytes, file_id: str) -> dict:
+    """The reference of an image of the run, for a span attribute instead of its base64."""
+    return blob_reference(content, file_id=file_id, mime_type="image/png")
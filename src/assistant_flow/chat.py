@@ -2,9 +2,11 @@ import os
 import logging
 
 # local imports
+from assistant_flow.admission import admission
+from assistant_flow.async_core import AsyncAssistantAPI
 from assistant_flow.core import AssistantAPI
 from promptflow.tracing import start_trace, trace
-from openai import AzureOpenAI
+from sales_data_insights.clients import get_async_azure_openai_client, get_azure_openai_client
 from sales_data_insights.main import SalesDataInsights
 from typing import TypedDict
 
@@ -26,20 +28,7 @@ class AssistantStream(TypedDict):
     session_state: dict
 
 
-@trace
-def chat_completion(
-    question: str,
-    session_state: dict = None,
-) -> AssistantStream:
-
-    """
-    This is the entry point of Assistant flow.
-    Args:
-        question (str): The question to ask the assistant.
-        session_state (dict, optional): The session state to resume from. Defaults to None.
-        Returns: AssistantStream 
-    """
-
+def _check_env_vars():
     # verify all env vars are present
     required_env_vars = [
         "OPENAI_API_BASE",
@@ -56,18 +45,74 @@ def chat_completion(
         not missing_env_vars
     ), f"Missing environment variables: {missing_env_vars}"
 
-    global client
-    client = AzureOpenAI(
-        azure_endpoint=os.getenv("OPENAI_API_BASE"),
-        api_key=os.getenv("OPENAI_API_KEY"),
-        api_version=os.getenv("OPENAI_API_VERSION"),
-    )
-    sales_data_insights = SalesDataInsights()
-    
-    handler = AssistantAPI(client=client,                              
-                            session_state=session_state, 
-                            tools=dict(sales_data_insights=sales_data_insights))
-    return handler.start(question=question)
+
+@trace
+def chat_completion(
+    question: str,
+    session_state: dict = None,
+    user: str = None,
+) -> AssistantStream:
+
+    """
+    This is the entry point of Assistant flow.
+    Args:
+        question (str): The question to ask the assistant.
+        session_state (dict, optional): The session state to resume from. Defaults to None.
+        user (str, optional): Who is asking, for the per-user limit of admission control. Defaults to None.
+        Returns: AssistantStream 
+    Raises:
+        AdmissionRejected: The assistant is too busy, retry after the given number of seconds.
+    """
+
+    _check_env_vars()
+
+    # waits for a free slot, see admission.py
+    slot = admission.admit(user)
+    try:
+        # the client is shared across sessions so connections are kept alive between turns
+        client = get_azure_openai_client()
+        sales_data_insights = SalesDataInsights()
+
+        handler = AssistantAPI(client=client,
+                                session_state=session_state,
+                                tools=dict(sales_data_insights=sales_data_insights))
+        return handler.start(question=question, admission=slot)
+    except BaseException:
+        slot.release()
+        raise
+
+
+@trace
+async def async_chat_completion(
+    question: str,
+    session_state: dict = None,
+    user: str = None,
+) -> AssistantStream:
+
+    """
+    asyncio version of chat_completion, chat_output is an async generator.
+    Args:
+        question (str): The question to ask the assistant.
+        session_state (dict, optional): The session state to resume from. Defaults to None.
+        user (str, optional): Who is asking, for the per-user limit of admission control. Defaults to None.
+        Returns: AssistantStream 
+    Raises:
+        AdmissionRejected: The assistant is too busy, retry after the given number of seconds.
+    """
+    _check_env_vars()
+
+    slot = await admission.admit_async(user)
+    try:
+        client = get_async_azure_openai_client()
+        sales_data_insights = SalesDataInsights()
+
+        handler = await AsyncAssistantAPI.create(client=client,
+                                                 session_state=session_state,
+                                                 tools=dict(sales_data_insights=sales_data_insights))
+        return handler.start(question=question, admission=slot)
+    except BaseException:
+        slot.release()
+        raise
 
 def _test():
     """Test the chat completion function."""
@@ -0,0 +1,42 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# Compaction of long conversations. Every turn resends the whole thread, so once the
+# prompt of a run or the number of turns passes a threshold the assistant summarizes
+# the thread (including the tool results it relied on) and the session continues on a
+# new thread seeded with the summary. Thresholds are environment variables (0 disables):
+#   ASSISTANT_COMPACT_PROMPT_TOKENS  prompt tokens of the last run (default 16000)
+#   ASSISTANT_COMPACT_TURNS          turns on the thread (default 30)
+#   ASSISTANT_COMPACT_TIMEOUT        seconds the summary may take (default 60)
+
+import os
+
+SUMMARY_INSTRUCTIONS = """The conversation will continue in a new thread that only contains your reply to this request.
+Summarize the conversation so far for that purpose. Do not call any tools.
+Keep the questions of the user, your answers and the key figures and results of the tool calls
+(queries, numbers, tables and charts described in words) that later questions may refer to.
+Leave out greetings and anything that was superseded. Reply with the summary only."""
+
+
+def should_compact(prompt_tokens: int, turns: int) -> bool:
+    max_prompt_tokens = int(os.getenv("ASSISTANT_COMPACT_PROMPT_TOKENS", "16000"))
+    max_turns = int(os.getenv("ASSISTANT_COMPACT_TURNS", "30"))
+    return (max_prompt_tokens > 0 and (prompt_tokens or 0) >= max_prompt_tokens) or (
+        max_turns > 0 and turns >= max_turns
+    )
+
+
+def compaction_timeout() -> float:
+    return float(os.getenv("ASSISTANT_COMPACT_TIMEOUT", "60"))
+
+
+def summary_message(summary: str) -> dict:
+    """The first message of the new thread."""
+    return {"role": "assistant", "content": f"Summary of the conversation so far:\n\n{summary}"}
+
+
+def summary_text(messages) -> str:
+    """The text of the messages of the summary run."""
+    return "\n".join(
+        content.text.value for message in messages for content in message.content if content.type == "text"
+    )
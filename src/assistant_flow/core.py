@@ -11,11 +11,154 @@ from openai import AzureOpenAI
 from promptflow.tracing import trace
 from opentelemetry import trace as otel_trace
 from opentelemetry import context as otel_context
-from promptflow.contracts.multimedia import Image
-from threading import Thread
+from threading import Event, Lock
+import httpx
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from assistant_flow.admission import Admission, admission as _admission
+from assistant_flow.attributes import image_reference, set_attribute
+from assistant_flow.compaction import (
+    SUMMARY_INSTRUCTIONS, compaction_timeout, should_compact, summary_message, summary_text,
+)
+from assistant_flow.deadline import RunDeadline, watchdog
+from assistant_flow.metrics import record_turn, timed_tool_call
+from assistant_flow.threads import new_thread_id, resume_thread_id, validated_threads
+from assistant_flow.events import (
+    ErrorEvent, EventChannel, ImageEvent, TextDelta, ToolCallArguments, ToolCallDone, ToolCallStarted,
+)
 
 tracer = otel_trace.get_tracer(__name__)
 
+# runs are executed on a bounded pool, sized to the runs admission control lets in at once
+_run_executor = ThreadPoolExecutor(max_workers=_admission.max_concurrency, thread_name_prefix="assistant-run")
+
+# tool calls of a run (e.g. from multi_tool_use.parallel) are executed concurrently on a
+# shared, bounded pool; ASSISTANT_TOOL_WORKERS sets its size
+_tool_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ASSISTANT_TOOL_WORKERS", "8")), thread_name_prefix="assistant-tool"
+)
+# files (charts of the code interpreter) are downloaded in the background; ASSISTANT_FILE_WORKERS sets the pool size
+_file_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ASSISTANT_FILE_WORKERS", "4")), thread_name_prefix="assistant-file"
+)
+
+# threads are compacted in the background, after the turn gave back its admission slot
+_compaction_executor = ThreadPoolExecutor(
+    max_workers=_admission.max_concurrency, thread_name_prefix="assistant-compact"
+)
+
+# a run is over in these statuses; cancel_run waits up to ASSISTANT_CANCEL_TIMEOUT seconds
+# (default 10) for a cancelled run to get there, the thread takes no new message before
+TERMINAL_RUN_STATUSES = ("cancelled", "completed", "failed", "expired", "incomplete")
+
+
+class FileContentCache:
+    """
+    The contents of the files of a run by file_id. Each file is downloaded once, in the
+    background as soon as its id shows up, and shared by the stream and the telemetry.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._files: dict[str, Future] = {}
+        self._lock = Lock()
+
+    def prefetch(self, file_id: str) -> Future:
+        with self._lock:
+            future = self._files.get(file_id)
+            if future is None:
+                future = self._files[file_id] = _file_executor.submit(self._download, file_id)
+            return future
+
+    def _download(self, file_id: str) -> bytes:
+        return self.client.files.content(file_id).read()
+
+    def get(self, file_id: str) -> bytes:
+        return self.prefetch(file_id).result()
+
+
+class SpeculativeToolCalls:
+    """
+    Function calls started as soon as their arguments are complete in the stream, before
+    the run stops with requires_action (opt-in with ASSISTANT_SPECULATIVE_TOOLS=1, the tools
+    must be safe to run when the result ends up unused). A call is reused when the run
+    requires the same function with the same arguments, the others are dropped.
+    """
+    def __init__(self, start_call: callable):
+        # start_call(tool_call) returns a future (or an asyncio task) of the output
+        self._start_call = start_call
+        self._calls: dict[str, tuple] = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, tool_call) -> None:
+        with self._lock:
+            if tool_call.id not in self._calls:
+                key = (tool_call.function.name, tool_call.function.arguments)
+                self._calls[tool_call.id] = (key, self._start_call(tool_call))
+
+    def take(self, tool_call):
+        """The future of a call started for tool_call, or None."""
+        with self._lock:
+            key, future = self._calls.pop(tool_call.id, (None, None))
+        if future is not None and key == (tool_call.function.name, tool_call.function.arguments):
+            self.hits += 1
+            return future
+        if future is not None:
+            future.cancel()
+        self.misses += 1
+        return None
+
+    def discard(self) -> int:
+        """Drop the calls the run never asked for, returns how many there were."""
+        with self._lock:
+            calls, self._calls = self._calls, {}
+        for _, future in calls.values():
+            future.cancel()
+        return len(calls)
+
+    def report(self, span) -> None:
+        span.set_attribute("promptflow.assistant.speculative.hits", self.hits)
+        span.set_attribute("promptflow.assistant.speculative.misses", self.misses)
+        span.set_attribute("promptflow.assistant.speculative.discarded", self.discard())
+
+
+# the runs in flight by thread id, so a chat session can cancel its run (see app.py)
+_active_runs: dict[str, object] = {}
+_active_runs_lock = Lock()
+
+
+def register_active_run(thread_id: str, handler) -> None:
+    with _active_runs_lock:
+        _active_runs[thread_id] = handler
+
+
+def unregister_active_run(thread_id: str, handler) -> None:
+    with _active_runs_lock:
+        if _active_runs.get(thread_id) is handler:
+            del _active_runs[thread_id]
+
+
+def get_active_run(thread_id: str):
+    """The AssistantAPI (or AsyncAssistantAPI) running on a thread, or None."""
+    with _active_runs_lock:
+        return _active_runs.get(thread_id)
+
+
+# the compactions in flight by thread id, the next turn on the thread stops them
+_compactions: dict[str, tuple] = {}
+_compactions_lock = Lock()
+
+
+def stop_compaction(thread_id: str) -> None:
+    """Cancel the compaction of a thread, if any, and wait for it to be done."""
+    with _compactions_lock:
+        handler, future = _compactions.pop(thread_id, (None, None))
+    if handler is not None:
+        handler.cancel()
+        wait([future])
+
+
 class AssistantAPI:
     @trace
     def __init__(
@@ -29,15 +172,23 @@ class AssistantAPI:
         self.client = client
         self.tools = tools or {}
 
-        self.max_waiting_time = 120
+        # budget of a whole turn, the phase budgets are in deadline.py
+        self.max_waiting_time = float(os.getenv("ASSISTANT_TURN_TIMEOUT", "120"))
+        # start function calls while the run is still streaming, see SpeculativeToolCalls
+        self.speculative = os.getenv("ASSISTANT_SPECULATIVE_TOOLS", "0") == "1"
 
         session_state = session_state or {}
+        # a compaction of the last turn may still move the session to a new thread
+        stop_compaction(session_state.get("thread_id"))
+        # turns on the thread so far, for compaction
+        self.turns = session_state.get("turns", 0)
         if "thread_id" in session_state:
             logging.info(f"Using thread_id from session_stat: {session_state['thread_id']}")
-            self.thread_id = self.client.beta.threads.retrieve(session_state['thread_id']).id
+            self.thread_id = resume_thread_id(self.client, session_state['thread_id'])
         else:
             logging.info(f"Creating a new thread")
-            self.thread_id = self.client.beta.threads.create().id
+            # taken from the pre-created threads when one is ready, see threads.py
+            self.thread_id = new_thread_id(self.client)
 
 
         if "OPENAI_ASSISTANT_ID" in os.environ:
@@ -52,11 +203,17 @@ class AssistantAPI:
 
 
 
-    def start(self, question):
-        # run handler in a separate thread
+    def start(self, question, admission: Admission = None):
+        # run handler in a separate thread; the admission slot, if any, is released when the run is done
+        self.admission = admission
         # Capture the current context
         current_context = otel_context.get_current()
-        self.queue = QueuedIteratorStream()
+        self.queue = EventChannel()
+        # set by cancel, and when the run thread is done
+        self.cancelled = Future()
+        self.finished = Event()
+        self._active_stream = None
+        register_active_run(self.thread_id, self)
         # print(f"current_context {current_context}")
         def run_with_context():
             # Reactivate the captured context in the new thread
@@ -68,13 +225,15 @@ class AssistantAPI:
                 otel_context.detach(token)
             logging.info("Thread ended")
 
-        # run handler in a separate thread with context
-        thread = Thread(target=run_with_context)
-        thread.start()
+        # the run updates the session state in place, e.g. when it compacts the thread
+        self.session_state = {"thread_id": self.thread_id, "turns": self.turns + 1}
+
+        # run handler in a pool thread with context
+        _run_executor.submit(run_with_context)
         
         return dict(
             chat_output=self.queue.iter(),
-            session_state={ "thread_id": self.thread_id },
+            session_state=self.session_state,
             planner_raw_output=None
         )
 
@@ -82,117 +241,315 @@ class AssistantAPI:
     @trace    
     def run(self, question):
         self.question = question
-
-        run = None
-        start_time = time.time()
+        # shared by the event handlers of all the streams of this run
+        self.files = FileContentCache(self.client)
+        self.deadline = RunDeadline(turn_budget=self.max_waiting_time)
+        self.speculation = SpeculativeToolCalls(self._submit_tool_call) if self.speculative else None
+        self.run_id = None
+        self.completed = False
+        self.model = None
 
         # get current span
         span = otel_trace.get_current_span()
         span.set_attribute("promptflow.assistant.message", self.question)
         span.set_attribute("promptflow.assistant.thread_id", self.thread_id)
         span.set_attribute("promptflow.assistant.assistant_id", self.assistant_id)
-        
+
+        try:
+            self._run(question, span)
+        except Exception as e:
+            logging.error(f"Run failed: {e}")
+            self.queue.send(ErrorEvent(f"Run failed: {e}"))
+            # the thread may be gone, retrieve it again next turn
+            validated_threads.discard(self.thread_id)
+            self.cancel_run()
+        finally:
+            self.deadline.report(span)
+            status = "completed" if self.completed else "cancelled" if self.queue.cancelled else (
+                "timeout" if self.deadline.timed_out else "failed"
+            )
+            record_turn(self.deadline.start, self.queue.first_token_at, status, self.model)
+            if self.speculation is not None:
+                self.speculation.report(span)
+            # the consumer always gets the end of the stream
+            self.queue.end()
+            unregister_active_run(self.thread_id, self)
+            if self.admission is not None:
+                self.admission.release()
+            # the answer is out, compact the thread before the next turn if it grew too long
+            if self.completed and should_compact(self.session_state.get("prompt_tokens"), self.session_state["turns"]):
+                self._compact_in_background()
+            self.finished.set()
+
+    def cancel(self) -> None:
+        """
+        Stop the run from another thread, e.g. when the user leaves or sends a new message:
+        the stream is closed, pending tool calls are dropped and the run thread cancels the
+        Assistants run on its way out.
+        """
+        logging.info(f"Cancelling the run on thread {self.thread_id}")
+        self.queue.cancel()
+        if not self.cancelled.done():
+            self.cancelled.set_result(True)
+        stream = self._active_stream
+        if stream is not None:
+            try:
+                # unblocks a read waiting for the next event
+                stream.close()
+            except Exception as e:
+                logging.warning(f"Failed to close the stream: {e}")
+
+    def _run(self, question, span):
         logging.info("Submitting the message")
-        _ = self.client.beta.threads.messages.create(
-            thread_id=self.thread_id,
-            role="user",
-            content=question,
-        )
+        with self.deadline.phase("submit_message") as phase:
+            _ = self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role="user",
+                content=question,
+                timeout=phase.http_timeout(),
+            )
 
         logging.info("Streaming the run")
-        with self.client.beta.threads.runs.stream(
+        run = self._stream("stream", lambda timeout: self.client.beta.threads.runs.stream(
             thread_id=self.thread_id,
             assistant_id=self.assistant_id,
-            event_handler=EventHandler(self.client, self.queue),
-        ) as stream:
-
-            for event in stream:
-                if ((time.time() - start_time) > self.max_waiting_time):
-                    # todo: in case of timeout, the current_run might not be populated yet
-                    run = stream.current_run
-                    logging.info(f"streaming timed out")
-                    logging.info(f"Run status: {stream.current_run.status}")
-                    break
-            logging.info(f"done streaming")
-            logging.info(f"Run status: {stream.current_run.status}")
-            run = stream.current_run
-    
-        span.set_attribute("promptflow.assistant.run_id", run.id)
-        logging.info(f"thread.run.created: run.id {run.id}")
+            event_handler=EventHandler(self.client, self.queue, self.files, self.speculation),
+            timeout=timeout,
+        ))
 
+        if run is not None:
+            span.set_attribute("promptflow.assistant.run_id", run.id)
+            logging.info(f"thread.run.created: run.id {run.id}")
 
-        # loop while action is required or until max_waiting_time is reached
-        while ((time.time() - start_time) < self.max_waiting_time) and run.status == "requires_action":
+        # loop while action is required or until the turn is over
+        while run is not None and run.status == "requires_action" and not self.deadline.expired() and not self.queue.cancelled:
             logging.info(
-                f"Run status: {run.status} (time={int(time.time() - start_time)}s, max_waiting_time={self.max_waiting_time})"
+                f"Run status: {run.status} (time={int(time.monotonic() - self.deadline.start)}s, max_waiting_time={self.max_waiting_time})"
             )
 
-            tool_call_outputs = []
-
-            for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-                # trace_tool(tool_call.model_dump())
-                # self.queue.send(f"\nTool call: {tool_call.function.name} with arguments: {tool_call.function.arguments}\n")
-
-                if tool_call.type == "function":
-                    tool_func = self.tools[tool_call.function.name]
-                    tool_call_output = tool_func(
-                        **json.loads(tool_call.function.arguments)
-                    )
-
-                    tool_call_outputs.append(
-                        {
-                            "tool_call_id": tool_call.id,
-                            "output": json.dumps(tool_call_output),
-                        }
-                    )
-                else:
-                    raise ValueError(f"Unsupported tool call type: {tool_call.type}")
-               
+            with self.deadline.phase("tool_calls") as phase:
+                tool_call_outputs = self.run_tool_calls(
+                    run.required_action.submit_tool_outputs.tool_calls,
+                    timeout=phase.remaining(),
+                )
+            if self.queue.cancelled:
+                # cancelled while the tools ran, the outputs are not submitted
+                logging.info("the run was cancelled during the tool calls")
+                break
+
             logging.info("Resuming streaming the run")
-            with self.client.beta.threads.runs.submit_tool_outputs_stream(
+            run_id = run.id
+            run = self._stream("tool_outputs_stream", lambda timeout: self.client.beta.threads.runs.submit_tool_outputs_stream(
                 thread_id=self.thread_id,
-                run_id=run.id,
+                run_id=run_id,
                 tool_outputs=tool_call_outputs,
-                event_handler=EventHandler(self.client, self.queue),
-            ) as stream:
-                logging.info(f"Stream status: {stream}")
-                for event in stream:
-                    if ((time.time() - start_time) > self.max_waiting_time):
-                        # todo: in case of timeout, the current_run might not be populated yet
-                        run = stream.current_run
-                        logging.info(f"streaming timed out")
-                        logging.info(f"Run status: {stream.current_run.status}")
-                        break
-                run = stream.current_run
-                logging.info(f"done streaming")
-                logging.info(f"Run status: {stream.current_run.status}")
-
-        if run.status == "completed":
+                event_handler=EventHandler(self.client, self.queue, self.files, self.speculation),
+                timeout=timeout,
+            ))
+
+        if run is None:
+            # the stream ended before the run was created
+            self.cancel_run()
+            self.queue.send(ErrorEvent(self.deadline.timeout_message()))
+
+        elif run.status == "completed":
+            self.completed = True
+            self.model = run.model
+            self.session_state["prompt_tokens"] = run.usage.prompt_tokens
             span.set_attribute("llm.response.model", run.model)
             span.set_attribute("llm.usage.completion_tokens", run.usage.completion_tokens)
             span.set_attribute("llm.usage.prompt_tokens", run.usage.prompt_tokens)
             span.set_attribute("llm.usage.total_tokens", run.usage.total_tokens)
 
-            
+        elif self.queue.cancelled:
+            # nobody is listening any more, only the run is left to stop
+            if run.status not in TERMINAL_RUN_STATUSES:
+                self.cancel_run()
+
         elif run.status in ["cancelled", "expired", "failed"]:
-            self.queue.send(f"Run failed with status: {run.status}")
+            self.queue.send(ErrorEvent(f"Run failed with status: {run.status}"))
 
-        elif run.status in ["in_progress", "queued"]:
+        elif run.status in ["in_progress", "queued", "requires_action"]:
             logging.info(f"Run status: {run.status}. The run has timed out.")
-            try: 
-                # the run could have complete by now, so do this in a try/except block
-                run = self.client.beta.threads.runs.cancel(
-                    thread_id=self.thread_id, run_id=run.id
-                )
-            except Exception as e:
-                logging.error(f"Failed to cancel the run: {e}")
-            self.queue.send(f"The run has timed out after {self.max_waiting_time} seconds.")
+            self.cancel_run()
+            self.queue.send(ErrorEvent(self.deadline.timeout_message()))
 
         else:
             raise ValueError(f"Unknown run status: {run.status}")
 
-        self.queue.end()
-        return
+    def _compact_in_background(self) -> None:
+        current_context = otel_context.get_current()
+
+        def compact_with_context():
+            token = otel_context.attach(current_context)
+            try:
+                self.compact()
+            finally:
+                otel_context.detach(token)
+                with _compactions_lock:
+                    if _compactions.get(self.thread_id, (None,))[0] is self:
+                        del _compactions[self.thread_id]
+
+        with _compactions_lock:
+            _compactions[self.thread_id] = (self, _compaction_executor.submit(compact_with_context))
+
+    def compact(self) -> None:
+        """Summarize the thread into a new thread and continue the session there."""
+        with tracer.start_as_current_span("assistant.compact_thread") as span:
+            span.set_attribute("promptflow.assistant.thread_id", self.thread_id)
+            span.set_attribute("promptflow.assistant.turns", self.session_state["turns"])
+            span.set_attribute("promptflow.assistant.prompt_tokens", self.session_state.get("prompt_tokens") or 0)
+            try:
+                deadline = time.monotonic() + compaction_timeout()
+                run = self.client.beta.threads.runs.create(
+                    thread_id=self.thread_id,
+                    assistant_id=self.assistant_id,
+                    additional_instructions=SUMMARY_INSTRUCTIONS,
+                    tool_choice="none",
+                    timeout=10,
+                )
+                self.run_id = run.id
+                # a new message cancels the compaction, the thread stays as it is
+                while run.status in ("queued", "in_progress") and time.monotonic() < deadline:
+                    if wait([self.cancelled], timeout=1).done:
+                        break
+                    run = self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run.id, timeout=10)
+                if run.status != "completed":
+                    logging.warning(f"Thread compaction stopped with run status {run.status}")
+                    # the next message can only be added once the run stopped
+                    self.cancel_run()
+                    return
+
+                messages = self.client.beta.threads.messages.list(thread_id=self.thread_id, run_id=run.id, timeout=10)
+                thread = self.client.beta.threads.create(
+                    messages=[summary_message(summary_text(messages.data))], timeout=10
+                )
+            except Exception as e:
+                logging.error(f"Thread compaction failed: {e}")
+                return
+
+            logging.info(f"Compacted thread {self.thread_id} into {thread.id}")
+            span.set_attribute("promptflow.assistant.compacted_thread_id", thread.id)
+            validated_threads.add(thread.id)
+            self.session_state.update(thread_id=thread.id, turns=0, prompt_tokens=0, compacted_from=self.thread_id)
+
+    def _stream(self, phase_name, open_stream):
+        """
+        Consume a run stream within the budget of a phase and return the run (None if it
+        was never created). The watchdog closes the HTTP stream when the phase expires.
+        """
+        with self.deadline.phase(phase_name) as phase:
+            with open_stream(phase.http_timeout()) as stream:
+                self._active_stream = stream
+                with watchdog.watching(phase.deadline, stream.close):
+                    try:
+                        for event in stream:
+                            if self.queue.cancelled:
+                                logging.info("the consumer cancelled the stream")
+                                break
+                    except Exception as e:
+                        # closed by cancel, by the watchdog or a stalled read
+                        if self.queue.cancelled:
+                            logging.info(f"{phase_name} was cancelled: {e}")
+                        elif phase.expired() or isinstance(e, httpx.TimeoutException):
+                            phase.timed_out = True
+                            # a read timeout before the phase deadline is a stalled stream
+                            phase.idle = not phase.expired()
+                            logging.info(f"{phase_name} timed out (idle: {phase.idle}): {e}")
+                        else:
+                            raise
+                    finally:
+                        self._active_stream = None
+                run = stream.current_run
+                if run is not None:
+                    self.run_id = run.id
+                logging.info(f"done streaming, run status: {run.status if run else None}")
+                return run
+
+    def cancel_run(self) -> None:
+        """
+        Cancel the run of this turn if it is still active, also when its id never arrived, and
+        wait for it to stop: a run that is still cancelling makes the next message fail.
+        """
+        try:
+            run_id = self.run_id
+            if run_id is None:
+                runs = self.client.beta.threads.runs.list(thread_id=self.thread_id, limit=1, timeout=10)
+                active = [run for run in runs.data if run.status in ("queued", "in_progress", "requires_action")]
+                if not active:
+                    return
+                run_id = active[0].id
+            # the run could have complete by now, so do this in a try/except block
+            run = self.client.beta.threads.runs.cancel(thread_id=self.thread_id, run_id=run_id, timeout=10)
+        except Exception as e:
+            logging.error(f"Failed to cancel the run: {e}")
+            return
+
+        deadline = time.monotonic() + float(os.getenv("ASSISTANT_CANCEL_TIMEOUT", "10"))
+        try:
+            while run.status not in TERMINAL_RUN_STATUSES and time.monotonic() < deadline:
+                time.sleep(0.5)
+                run = self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run_id, timeout=10)
+        except Exception as e:
+            logging.error(f"Failed to wait for the run to stop: {e}")
+            return
+        if run.status not in TERMINAL_RUN_STATUSES:
+            logging.warning(f"The run {run_id} is still {run.status} after cancelling it")
+
+    def _submit_tool_call(self, tool_call) -> Future:
+        """Run a function call on the tool pool."""
+        # the worker continues the trace of the run
+        current_context = otel_context.get_current()
+        submitted = time.monotonic()
+
+        def call():
+            token = otel_context.attach(current_context)
+            try:
+                name = tool_call.function.name
+                return timed_tool_call(name, submitted, self.tools[name], **json.loads(tool_call.function.arguments))
+            finally:
+                otel_context.detach(token)
+
+        return _tool_executor.submit(call)
+
+    def run_tool_calls(self, tool_calls, timeout: float) -> list[dict]:
+        """Run the function calls concurrently, returns the outputs in the order of the calls."""
+        for tool_call in tool_calls:
+            if tool_call.type != "function":
+                raise ValueError(f"Unsupported tool call type: {tool_call.type}")
+
+        futures = [
+            (self.speculation and self.speculation.take(tool_call)) or self._submit_tool_call(tool_call)
+            for tool_call in tool_calls
+        ]
+        # wait for all calls, but stop early when the run is cancelled
+        deadline = time.monotonic() + max(timeout, 0)
+        pending = set(futures)
+        while pending and not self.cancelled.done() and time.monotonic() < deadline:
+            _, pending = wait(pending | {self.cancelled}, timeout=deadline - time.monotonic(), return_when=FIRST_COMPLETED)
+            pending.discard(self.cancelled)
+
+        tool_call_outputs = []
+        for tool_call, future in zip(tool_calls, futures):
+            if not future.done():
+                # the call keeps running in the pool, the assistant gets an error instead
+                future.cancel()
+                logging.warning(f"tool call {tool_call.id} timed out after {timeout:.0f}s")
+                tool_call_output = {"error": f"The tool call timed out after {timeout:.0f} seconds"}
+            elif future.exception() is not None:
+                logging.error(f"tool call {tool_call.id} failed: {future.exception()}")
+                tool_call_output = {"error": str(future.exception())}
+            else:
+                tool_call_output = future.result()
+
+            tool_call_outputs.append(
+                {
+                    "tool_call_id": tool_call.id,
+                    # compact separators, the output counts against the prompt tokens
+                    "output": json.dumps(tool_call_output, separators=(",", ":"), default=str),
+                }
+            )
+        return tool_call_outputs
     
 
 from openai import AssistantEventHandler
@@ -200,43 +557,44 @@ from typing_extensions import override
 from openai.types.beta.threads import ImageFile, Message
 
 class EventHandler(AssistantEventHandler): 
-    def __init__(self, client, queue):
+    def __init__(
+        self, client, queue: EventChannel, files: FileContentCache = None, speculation: SpeculativeToolCalls = None
+    ):
         self.client = client
         self.queue = queue
+        self.files = files or FileContentCache(client)
+        self.speculation = speculation
         self.tool_calls_done = []
         super().__init__()
 
     @override
     def on_text_created(self, text) -> None:
-        self.queue.send(f"\n")
+        self.queue.send(TextDelta("\n"))
         
     @override
     def on_text_delta(self, delta, snapshot):
-        self.queue.send(delta.value)
+        self.queue.send(TextDelta(delta.value))
         
     def text_message(self, content):
         with tracer.start_as_current_span("assistant.text_message") as span:
             span.set_attribute("framework", "promptflow")
             span.set_attribute("span_type", "Function")
             span.set_attribute("function", "assistant.text_message")
-            span.set_attribute("inputs", json.dumps(content.text.value.split("\n")))
+            set_attribute(span, "inputs", json.dumps(content.text.value.split("\n")))
 
     def image_message(self, content):
-        image = Image(self.client.files.content(content.image_file.file_id).read())
         with tracer.start_as_current_span("assistant.image_message") as span:
             span.set_attribute("framework", "promptflow")
             span.set_attribute("span_type", "Function")
             span.set_attribute("function", "assistant.image_message")
-            span.set_attribute("inputs", image.to_base64(with_type=True))
+            # spans only refer to images, see attributes.py
+            file_id = content.image_file.file_id
+            span.set_attribute("inputs", json.dumps(image_reference(self.files.get(file_id), file_id)))
 
     @override
     def on_tool_call_created(self, tool_call):
-        self.queue.send(f"\n> tool_call: {tool_call.type}\n")
-        if tool_call.type == "function":
-            self.queue.send(f"> id  : {tool_call.id}\n")
-            self.queue.send(f"> name: {tool_call.function.name}\n> arguments: ")
-        elif tool_call.type == "code_interpreter":
-            self.queue.send(f"> id  : {tool_call.id}\n\n")
+        name = tool_call.function.name if tool_call.type == "function" else None
+        self.queue.send(ToolCallStarted(tool_call.id, tool_call.type, name))
         
     @override
     def on_message_done(self, message: Message) -> None:
@@ -249,7 +607,10 @@ class EventHandler(AssistantEventHandler):
     @override
     def on_tool_call_delta(self, delta, snapshot):
         if delta.type == 'code_interpreter':
-            pass
+            # start downloading charts as soon as their ids show up
+            for output in delta.code_interpreter.outputs or []:
+                if output.type == "image" and output.image and output.image.file_id:
+                    self.files.prefetch(output.image.file_id)
             # if delta.code_interpreter.input:
             #     self.queue.send(delta.code_interpreter.input)
             # if delta.code_interpreter.outputs:
@@ -258,15 +619,14 @@ class EventHandler(AssistantEventHandler):
             #         if output.type == "logs":
             #             self.queue.send(f"\n{output.logs}\n")
         elif delta.type == "function":
-            self.queue.send(delta.function.arguments)
+            self.queue.send(ToolCallArguments(snapshot.id, delta.function.arguments))
         else:
-            self.queue.send(delta)
+            self.queue.send(TextDelta(str(delta)))
 
     @override
     def on_image_file_done(self, image_file: ImageFile):
         file_id = image_file.file_id
-        image = Image(self.client.files.content(file_id).read())
-        self.queue.send(image)
+        self.queue.send(ImageEvent(file_id, self.files.get(file_id)))
 
 
     @override
@@ -276,7 +636,11 @@ class EventHandler(AssistantEventHandler):
             return
         self.tool_calls_done.append(tool_call.id)
 
-        self.queue.send("\n")
+        self.queue.send(ToolCallDone(tool_call.id))
+
+        # the arguments are complete, no need to wait for requires_action
+        if tool_call.type == "function" and self.speculation is not None:
+            self.speculation.start(tool_call)
 
         # submit tool call to telemetry
         print(f"\ntool_call: {tool_call.type}", flush=True)
@@ -285,10 +649,9 @@ class EventHandler(AssistantEventHandler):
                 span.set_attribute("frmaework", "promptflow")
                 span.set_attribute("span_type", "Function")
                 span.set_attribute("function", "function_call")
-                span.set_attribute("inputs", tool_call.function.arguments)
-                span.set_attribute("inputs", json.dumps(dict(name=tool_call.function.name,
-                                                             arguments=json.loads(tool_call.function.arguments),
-                                                             tool_call_id=tool_call.id)))
+                set_attribute(span, "inputs", json.dumps(dict(name=tool_call.function.name,
+                                                              arguments=json.loads(tool_call.function.arguments),
+                                                              tool_call_id=tool_call.id)))
 
         elif tool_call.type == "code_interpreter":
             with tracer.start_as_current_span("code_interpreter_call") as span:
@@ -297,8 +660,8 @@ class EventHandler(AssistantEventHandler):
                 span.set_attribute("function", "code_interpreter_call")
 
                 if tool_call.code_interpreter.input:
-                    span.set_attribute("inputs", json.dumps(dict(code=tool_call.code_interpreter.input.split("\n"),
-                                                                 tool_call_id=tool_call.id)))
+                    set_attribute(span, "inputs", json.dumps(dict(code=tool_call.code_interpreter.input.split("\n"),
+                                                                  tool_call_id=tool_call.id)))
                 
                 if tool_call.code_interpreter.outputs:
                     output_dict = {}
@@ -307,63 +670,10 @@ class EventHandler(AssistantEventHandler):
                             output_dict["logs"] = output.logs.split("\n")
                         elif output.type == "image":
                             output_dict["image_file_id"] =  output.image.file_id
-                            file_id = output.image.file_id
-                            image_base64 = Image(self.client.files.content(file_id).read()).to_base64(with_type=True)
-                            output_dict["image_base64"] = image_base64
+                            output_dict["image"] = image_reference(self.files.get(output.image.file_id),
+                                                                   output.image.file_id)
                 
-                    span.set_attribute("output", json.dumps(output_dict))
+                    set_attribute(span, "output", json.dumps(output_dict))
         else:
             with tracer.start_as_current_span("tool_call") as span:
                 span.set_attribute("promptflow.assistant.tool_call", str(tool_call))
-
-
-import queue
-import json
-from typing import Any, Dict, List
-from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
-from opentelemetry import trace
-
-class QueuedIteratorStream:
-    terminate: str = "<--terminate-->"
-    queue: queue.Queue[str]
-    output: List[str]
-    context_carrier: Dict[str, Any]
-
-    def __init__(self) -> None:
-        self.queue = queue.Queue()
-        self.output = []
-        self.context_carrier = {}
-        # Write the current context into the carrier.
-        TraceContextTextMapPropagator().inject(self.context_carrier)
-
-    def send(self, event: str) -> None:
-        if event is not None and event != "":
-            if isinstance(event, Image):
-                self.output.append(f"\n{event.to_base64(with_type=True)}\n")
-                self.queue.put_nowait(f"\n\n![]({event.to_base64(with_type=True)})\n\n")
-            else:
-                self.output.append(event)
-                self.queue.put_nowait(event)
-
-    def end(self) -> None:
-        tracer = trace.get_tracer(__name__)
-        ctx = TraceContextTextMapPropagator().extract(carrier=self.context_carrier)
-
-        with tracer.start_as_current_span("stream", context=ctx) as span:
-            span.set_attribute("framework", "promptflow")
-            span.set_attribute("span_type", "Function")
-            span.set_attribute("function", "stream")
-            reformatted_output :str = "".join(self.output)
-            span.set_attribute("output", json.dumps(reformatted_output.split("\n")))
-
-        self.queue.put_nowait(self.terminate)
-
-    def iter(self) -> Any:
-        while True:
-            token = self.queue.get()
-
-            if token == self.terminate:
-                break
-
-            yield token
-
@@ -0,0 +1,168 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# Deadlines of an assistant run. A turn has an overall budget and each phase (submitting
+# the message, the initial stream, the tool calls, the tool output streams) its own;
+# a phase ends at its budget or at the end of the turn, whichever comes first. Budgets
+# are configured with environment variables (seconds):
+#   ASSISTANT_TURN_TIMEOUT         the whole turn (default 120)
+#   ASSISTANT_SUBMIT_TIMEOUT       submitting the user message (default 15)
+#   ASSISTANT_STREAM_TIMEOUT       each run stream (default 90)
+#   ASSISTANT_STREAM_IDLE_TIMEOUT  max wait for the next chunk of a stream (default 30)
+#   ASSISTANT_TOOL_TIMEOUT         running the tool calls of a step (default 60)
+#
+# Blocking reads of a sync stream cannot be interrupted by the thread doing them, so the
+# watchdog thread closes the stream when its phase expires.
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+
+from assistant_flow.metrics import phase_duration
+
+PHASE_BUDGETS = {
+    "submit_message": ("ASSISTANT_SUBMIT_TIMEOUT", 15),
+    "stream": ("ASSISTANT_STREAM_TIMEOUT", 90),
+    "tool_calls": ("ASSISTANT_TOOL_TIMEOUT", 60),
+    "tool_outputs_stream": ("ASSISTANT_STREAM_TIMEOUT", 90),
+}
+
+
+class Phase:
+    def __init__(self, name: str, budget: float, deadline: float):
+        self.name = name
+        self.budget = budget
+        self.deadline = deadline
+        self.timed_out = False
+        # max wait for the next chunk of a stream, and whether that is what ran out
+        self.idle_timeout = float(os.getenv("ASSISTANT_STREAM_IDLE_TIMEOUT", "30"))
+        self.idle = False
+
+    def remaining(self) -> float:
+        return max(self.deadline - time.monotonic(), 0)
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    def http_timeout(self) -> httpx.Timeout:
+        """Request timeout for the phase; reads also give up when a stream stalls."""
+        remaining = max(self.remaining(), 0.1)
+        return httpx.Timeout(remaining, read=min(self.idle_timeout, remaining))
+
+
+class RunDeadline:
+    def __init__(self, turn_budget: float = None, budgets: dict[str, float] = None):
+        self.turn_budget = turn_budget or float(os.getenv("ASSISTANT_TURN_TIMEOUT", "120"))
+        self.budgets = {
+            name: float(os.getenv(variable, str(default))) for name, (variable, default) in PHASE_BUDGETS.items()
+        }
+        self.budgets.update(budgets or {})
+        self.start = time.monotonic()
+        self.deadline = self.start + self.turn_budget
+        # seconds spent per phase, phases that repeat (tool steps) add up
+        self.elapsed: dict[str, float] = {}
+        self.timed_out: list[str] = []
+        # the last phase that ran out of time
+        self.expired_phase: Phase = None
+
+    def remaining(self) -> float:
+        return max(self.deadline - time.monotonic(), 0)
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.monotonic()
+        budget = self.budgets.get(name, self.turn_budget)
+        phase = Phase(name, budget, min(started + budget, self.deadline))
+        status = "error"
+        try:
+            yield phase
+            status = "ok"
+        finally:
+            elapsed = time.monotonic() - started
+            self.elapsed[name] = self.elapsed.get(name, 0) + elapsed
+            if phase.timed_out or phase.expired():
+                self.timed_out.append(name)
+                self.expired_phase = phase
+                status = "timeout"
+            phase_duration.record(elapsed, {"phase": name, "status": status})
+
+    def timeout_message(self) -> str:
+        """What ran out of time, for the user: a stalled stream, a phase or the whole turn."""
+        phase = self.expired_phase
+        if phase is not None and phase.idle:
+            return f"The run has timed out: {phase.name} sent nothing for {phase.idle_timeout:g} seconds."
+        if phase is not None and phase.deadline < self.deadline:
+            return f"The run has timed out: {phase.name} took longer than {phase.budget:g} seconds."
+        if phase is None and not self.expired():
+            return "The run ended before it was started."
+        return f"The run has timed out after {self.turn_budget:g} seconds."
+
+    def report(self, span) -> None:
+        """Record the time spent and the budget of each phase on a span."""
+        span.set_attribute("promptflow.assistant.turn.elapsed", round(time.monotonic() - self.start, 3))
+        span.set_attribute("promptflow.assistant.turn.budget", self.turn_budget)
+        for name, elapsed in self.elapsed.items():
+            span.set_attribute(f"promptflow.assistant.phase.{name}.elapsed", round(elapsed, 3))
+            span.set_attribute(f"promptflow.assistant.phase.{name}.budget", self.budgets.get(name, self.turn_budget))
+        if self.timed_out:
+            span.set_attribute("promptflow.assistant.timed_out", ",".join(self.timed_out))
+
+
+class Watchdog:
+    """One thread calling callbacks at their deadlines (time.monotonic)."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cancelled = set()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def watch(self, deadline: float, callback) -> int:
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="assistant-watchdog", daemon=True)
+                self._thread.start()
+            handle = next(self._counter)
+            heapq.heappush(self._heap, (deadline, handle, callback))
+            self._condition.notify()
+            return handle
+
+    def cancel(self, handle: int) -> None:
+        with self._condition:
+            self._cancelled.add(handle)
+
+    @contextmanager
+    def watching(self, deadline: float, callback):
+        handle = self.watch(deadline, callback)
+        try:
+            yield
+        finally:
+            self.cancel(handle)
+
+    def _loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                _, handle, callback = heapq.heappop(self._heap)
+                if handle in self._cancelled:
+                    self._cancelled.discard(handle)
+                    continue
+            try:
+                callback()
+            except Exception as e:
+                logging.warning(f"watchdog callback failed: {e}")
+
+
+watchdog = Watchdog()
@@ -0,0 +1,255 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# Typed events of the chat_output stream and the bounded channels that carry them
+# from the event handler of a run to its consumer (app.py or the promptflow flow).
+#
+# str(event) is the text shown for an event, so consumers that only want text can
+# join the events. The channels are configured with environment variables:
+#   ASSISTANT_STREAM_CAPACITY       max events waiting for the consumer (default 256)
+#   ASSISTANT_TRANSCRIPT_MAX_CHARS  max characters of the transcript kept for the stream span (default 65536)
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Iterator, NamedTuple
+
+from opentelemetry import trace
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+
+from assistant_flow.attributes import set_attribute
+
+# adjacent text deltas are merged up to this size
+_MAX_COALESCED_CHARS = 4096
+
+
+class TextDelta(NamedTuple):
+    text: str
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class ToolCallStarted(NamedTuple):
+    id: str
+    type: str
+    name: str = None
+
+    def __str__(self) -> str:
+        if self.type == "function":
+            return f"\n> tool_call: {self.type}\n> id  : {self.id}\n> name: {self.name}\n> arguments: "
+        if self.type == "code_interpreter":
+            return f"\n> tool_call: {self.type}\n> id  : {self.id}\n\n"
+        return f"\n> tool_call: {self.type}\n"
+
+
+class ToolCallArguments(NamedTuple):
+    id: str
+    delta: str
+
+    def __str__(self) -> str:
+        return self.delta
+
+
+class ToolCallDone(NamedTuple):
+    id: str
+
+    def __str__(self) -> str:
+        return "\n"
+
+
+class ImageEvent(NamedTuple):
+    """An image of the run, sent as bytes."""
+    file_id: str
+    content: bytes
+
+    def __str__(self) -> str:
+        # images stay binary, the text form only refers to them
+        return f"\n![image]({self.file_id})\n"
+
+
+class ErrorEvent(NamedTuple):
+    message: str
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class EndEvent(NamedTuple):
+    def __str__(self) -> str:
+        return ""
+
+
+class _Channel:
+    """Transcript and coalescing shared by the sync and async channels."""
+
+    def __init__(self, capacity: int = None, transcript_max_chars: int = None):
+        self.capacity = capacity or int(os.getenv("ASSISTANT_STREAM_CAPACITY", "256"))
+        self.transcript_max_chars = transcript_max_chars or int(
+            os.getenv("ASSISTANT_TRANSCRIPT_MAX_CHARS", "65536")
+        )
+        self.events: deque = deque()
+        self.cancelled = False
+        self.ended = False
+        self.transcript: list[str] = []
+        self.transcript_chars = 0
+        self.transcript_truncated = False
+        # time.monotonic() of the first text delta, for the time to first token
+        self.first_token_at = None
+        self.context_carrier = {}
+        # Write the current context into the carrier.
+        TraceContextTextMapPropagator().inject(self.context_carrier)
+
+    def _record(self, event) -> None:
+        if self.transcript_truncated:
+            return
+        text = str(event)
+        if self.transcript_chars + len(text) > self.transcript_max_chars:
+            self.transcript.append(text[: self.transcript_max_chars - self.transcript_chars])
+            self.transcript.append("\n[transcript truncated]")
+            self.transcript_truncated = True
+        else:
+            self.transcript.append(text)
+        self.transcript_chars += len(text)
+
+    def _coalesce(self, event) -> bool:
+        """Merge a text delta into the text delta waiting at the end of the queue."""
+        if isinstance(event, TextDelta) and self.events and isinstance(self.events[-1], TextDelta):
+            if len(self.events[-1].text) + len(event.text) <= _MAX_COALESCED_CHARS:
+                self.events[-1] = TextDelta(self.events[-1].text + event.text)
+                return True
+        return False
+
+    def _accept(self, event):
+        """The event to queue (plain strings become text deltas), or None to drop it."""
+        if isinstance(event, str):
+            event = TextDelta(event)
+        if self.cancelled or self.ended or event is None or (isinstance(event, TextDelta) and not event.text):
+            return None
+        if self.first_token_at is None and isinstance(event, TextDelta) and event.text.strip():
+            self.first_token_at = time.monotonic()
+        self._record(event)
+        return event
+
+    def _trace_transcript(self) -> None:
+        tracer = trace.get_tracer(__name__)
+        ctx = TraceContextTextMapPropagator().extract(carrier=self.context_carrier)
+
+        with tracer.start_as_current_span("stream", context=ctx) as span:
+            span.set_attribute("framework", "promptflow")
+            span.set_attribute("span_type", "Function")
+            span.set_attribute("function", "stream")
+            # long answers go to the blob store, see attributes.py
+            set_attribute(span, "output", json.dumps("".join(self.transcript).split("\n")))
+
+
+class EventChannel(_Channel):
+    """
+    Bounded channel between the thread running the assistant and the consumer. send
+    blocks while the channel is full, unless the event can be merged into the last
+    waiting text delta; closing or cancelling the consumer drops further events.
+    """
+
+    def __init__(self, capacity: int = None, transcript_max_chars: int = None):
+        super().__init__(capacity, transcript_max_chars)
+        self._condition = threading.Condition()
+
+    def send(self, event) -> bool:
+        with self._condition:
+            event = self._accept(event)
+            if event is None:
+                return False
+            if self._coalesce(event):
+                return True
+            while len(self.events) >= self.capacity and not self.cancelled:
+                self._condition.wait(timeout=1)
+            if self.cancelled:
+                return False
+            self.events.append(event)
+            self._condition.notify_all()
+            return True
+
+    def end(self) -> None:
+        self._trace_transcript()
+        with self._condition:
+            # the end is never blocked by a full channel
+            self.ended = True
+            self.events.append(EndEvent())
+            self._condition.notify_all()
+
+    def cancel(self) -> None:
+        """Called by the consumer, the producer sees cancelled and stops the run."""
+        with self._condition:
+            self.cancelled = True
+            self.events.clear()
+            self._condition.notify_all()
+
+    def iter(self) -> Iterator:
+        try:
+            while True:
+                with self._condition:
+                    while not self.events:
+                        self._condition.wait()
+                    event = self.events.popleft()
+                    self._condition.notify_all()
+                if isinstance(event, EndEvent):
+                    return
+                yield event
+        finally:
+            # the consumer went away before the end
+            if not self.ended:
+                self.cancel()
+
+
+class AsyncEventChannel(_Channel):
+    """EventChannel for asyncio, send waits without blocking the loop."""
+
+    def __init__(self, capacity: int = None, transcript_max_chars: int = None):
+        super().__init__(capacity, transcript_max_chars)
+        self._changed = asyncio.Event()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def send(self, event) -> bool:
+        event = self._accept(event)
+        if event is None:
+            return False
+        if self._coalesce(event):
+            return True
+        while len(self.events) >= self.capacity and not self.cancelled:
+            await self._changed.wait()
+        if self.cancelled:
+            return False
+        self.events.append(event)
+        self._notify()
+        return True
+
+    def end(self) -> None:
+        self._trace_transcript()
+        self.ended = True
+        self.events.append(EndEvent())
+        self._notify()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        self.events.clear()
+        self._notify()
+
+    async def iter(self) -> AsyncIterator:
+        try:
+            while True:
+                while not self.events:
+                    await self._changed.wait()
+                event = self.events.popleft()
+                self._notify()
+                if isinstance(event, EndEvent):
+                    return
+                yield event
+        finally:
+            if not self.ended:
+                self.cancel()
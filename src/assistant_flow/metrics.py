@@ -0,0 +1,54 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# Latency metrics of assistant turns (OpenTelemetry meter "assistant_flow.metrics"), in seconds:
+#   assistant.phase.duration          each phase of a turn, by phase (submit_message, stream,
+#                                     tool_calls, tool_outputs_stream) and status
+#   assistant.turn.duration           the whole turn, by model and status
+#   assistant.turn.time_to_first_token  from the start of the turn to the first text delta
+#   assistant.tool.queue_wait         from submitting a tool call until a worker picks it up
+#   assistant.tool.duration           running a tool call, by tool and status
+# The database and SQL generation side is in sales_data_insights/metrics.py.
+
+import time
+
+from opentelemetry import metrics
+
+meter = metrics.get_meter(__name__)
+phase_duration = meter.create_histogram(
+    "assistant.phase.duration", unit="s", description="Duration of a phase of an assistant turn"
+)
+turn_duration = meter.create_histogram(
+    "assistant.turn.duration", unit="s", description="Duration of an assistant turn"
+)
+time_to_first_token = meter.create_histogram(
+    "assistant.turn.time_to_first_token", unit="s", description="Time until the first text of an assistant turn"
+)
+tool_queue_wait = meter.create_histogram(
+    "assistant.tool.queue_wait", unit="s", description="Time a tool call waited for a worker"
+)
+tool_duration = meter.create_histogram(
+    "assistant.tool.duration", unit="s", description="Duration of a tool call"
+)
+
+
+def record_turn(start: float, first_token_at: float | None, status: str, model: str = None) -> None:
+    """Record a turn started at start (time.monotonic), status is completed, cancelled, timeout or failed."""
+    attributes = {"status": status, "model": model or "unknown"}
+    turn_duration.record(time.monotonic() - start, attributes)
+    if first_token_at is not None:
+        time_to_first_token.record(first_token_at - start, attributes)
+
+
+def timed_tool_call(name: str, submitted: float, tool_func: callable, **arguments):
+    """Call a sync tool in a worker, recording its wait for the worker and its duration."""
+    started = time.monotonic()
+    tool_queue_wait.record(started - submitted, {"tool": name})
+    status = "error"
+    try:
+        result = tool_func(**arguments)
+        # tools report failures in their result, like the error of SalesDataInsights
+        status = "error" if isinstance(result, dict) and result.get("error") not in (None, "None") else "ok"
+        return result
+    finally:
+        tool_duration.record(time.monotonic() - started, {"tool": name, "status": status})
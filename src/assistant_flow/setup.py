@@ -60,7 +60,8 @@ tools = [
   If you are unsure of the data available, you can ask for a list of categories, days, etc.
   - query for all the values for the main_category
   The data will be returned in a json format in the data property of the returned object with the query used 
-  to get the data in the query property.
+  to get the data in the query property. data has the column names in columns and one array per row in rows;
+  row_count is the total number of rows and truncated is true if only the first rows were returned.
   If a query cannot be answered, the tool will return a message in the error property of the returned object. 
             """,
             "parameters": {
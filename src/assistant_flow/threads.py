@@ -0,0 +1,162 @@
+# enable type annotation syntax on Python versions earlier than 3.9
+from __future__ import annotations
+
+# Assistants threads off the critical path of a turn. New chats take a thread created
+# ahead of time from a pool that is refilled in the background, and resumed chats skip
+# threads.retrieve while their thread id was validated recently. Configured with
+# environment variables:
+#   ASSISTANT_THREAD_POOL_SIZE  threads created ahead of time per client (default 4, 0 disables)
+#   ASSISTANT_THREAD_CACHE_TTL  seconds a validated thread id is trusted (default 300)
+#
+# Pooled threads that are never used stay empty on the service when the process exits.
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# creates the threads of the sync pools
+_thread_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="assistant-threads")
+
+
+class ValidatedThreads:
+    """Thread ids known to exist, each trusted for ttl seconds."""
+
+    def __init__(self, ttl: float = None):
+        self.ttl = ttl if ttl is not None else float(os.getenv("ASSISTANT_THREAD_CACHE_TTL", "300"))
+        self._expiry: dict[str, float] = {}
+        self._lock = Lock()
+
+    def add(self, thread_id: str) -> None:
+        with self._lock:
+            self._expiry[thread_id] = time.monotonic() + self.ttl
+            # drop the expired ids now and then so the cache does not grow with every session
+            if len(self._expiry) > 1024:
+                now = time.monotonic()
+                self._expiry = {key: expiry for key, expiry in self._expiry.items() if expiry > now}
+
+    def discard(self, thread_id: str) -> None:
+        with self._lock:
+            self._expiry.pop(thread_id, None)
+
+    def __contains__(self, thread_id: str) -> bool:
+        with self._lock:
+            return self._expiry.get(thread_id, 0) > time.monotonic()
+
+
+validated_threads = ValidatedThreads()
+
+
+class PrecreatedThreads:
+    """Threads created ahead of time for one client, refilled by a background worker."""
+
+    def __init__(self, client, size: int):
+        self.client = client
+        self.size = size
+        self._ids: deque[str] = deque()
+        self._lock = Lock()
+        self._refilling = False
+
+    def take(self) -> str | None:
+        with self._lock:
+            thread_id = self._ids.popleft() if self._ids else None
+        self.refill()
+        return thread_id
+
+    def refill(self) -> None:
+        with self._lock:
+            if self._refilling or len(self._ids) >= self.size:
+                return
+            self._refilling = True
+        _thread_executor.submit(self._refill)
+
+    def _refill(self) -> None:
+        try:
+            while len(self._ids) < self.size:
+                thread_id = self.client.beta.threads.create(timeout=10).id
+                validated_threads.add(thread_id)
+                with self._lock:
+                    self._ids.append(thread_id)
+        except Exception as e:
+            logging.warning(f"Failed to pre-create a thread: {e}")
+        finally:
+            with self._lock:
+                self._refilling = False
+
+
+class AsyncPrecreatedThreads(PrecreatedThreads):
+    """PrecreatedThreads for the async client, refilled by a task on its loop."""
+
+    def refill(self) -> None:
+        if self._refilling or len(self._ids) >= self.size:
+            return
+        self._refilling = True
+        asyncio.ensure_future(self._refill())
+
+    async def _refill(self) -> None:
+        try:
+            while len(self._ids) < self.size:
+                thread = await self.client.beta.threads.create(timeout=10)
+                validated_threads.add(thread.id)
+                self._ids.append(thread.id)
+        except Exception as e:
+            logging.warning(f"Failed to pre-create a thread: {e}")
+        finally:
+            self._refilling = False
+
+
+# one pool per (shared) client, see sales_data_insights/clients.py
+_pools: dict[int, PrecreatedThreads] = {}
+_pools_lock = Lock()
+
+
+def _pool(client, pool_class) -> PrecreatedThreads | None:
+    size = int(os.getenv("ASSISTANT_THREAD_POOL_SIZE", "4"))
+    if size <= 0:
+        return None
+    with _pools_lock:
+        pool = _pools.get(id(client))
+        if pool is None or pool.client is not client:
+            pool = _pools[id(client)] = pool_class(client, size)
+        return pool
+
+
+def new_thread_id(client) -> str:
+    """A new thread, from the pool when one is ready."""
+    pool = _pool(client, PrecreatedThreads)
+    thread_id = pool.take() if pool else None
+    if thread_id is None:
+        thread_id = client.beta.threads.create().id
+        validated_threads.add(thread_id)
+    return thread_id
+
+
+def resume_thread_id(client, thread_id: str) -> str:
+    """The id of an existing thread, retrieved only when it was not validated recently."""
+    if thread_id not in validated_threads:
+        thread_id = client.beta.threads.retrieve(thread_id).id
+        validated_threads.add(thread_id)
+    return thread_id
+
+
+async def anew_thread_id(client) -> str:
+    """new_thread_id for the async client."""
+    pool = _pool(client, AsyncPrecreatedThreads)
+    thread_id = pool.take() if pool else None
+    if thread_id is None:
+        thread = await client.beta.threads.create()
+        thread_id = thread.id
+        validated_threads.add(thread_id)
+    return thread_id
+
+
+async def aresume_thread_id(client, thread_id: str) -> str:
+    """resume_thread_id for the async client."""
+    if thread_id not in validated_threads:
+        thread = await client.beta.threads.retrieve(thread_id)
+        thread_id = thread.id
+        validated_threads.add(thread_id)
+    return thread_id
@@ -0,0 +1,518 @@
+# this script replays the questions of a test set as concurrent simulated users to find the
+# concurrency knee of the assistant before production does:
+#   - targets: chat_completion in-process ("sync", on a thread pool), async_chat_completion
+#     in-process ("async") or a running Chainlit app over its websocket ("chainlit", needs
+#     python-socketio)
+#   - a session is --turns questions in a row, reusing the session_state of the previous turn
+#     (the Chainlit app keeps it in the user session)
+#   - closed loop: --users users each run sessions back to back, with --think_time between turns
+#   - open loop: sessions arrive at --rate per second (Poisson), whatever the latency
+#   - --ramp_up seconds to reach the level of the first stage, and --stages to step through
+#     levels ("users:seconds" or "rate:seconds", e.g. 5:60,10:60,20:60), reported per stage
+#
+# Reported per stage: turns, throughput, time to first token and turn latency percentiles,
+# errors by message, admission rejections, assistant threads and OS threads of the process.
+# With --stub the in-process targets talk to benchmark/stub_server.py instead of Azure.
+#
+# usage: python -m benchmark.load_test --target sync --stub --users 8 --duration 60
+#        python -m benchmark.load_test --target chainlit --url http://localhost:8000 --arrival open --stages 0.5:60,1:60,2:60
+
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from benchmark.stub_server import Latency
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def load_questions(files: list) -> list:
+    questions = []
+    for file in files:
+        with open(file) as f:
+            for line in f:
+                if line.strip():
+                    questions.append(json.loads(line)["question"])
+    return questions
+
+
+def percentile(values: list, p: float) -> float:
+    """Linear interpolation between the closest ranks, None without values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class Turn:
+    """Outcome of one question, filled in by the targets."""
+
+    def __init__(self, session: str, index: int, question: str, stage: int):
+        self.session = session
+        self.index = index
+        self.question = question
+        self.stage = stage
+        self.start = time.monotonic()
+        self.first_token_at = None
+        self.end = None
+        # ok, error, rejected or timeout
+        self.status = "ok"
+        self.error = None
+        self.thread_id = None
+
+    def token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+    def fail(self, status: str, error: str) -> None:
+        self.status = status
+        self.error = error
+
+    def record(self) -> dict:
+        return dict(
+            session=self.session,
+            turn=self.index,
+            stage=self.stage,
+            question=self.question,
+            status=self.status,
+            error=self.error,
+            thread_id=self.thread_id,
+            ttft=None if self.first_token_at is None else round(self.first_token_at - self.start, 4),
+            latency=round(self.end - self.start, 4),
+        )
+
+
+class SyncTarget:
+    """chat_completion in-process, each turn on a thread of a pool sized for the load."""
+
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="load-test")
+
+    async def open(self, session: str) -> dict:
+        return {"user": session, "session_state": None}
+
+    async def close(self, state: dict) -> None:
+        pass
+
+    async def turn(self, state: dict, turn: Turn) -> None:
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._turn, state, turn)
+
+    def _turn(self, state: dict, turn: Turn) -> None:
+        from assistant_flow.admission import AdmissionRejected
+        from assistant_flow.chat import chat_completion
+
+        try:
+            response = chat_completion(turn.question, session_state=state["session_state"], user=state["user"])
+        except AdmissionRejected as e:
+            return turn.fail("rejected", e.reason)
+        for event in response["chat_output"]:
+            consume(turn, event)
+        state["session_state"] = response["session_state"]
+        turn.thread_id = state["session_state"]["thread_id"]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+class AsyncTarget:
+    """async_chat_completion in-process, on the event loop of the load test."""
+
+    async def open(self, session: str) -> dict:
+        return {"user": session, "session_state": None}
+
+    async def close(self, state: dict) -> None:
+        pass
+
+    async def turn(self, state: dict, turn: Turn) -> None:
+        from assistant_flow.admission import AdmissionRejected
+        from assistant_flow.chat import async_chat_completion
+
+        try:
+            response = await async_chat_completion(turn.question, session_state=state["session_state"], user=state["user"])
+        except AdmissionRejected as e:
+            return turn.fail("rejected", e.reason)
+        async for event in response["chat_output"]:
+            consume(turn, event)
+        state["session_state"] = response["session_state"]
+        turn.thread_id = state["session_state"]["thread_id"]
+
+    def shutdown(self) -> None:
+        pass
+
+
+def consume(turn: Turn, event) -> None:
+    from assistant_flow.events import ErrorEvent, TextDelta
+
+    if isinstance(event, TextDelta) and event.text.strip():
+        turn.token()
+    elif isinstance(event, ErrorEvent):
+        turn.fail("timeout" if "timed out" in event.message else "error", event.message)
+
+
+class ChainlitTarget:
+    """
+    A running Chainlit app, one websocket (and so one Chainlit session) per simulated session.
+    A turn starts with the user message and ends with the task_end event of the app.
+    """
+
+    def __init__(self, url: str, message_event: str = "client_message"):
+        self.url = url
+        # "client_message" since Chainlit 1.1, "ui_message" before
+        self.message_event = message_event
+
+    async def open(self, session: str) -> dict:
+        try:
+            import socketio
+        except ImportError:
+            raise ImportError("the chainlit target needs python-socketio: pip install 'python-socketio[asyncio_client]'")
+
+        client = socketio.AsyncClient(reconnection=False)
+        state = {"client": client, "turn": None, "done": None}
+
+        @client.on("stream_token")
+        async def on_token(data):
+            if state["turn"] is not None and str(data.get("token", "")).strip():
+                state["turn"].token()
+
+        @client.on("task_end")
+        async def on_task_end(data=None):
+            if state["done"] is not None and not state["done"].done():
+                state["done"].set_result(None)
+
+        @client.on("new_message")
+        async def on_message(data):
+            # app.py answers busy (admission) and failed runs with a plain message
+            output = str(data.get("output") or data.get("content") or "")
+            if state["turn"] is not None and output.startswith("The assistant is busy"):
+                state["turn"].fail("rejected", output)
+
+        session_id = str(uuid.uuid4())
+        await client.connect(
+            self.url,
+            socketio_path="/ws/socket.io",
+            transports=["websocket"],
+            headers={"X-Chainlit-Session-Id": session_id, "X-Chainlit-Client-Type": "webapp", "user-env": "{}"},
+            auth={"clientType": "webapp", "sessionId": session_id, "threadId": None, "userEnv": "{}", "chatProfile": None},
+        )
+        return state
+
+    async def close(self, state: dict) -> None:
+        await state["client"].disconnect()
+
+    async def turn(self, state: dict, turn: Turn) -> None:
+        state["turn"] = turn
+        state["done"] = asyncio.get_running_loop().create_future()
+        message = {
+            "id": str(uuid.uuid4()),
+            "threadId": "",
+            "name": "User",
+            "type": "user_message",
+            "output": turn.question,
+            "content": turn.question,
+            "createdAt": datetime.now(timezone.utc).isoformat(),
+        }
+        await state["client"].emit(self.message_event, {"message": message, "fileReferences": []})
+        await state["done"]
+
+    def shutdown(self) -> None:
+        pass
+
+
+class LoadTest:
+    def __init__(
+        self,
+        target,
+        questions: list,
+        arrival: str = "closed",
+        stages: list = None,
+        ramp_up: float = 0,
+        turns: int = 3,
+        think_time: str = "1",
+        turn_timeout: float = 300,
+        max_sessions: int = 1000,
+        seed: int = None,
+    ):
+        if arrival not in ("closed", "open"):
+            raise ValueError(f"Unknown arrival model: {arrival}, use 'closed' or 'open'")
+        self.target = target
+        self.questions = questions
+        self.arrival = arrival
+        # [(users or sessions per second, seconds)]
+        self.stages = stages
+        self.ramp_up = ramp_up
+        self.turns = turns
+        self.rng = random.Random(seed)
+        self.think_time = Latency(think_time, self.rng)
+        self.turn_timeout = turn_timeout
+        # open loop sessions over this many at once are not started (counted as skipped)
+        self.max_sessions = max_sessions
+        self.records = []
+        self.active_sessions = 0
+        self.skipped = Counter()
+        self.os_threads = []
+        self.started = None
+
+    def stage(self) -> tuple:
+        """(index, level) of the current stage, index None when the test is over."""
+        elapsed = time.monotonic() - self.started
+        for index, (level, seconds) in enumerate(self.stages):
+            if elapsed < seconds:
+                if index == 0 and self.ramp_up > 0:
+                    level = level * min(1.0, elapsed / self.ramp_up)
+                return index, level
+            elapsed -= seconds
+        return None, 0
+
+    async def session(self, name: str) -> None:
+        self.active_sessions += 1
+        try:
+            state = await self.target.open(name)
+        except Exception as e:
+            self.active_sessions -= 1
+            logging.warning(f"session {name} failed to open: {e}")
+            self.skipped["open failed"] += 1
+            return
+        offset = self.rng.randrange(len(self.questions))
+        try:
+            for index in range(self.turns):
+                stage, _ = self.stage()
+                if stage is None:
+                    return
+                turn = Turn(name, index, self.questions[(offset + index) % len(self.questions)], stage)
+                try:
+                    await asyncio.wait_for(self.target.turn(state, turn), self.turn_timeout)
+                except asyncio.TimeoutError:
+                    turn.fail("timeout", f"no answer after {self.turn_timeout} seconds")
+                except Exception as e:
+                    turn.fail("error", f"{type(e).__name__}: {e}")
+                turn.end = time.monotonic()
+                self.records.append(turn.record())
+                if turn.status == "rejected":
+                    # a new session would be rejected too, let the user wait
+                    return
+                if index < self.turns - 1:
+                    await asyncio.sleep(self.think_time.sample())
+        finally:
+            self.active_sessions -= 1
+            try:
+                await self.target.close(state)
+            except Exception as e:
+                logging.debug(f"session {name} failed to close: {e}")
+
+    async def user(self, index: int) -> None:
+        """A closed loop user, active while the level of the stage is above its index."""
+        session = 0
+        while True:
+            stage, level = self.stage()
+            if stage is None:
+                return
+            if index >= level:
+                await asyncio.sleep(0.1)
+                continue
+            await self.session(f"user-{index}-{session}")
+            session += 1
+            await asyncio.sleep(self.think_time.sample())
+
+    async def arrivals(self) -> None:
+        """Open loop sessions, Poisson arrivals at the rate of the stage."""
+        tasks = set()
+        count = 0
+        while True:
+            stage, rate = self.stage()
+            if stage is None:
+                break
+            if rate <= 0:
+                await asyncio.sleep(0.1)
+                continue
+            gap = self.rng.expovariate(rate)
+            if gap > 0.1:
+                # the rate changes while ramping up, exponential gaps can be drawn again
+                await asyncio.sleep(0.1)
+                continue
+            await asyncio.sleep(gap)
+            if self.active_sessions >= self.max_sessions:
+                self.skipped["max sessions"] += 1
+                continue
+            task = asyncio.ensure_future(self.session(f"session-{count}"))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            count += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def monitor(self) -> None:
+        while True:
+            self.os_threads.append((self.stage()[0], threading.active_count()))
+            await asyncio.sleep(1)
+
+    async def run(self) -> dict:
+        self.started = time.monotonic()
+        monitor = asyncio.ensure_future(self.monitor())
+        try:
+            if self.arrival == "closed":
+                users = int(max(level for level, _ in self.stages))
+                await asyncio.gather(*(self.user(index) for index in range(users)))
+            else:
+                await self.arrivals()
+        finally:
+            monitor.cancel()
+            self.target.shutdown()
+        return self.report(time.monotonic() - self.started)
+
+    def report(self, elapsed: float) -> dict:
+        stages = []
+        for index, (level, seconds) in enumerate(self.stages):
+            records = [record for record in self.records if record["stage"] == index]
+            threads = [count for stage, count in self.os_threads if stage == index]
+            stages.append(dict(level=level, seconds=seconds, **summarize(records, seconds, threads)))
+        threads = [count for _, count in self.os_threads]
+        return dict(
+            arrival=self.arrival,
+            elapsed=round(elapsed, 1),
+            skipped_sessions=dict(self.skipped),
+            stages=stages,
+            total=summarize(self.records, elapsed, threads),
+            records=self.records,
+        )
+
+
+def summarize(records: list, seconds: float, os_threads: list) -> dict:
+    ok = [record for record in records if record["status"] == "ok"]
+    ttft = [record["ttft"] for record in ok if record["ttft"] is not None]
+    latency = [record["latency"] for record in ok]
+    thread_ids = {record["thread_id"] for record in records if record["thread_id"]}
+    return dict(
+        turns=len(records),
+        completed=len(ok),
+        throughput=round(len(ok) / seconds, 3) if seconds else None,
+        status=dict(Counter(record["status"] for record in records)),
+        errors=dict(Counter((record["error"] or "")[:80] for record in records if record["status"] != "ok").most_common(10)),
+        ttft={**{f"p{p}": round_or_none(percentile(ttft, p)) for p in PERCENTILES}, "max": max(ttft, default=None)},
+        latency={**{f"p{p}": round_or_none(percentile(latency, p)) for p in PERCENTILES}, "max": max(latency, default=None)},
+        sessions=len({record["session"] for record in records}),
+        # more assistant threads than sessions means threads were compacted (compaction.py)
+        assistant_threads=len(thread_ids),
+        os_threads_max=max(os_threads, default=None),
+        os_threads_mean=round(sum(os_threads) / len(os_threads), 1) if os_threads else None,
+    )
+
+
+def round_or_none(value):
+    return None if value is None else round(value, 3)
+
+
+def print_summary(name: str, summary: dict) -> None:
+    print(
+        f"{name}: {summary['completed']}/{summary['turns']} turns ok, {summary['throughput']} turns/s, "
+        f"status {summary['status']}, sessions {summary['sessions']}, assistant threads {summary['assistant_threads']}, "
+        f"os threads max {summary['os_threads_max']} mean {summary['os_threads_mean']}"
+    )
+    for metric in ("ttft", "latency"):
+        print(f"  {metric:8}" + "".join(f"  {key} {value}" for key, value in summary[metric].items()))
+    for error, count in summary["errors"].items():
+        print(f"  {count:5} x {error}")
+
+
+def parse_stages(spec: str) -> list:
+    stages = []
+    for stage in spec.split(","):
+        level, seconds = stage.split(":")
+        stages.append((float(level), float(seconds)))
+    return stages
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay test set questions as concurrent simulated users")
+    parser.add_argument("--target", default="sync", choices=["sync", "async", "chainlit"])
+    parser.add_argument("--url", default="http://localhost:8000", help="url of the Chainlit app (chainlit target)")
+    parser.add_argument("--chainlit_event", default="client_message", help="socket event of a user message, ui_message before Chainlit 1.1")
+    parser.add_argument("--questions", nargs="*", default=["generate_data/test_set_xxl.jsonl"], help="jsonl files with a question per line")
+    parser.add_argument("--arrival", default="closed", choices=["closed", "open"])
+    parser.add_argument("--users", type=int, default=4, help="closed loop users, when no --stages")
+    parser.add_argument("--rate", type=float, default=0.5, help="open loop sessions per second, when no --stages")
+    parser.add_argument("--duration", type=float, default=60, help="seconds, when no --stages")
+    parser.add_argument("--stages", help="level:seconds,... with users (closed) or sessions per second (open) as levels")
+    parser.add_argument("--ramp_up", type=float, default=0, help="seconds to reach the level of the first stage")
+    parser.add_argument("--turns", type=int, default=3, help="questions per session")
+    parser.add_argument("--think_time", default="1", help="seconds between turns, as a latency of stub_server.py")
+    parser.add_argument("--turn_timeout", type=float, default=300)
+    parser.add_argument("--max_sessions", type=int, default=1000, help="max concurrent open loop sessions")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--stub", action="store_true", help="run the in-process targets against a local stub server")
+    parser.add_argument("--stub_script", help="turn script of the stub server, see stub_server.py")
+    parser.add_argument("--env", help="Path to .env file", default=".env")
+    parser.add_argument("--output", help="write the report and the turns as JSON")
+    parser.add_argument("--log", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    if args.target != "chainlit":
+        from dotenv import load_dotenv
+
+        load_dotenv(args.env, override=True)
+    if args.stub:
+        from benchmark.stub_server import StubConfig, load_queries, start_stub_server
+
+        script = None
+        if args.stub_script:
+            with open(args.stub_script) as f:
+                script = json.load(f)
+        _, url = start_stub_server(StubConfig(script=script, queries=load_queries(args.questions), seed=args.seed))
+        os.environ["OPENAI_API_BASE"] = url
+        for name, value in (
+            ("OPENAI_API_KEY", "stub"),
+            ("OPENAI_API_VERSION", "2024-05-01-preview"),
+            ("OPENAI_ASSISTANT_ID", "asst_stub"),
+            ("OPENAI_ANALYST_CHAT_MODEL", "stub-model"),
+        ):
+            os.environ.setdefault(name, value)
+        print(f"stub server on {url}")
+
+    stages = parse_stages(args.stages) if args.stages else [
+        (args.users if args.arrival == "closed" else args.rate, args.duration)
+    ]
+    if args.target == "sync":
+        # enough threads for every session to have a turn in flight
+        workers = int(max(level for level, _ in stages)) if args.arrival == "closed" else args.max_sessions
+        target = SyncTarget(workers)
+    elif args.target == "async":
+        target = AsyncTarget()
+    else:
+        target = ChainlitTarget(args.url, args.chainlit_event)
+
+    load_test = LoadTest(
+        target,
+        load_questions(args.questions),
+        arrival=args.arrival,
+        stages=stages,
+        ramp_up=args.ramp_up,
+        turns=args.turns,
+        think_time=args.think_time,
+        turn_timeout=args.turn_timeout,
+        max_sessions=args.max_sessions,
+        seed=args.seed,
+    )
+    report = asyncio.run(load_test.run())
+
+    for index, stage in enumerate(report["stages"]):
+        print_summary(f"stage {index + 1} ({args.arrival}, level {stage['level']}, {stage['seconds']}s)", stage)
+    print_summary(f"total ({report['elapsed']}s)", report["total"])
+    if report["skipped_sessions"]:
+        print(f"skipped sessions: {report['skipped_sessions']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,650 @@
+# this script serves a local stand-in for the Azure OpenAI endpoints used by the app, so a
+# whole turn (chat_completion -> AssistantAPI -> EventHandler -> SalesDataInsights -> SQLite)
+# runs without Azure and can be benchmarked reproducibly:
+#   - Assistants: threads, messages, runs (streamed as SSE or polled), submit_tool_outputs,
+#     cancel and files content
+#   - Chat completions for SalesDataInsights, both the AzureOpenAI deployments route and
+#     the azure-ai-inference route
+#
+# Point the app at it with OPENAI_API_BASE=http://127.0.0.1:8765, any OPENAI_API_KEY and
+# OPENAI_ASSISTANT_ID, and AZUREAI_<MODEL_TYPE>_URL=http://127.0.0.1:8765 for the other models.
+#
+# Latencies are distributions: "0.2" or "fixed:0.2", "uniform:0.1,0.5", "lognormal:<median>,<sigma>"
+# or "exp:<mean>" (seconds). A script (JSON) describes the turns of a thread, cycled by turn:
+#   [{"tool_calls": [{"name": "sales_data_insights"}], "answer_tokens": 80},
+#    {"tool_calls": [{"name": "sales_data_insights", "arguments": {"question": "..."}}, ...],
+#     "image": true, "answer_tokens": 120},
+#    {"answer_tokens": 40}]
+# tool calls without arguments ask the user question; "image" adds a code interpreter chart.
+#
+# usage: python -m benchmark.stub_server --port 8765 --tokens_per_second 40 --ttft lognormal:0.8,0.4
+
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_SCRIPT = [{"tool_calls": [{"name": "sales_data_insights"}], "answer_tokens": 80}]
+DEFAULT_SQL = "SELECT Year, SUM(Sum_of_Order_Value_USD) AS revenue FROM order_data GROUP BY Year"
+MODEL = "stub-model"
+WORDS = (
+    "the revenue of the orders grew in every region while the number of orders per day "
+    "stayed flat and europe leads the quarter ahead of north america"
+).split()
+
+
+class Latency:
+    """A latency distribution in seconds, see the module comment for the syntax."""
+
+    def __init__(self, spec: str, rng: random.Random):
+        self.spec = spec
+        self.rng = rng
+        kind, _, params = spec.partition(":") if ":" in spec else ("fixed", "", spec)
+        self.kind = kind
+        self.params = [float(param) for param in params.split(",")]
+        if kind not in ("fixed", "uniform", "lognormal", "exp"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return self.rng.uniform(*self.params)
+        if self.kind == "lognormal":
+            median, sigma = self.params
+            return self.rng.lognormvariate(math.log(median), sigma) if median > 0 else 0
+        return self.rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0
+
+
+class StubConfig:
+    def __init__(
+        self,
+        tokens_per_second: float = 50,
+        ttft: str = "0.5",
+        api_latency: str = "0.02",
+        chat_latency: str = "0.8",
+        script: list = None,
+        queries: dict = None,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        stall_rate: float = 0.0,
+        stall_seconds: float = 60,
+        seed: int = None,
+    ):
+        self.rng = random.Random(seed)
+        self.tokens_per_second = tokens_per_second
+        self.ttft = Latency(ttft, self.rng)
+        self.api_latency = Latency(api_latency, self.rng)
+        self.chat_latency = Latency(chat_latency, self.rng)
+        self.script = script or DEFAULT_SCRIPT
+        # question -> SQL for the chat completions, DEFAULT_SQL otherwise
+        self.queries = queries or {}
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self._lock = threading.Lock()
+
+    def chance(self, rate: float) -> bool:
+        with self._lock:
+            return rate > 0 and self.rng.random() < rate
+
+    def sleep(self, latency: Latency) -> None:
+        with self._lock:
+            seconds = latency.sample()
+        time.sleep(seconds)
+
+
+def new_id(prefix: str) -> str:
+    return f"{prefix}_{uuid.uuid4().hex[:24]}"
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def chart_png(width: int = 64, height: int = 48) -> bytes:
+    """A small valid PNG (a bar chart like gradient) for the code interpreter files."""
+    rows = b"".join(
+        b"\x00" + bytes(0x30 if x * height // width < height - y else 0xF0 for x in range(width))
+        for y in range(height)
+    )
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+class State:
+    """Threads, runs and files of the stub, shared by the request threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.threads: dict[str, dict] = {}
+        self.runs: dict[str, dict] = {}
+        self.files: dict[str, bytes] = {}
+        # run id -> set when the run is cancelled
+        self.cancelled: dict[str, threading.Event] = {}
+
+
+def message_object(thread_id: str, role: str, content: list, run_id: str = None, assistant_id: str = None) -> dict:
+    return {
+        "id": new_id("msg"),
+        "object": "thread.message",
+        "created_at": int(time.time()),
+        "thread_id": thread_id,
+        "role": role,
+        "content": content,
+        "assistant_id": assistant_id,
+        "run_id": run_id,
+        "attachments": [],
+        "metadata": {},
+        "status": "completed",
+        "incomplete_details": None,
+        "completed_at": int(time.time()),
+        "incomplete_at": None,
+    }
+
+
+def text_content(text: str) -> dict:
+    return {"type": "text", "text": {"value": text, "annotations": []}}
+
+
+def run_object(thread_id: str, assistant_id: str, status: str = "queued") -> dict:
+    return {
+        "id": new_id("run"),
+        "object": "thread.run",
+        "created_at": int(time.time()),
+        "thread_id": thread_id,
+        "assistant_id": assistant_id,
+        "status": status,
+        "required_action": None,
+        "last_error": None,
+        "expires_at": None,
+        "started_at": None,
+        "cancelled_at": None,
+        "failed_at": None,
+        "completed_at": None,
+        "model": MODEL,
+        "instructions": "",
+        "tools": [],
+        "metadata": {},
+        "usage": None,
+        "incomplete_details": None,
+        "max_prompt_tokens": None,
+        "max_completion_tokens": None,
+        "truncation_strategy": {"type": "auto", "last_messages": None},
+        "response_format": "auto",
+        "tool_choice": "auto",
+        "parallel_tool_calls": True,
+        "temperature": 1.0,
+        "top_p": 1.0,
+    }
+
+
+def step_object(run: dict, step_type: str, details: dict) -> dict:
+    return {
+        "id": new_id("step"),
+        "object": "thread.run.step",
+        "created_at": int(time.time()),
+        "run_id": run["id"],
+        "assistant_id": run["assistant_id"],
+        "thread_id": run["thread_id"],
+        "type": step_type,
+        "status": "in_progress",
+        "step_details": details,
+        "last_error": None,
+        "expired_at": None,
+        "cancelled_at": None,
+        "failed_at": None,
+        "completed_at": None,
+        "metadata": {},
+        "usage": None,
+    }
+
+
+class Turn:
+    """The scripted progress of the runs of one user message."""
+
+    def __init__(self, script: dict, question: str):
+        self.tool_calls = [
+            {"name": call.get("name", "sales_data_insights"), "arguments": call.get("arguments") or {"question": question}}
+            for call in script.get("tool_calls", [])
+        ]
+        self.image = script.get("image", False)
+        self.answer_tokens = script.get("answer_tokens", 80)
+        self.tool_outputs = []
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: StubConfig = None
+    state: State = None
+
+    # routes: (method, pattern) -> handler name; the /openai prefix of Azure is optional
+    routes = [
+        ("POST", r"/threads", "create_thread"),
+        ("GET", r"/threads/(?P<thread_id>[^/]+)", "retrieve_thread"),
+        ("POST", r"/threads/(?P<thread_id>[^/]+)/messages", "create_message"),
+        ("GET", r"/threads/(?P<thread_id>[^/]+)/messages", "list_messages"),
+        ("POST", r"/threads/(?P<thread_id>[^/]+)/runs", "create_run"),
+        ("GET", r"/threads/(?P<thread_id>[^/]+)/runs", "list_runs"),
+        ("GET", r"/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)", "retrieve_run"),
+        ("POST", r"/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)/submit_tool_outputs", "submit_tool_outputs"),
+        ("POST", r"/threads/(?P<thread_id>[^/]+)/runs/(?P<run_id>[^/]+)/cancel", "cancel_run"),
+        ("GET", r"/files/(?P<file_id>[^/]+)/content", "file_content"),
+        ("POST", r"/deployments/(?P<deployment>[^/]+)/chat/completions", "chat_completions"),
+        ("POST", r"/chat/completions", "chat_completions"),
+    ]
+
+    def log_message(self, format, *args):
+        # one line per request is too chatty under load
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method: str) -> None:
+        url = urlparse(self.path)
+        path = re.sub(r"^/openai", "", url.path).rstrip("/")
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+        for route_method, pattern, name in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                if self.config.chance(self.config.error_rate):
+                    return self.send_error_json(self.config.error_status, "injected error")
+                try:
+                    return getattr(self, name)(**match.groupdict())
+                except KeyError as e:
+                    return self.send_error_json(404, f"not found: {e}")
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client went away, e.g. a cancelled stream
+                    self.close_connection = True
+                    return
+        self.send_error_json(404, f"no route for {method} {url.path}")
+
+    # responses
+
+    def send_json(self, payload, status: int = 200) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status: int, message: str) -> None:
+        body = json.dumps({"error": {"code": str(status), "message": message}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_events(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_event(self, event: str, data) -> None:
+        payload = data if isinstance(data, str) else json.dumps(data)
+        chunk = f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.flush()
+
+    def end_events(self) -> None:
+        self.send_event("done", "[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def list_payload(self, data: list) -> dict:
+        return {
+            "object": "list",
+            "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": False,
+        }
+
+    # threads and messages
+
+    def create_thread(self):
+        self.config.sleep(self.config.api_latency)
+        thread = {"id": new_id("thread"), "object": "thread", "created_at": int(time.time()), "metadata": {}}
+        messages = [
+            message_object(thread["id"], message.get("role", "user"), [text_content(str(message.get("content", "")))])
+            for message in self.body.get("messages") or []
+        ]
+        with self.state.lock:
+            self.state.threads[thread["id"]] = {"thread": thread, "messages": messages, "runs": [], "turns": 0}
+        self.send_json(thread)
+
+    def retrieve_thread(self, thread_id):
+        self.config.sleep(self.config.api_latency)
+        self.send_json(self.state.threads[thread_id]["thread"])
+
+    def create_message(self, thread_id):
+        self.config.sleep(self.config.api_latency)
+        content = self.body.get("content", "")
+        message = message_object(thread_id, self.body.get("role", "user"), [text_content(str(content))])
+        with self.state.lock:
+            thread = self.state.threads[thread_id]
+            thread["messages"].append(message)
+        self.send_json(message)
+
+    def list_messages(self, thread_id):
+        self.config.sleep(self.config.api_latency)
+        with self.state.lock:
+            messages = list(self.state.threads[thread_id]["messages"])
+        if "run_id" in self.query:
+            messages = [message for message in messages if message["run_id"] == self.query["run_id"]]
+        if self.query.get("order", "desc") == "desc":
+            messages.reverse()
+        self.send_json(self.list_payload(messages[: int(self.query.get("limit", 20))]))
+
+    # runs
+
+    def create_run(self, thread_id):
+        with self.state.lock:
+            thread = self.state.threads[thread_id]
+            run = run_object(thread_id, self.body.get("assistant_id"))
+            self.state.runs[run["id"]] = run
+            self.state.cancelled[run["id"]] = threading.Event()
+            thread["runs"].append(run["id"])
+            question = next(
+                (m["content"][0]["text"]["value"] for m in reversed(thread["messages"]) if m["role"] == "user"), ""
+            )
+            script = self.config.script[thread["turns"] % len(self.config.script)]
+            thread["turns"] += 1
+            prompt = sum(count_tokens(c["text"]["value"]) for m in thread["messages"] for c in m["content"] if c["type"] == "text")
+        # runs that must not call tools (like the summary of a compaction) only answer
+        run["turn"] = Turn({} if self.body.get("tool_choice") == "none" else script, question)
+        run["prompt_tokens"] = prompt
+
+        if self.body.get("stream"):
+            self.start_events()
+            self.send_event("thread.run.created", public(run))
+            self.stream_run(run)
+            self.end_events()
+        else:
+            # polled runs (like the summary of a compaction) skip the tool calls and finish
+            # after the time the answer would have taken to stream
+            self.config.sleep(self.config.api_latency)
+            run["status"] = "in_progress"
+            run["ready_at"] = time.monotonic() + self.answer_seconds(run["turn"].answer_tokens)
+            self.send_json(public(run))
+
+    def answer_seconds(self, tokens: int) -> float:
+        with self.config._lock:
+            ttft = self.config.ttft.sample()
+        return ttft + tokens / self.config.tokens_per_second
+
+    def retrieve_run(self, thread_id, run_id):
+        self.config.sleep(self.config.api_latency)
+        run = self.state.runs[run_id]
+        if run["status"] == "in_progress" and time.monotonic() >= run.get("ready_at", 0):
+            # complete a polled run with its whole answer at once
+            answer = answer_text(run["turn"], run["turn"].answer_tokens)
+            message = message_object(thread_id, "assistant", [text_content(answer)], run_id, run["assistant_id"])
+            with self.state.lock:
+                self.state.threads[thread_id]["messages"].append(message)
+            self.complete(run, count_tokens(answer))
+        self.send_json(public(run))
+
+    def list_runs(self, thread_id):
+        self.config.sleep(self.config.api_latency)
+        with self.state.lock:
+            runs = [public(self.state.runs[run_id]) for run_id in reversed(self.state.threads[thread_id]["runs"])]
+        self.send_json(self.list_payload(runs[: int(self.query.get("limit", 20))]))
+
+    def cancel_run(self, thread_id, run_id):
+        self.config.sleep(self.config.api_latency)
+        run = self.state.runs[run_id]
+        self.state.cancelled[run_id].set()
+        if run["status"] in ("queued", "in_progress", "requires_action"):
+            run["status"] = "cancelled"
+            run["cancelled_at"] = int(time.time())
+        self.send_json(public(run))
+
+    def submit_tool_outputs(self, thread_id, run_id):
+        run = self.state.runs[run_id]
+        if run["status"] != "requires_action":
+            return self.send_error_json(400, f"run {run_id} does not require action, status {run['status']}")
+        run["turn"].tool_outputs = self.body.get("tool_outputs", [])
+        run["turn"].tool_calls = []
+        run["required_action"] = None
+        run["status"] = "in_progress"
+        self.start_events()
+        self.stream_run(run)
+        self.end_events()
+
+    def stream_run(self, run: dict) -> None:
+        """Stream the next part of a run: its tool calls (until requires_action) or its answer."""
+        turn = run["turn"]
+        cancelled = self.state.cancelled[run["id"]]
+        run["status"] = "in_progress"
+        run["started_at"] = run["started_at"] or int(time.time())
+        self.send_event("thread.run.in_progress", public(run))
+        self.config.sleep(self.config.ttft)
+
+        if turn.image and not turn.tool_outputs:
+            self.stream_code_interpreter(run)
+
+        if turn.tool_calls:
+            self.stream_tool_calls(run, cancelled)
+            return
+
+        message = message_object(run["thread_id"], "assistant", [], run["id"], run["assistant_id"])
+        message["status"] = "in_progress"
+        step = step_object(run, "message_creation", {"type": "message_creation", "message_creation": {"message_id": message["id"]}})
+        self.send_event("thread.run.step.created", step)
+        self.send_event("thread.message.created", message)
+
+        stall_at = turn.answer_tokens // 2 if self.config.chance(self.config.stall_rate) else -1
+        words = answer_text(turn, turn.answer_tokens).split(" ")
+        for index, word in enumerate(words):
+            if cancelled.is_set():
+                self.send_event("thread.run.cancelled", public(run))
+                return
+            if index == stall_at:
+                time.sleep(self.config.stall_seconds)
+            delta = {"content": [{"index": 0, "type": "text", "text": {"value": (" " if index else "") + word, "annotations": []}}]}
+            self.send_event("thread.message.delta", {"id": message["id"], "object": "thread.message.delta", "delta": delta})
+            time.sleep(1 / self.config.tokens_per_second)
+
+        message["content"] = [text_content(" ".join(words))]
+        message["status"] = "completed"
+        with self.state.lock:
+            self.state.threads[run["thread_id"]]["messages"].append(message)
+        self.send_event("thread.message.completed", message)
+        step["status"] = "completed"
+        self.send_event("thread.run.step.completed", step)
+        self.complete(run, len(words))
+        self.send_event("thread.run.completed", public(run))
+
+    def stream_code_interpreter(self, run: dict) -> None:
+        file_id = new_id("assistant-file")
+        self.state.files[file_id] = chart_png()
+        call = {"id": new_id("call"), "type": "code_interpreter", "code_interpreter": {"input": "", "outputs": []}}
+        # the step starts empty and the deltas build the call, like stream_tool_calls
+        step = step_object(run, "tool_calls", {"type": "tool_calls", "tool_calls": []})
+        self.send_event("thread.run.step.created", step)
+        code = "import matplotlib.pyplot as plt\nplt.bar(years, revenue)\nplt.show()"
+        for delta in (
+            {"index": 0, "id": call["id"], "type": "code_interpreter", "code_interpreter": {"input": "", "outputs": []}},
+            {"index": 0, "type": "code_interpreter", "code_interpreter": {"input": code}},
+            {"index": 0, "type": "code_interpreter", "code_interpreter": {"outputs": [{"index": 0, "type": "image", "image": {"file_id": file_id}}]}},
+        ):
+            self.send_event("thread.run.step.delta", {"id": step["id"], "object": "thread.run.step.delta", "delta": {"step_details": {"type": "tool_calls", "tool_calls": [delta]}}})
+        call["code_interpreter"] = {"input": code, "outputs": [{"type": "image", "image": {"file_id": file_id}}]}
+        step["step_details"]["tool_calls"] = [call]
+        step["status"] = "completed"
+        self.send_event("thread.run.step.completed", step)
+
+        message = message_object(run["thread_id"], "assistant", [{"type": "image_file", "image_file": {"file_id": file_id, "detail": None}}], run["id"], run["assistant_id"])
+        self.send_event("thread.message.created", {**message, "content": [], "status": "in_progress"})
+        self.send_event("thread.message.delta", {"id": message["id"], "object": "thread.message.delta", "delta": {"content": [{"index": 0, **message["content"][0]}]}})
+        with self.state.lock:
+            self.state.threads[run["thread_id"]]["messages"].append(message)
+        self.send_event("thread.message.completed", message)
+
+    def stream_tool_calls(self, run: dict, cancelled: threading.Event) -> None:
+        turn = run["turn"]
+        calls = [
+            {"id": new_id("call"), "type": "function", "function": {"name": call["name"], "arguments": json.dumps(call["arguments"])}}
+            for call in turn.tool_calls
+        ]
+        step = step_object(run, "tool_calls", {"type": "tool_calls", "tool_calls": []})
+        self.send_event("thread.run.step.created", step)
+        for index, call in enumerate(calls):
+            first = {"index": index, "id": call["id"], "type": "function", "function": {"name": call["function"]["name"], "arguments": "", "output": None}}
+            self.send_event("thread.run.step.delta", {"id": step["id"], "object": "thread.run.step.delta", "delta": {"step_details": {"type": "tool_calls", "tool_calls": [first]}}})
+            arguments = call["function"]["arguments"]
+            # the arguments stream in chunks of about a token
+            for start in range(0, len(arguments), 4):
+                if cancelled.is_set():
+                    self.send_event("thread.run.cancelled", public(run))
+                    return
+                chunk = {"index": index, "type": "function", "function": {"arguments": arguments[start:start + 4]}}
+                self.send_event("thread.run.step.delta", {"id": step["id"], "object": "thread.run.step.delta", "delta": {"step_details": {"type": "tool_calls", "tool_calls": [chunk]}}})
+                time.sleep(1 / self.config.tokens_per_second)
+        run["status"] = "requires_action"
+        run["required_action"] = {"type": "submit_tool_outputs", "submit_tool_outputs": {"tool_calls": calls}}
+        self.send_event("thread.run.requires_action", public(run))
+
+    def complete(self, run: dict, completion_tokens: int) -> None:
+        run["status"] = "completed"
+        run["completed_at"] = int(time.time())
+        prompt_tokens = run["prompt_tokens"] + sum(count_tokens(output.get("output", "")) for output in run["turn"].tool_outputs)
+        run["usage"] = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    # files and chat completions
+
+    def file_content(self, file_id):
+        self.config.sleep(self.config.api_latency)
+        content = self.state.files[file_id]
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def chat_completions(self, deployment=None):
+        self.config.sleep(self.config.chat_latency)
+        question = ""
+        for message in self.body.get("messages", []):
+            if message.get("role") == "user":
+                content = message.get("content")
+                question = content if isinstance(content, str) else json.dumps(content)
+        # the question comes first, followed by "Give only the query in SQL format"
+        key = question.split("\n")[-2].strip() if "\n" in question else question.strip()
+        sql = self.config.queries.get(key.lower(), DEFAULT_SQL)
+        self.send_json({
+            "id": new_id("chatcmpl"),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment or self.body.get("model") or MODEL,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": f"```sql{sql}```"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": count_tokens(question), "completion_tokens": count_tokens(sql), "total_tokens": count_tokens(question) + count_tokens(sql)},
+        })
+
+
+def public(run: dict) -> dict:
+    """The run as the API returns it, without the bookkeeping of the stub."""
+    return {key: value for key, value in run.items() if key not in ("turn", "prompt_tokens", "ready_at")}
+
+
+def answer_text(turn: Turn, tokens: int) -> str:
+    words = []
+    for output in turn.tool_outputs:
+        words += ["according", "to", "the", "query", "result", output.get("output", "")[:60].replace(" ", "")]
+    while len(words) < tokens:
+        words.append(WORDS[len(words) % len(WORDS)])
+    return " ".join(words[:max(tokens, 1)])
+
+
+def load_queries(files: list) -> dict:
+    """question (lowercase) -> ground_truth_query of test set jsonl files."""
+    queries = {}
+    for file in files or []:
+        with open(file) as f:
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    queries[item["question"].strip().lower()] = item["ground_truth_query"]
+    return queries
+
+
+def start_stub_server(config: StubConfig = None, host: str = "127.0.0.1", port: int = 0):
+    """Serve the stub in a daemon thread, returns the server and its base url (port 0 picks a free port)."""
+    handler = type("Handler", (StubHandler,), {"config": config or StubConfig(), "state": State()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Azure OpenAI Assistants and chat completions APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tokens_per_second", type=float, default=50, help="streaming rate of answers and arguments")
+    parser.add_argument("--ttft", default="0.5", help="latency before the first event of a run stream")
+    parser.add_argument("--api_latency", default="0.02", help="latency of the non-streaming calls")
+    parser.add_argument("--chat_latency", default="0.8", help="latency of the chat completions (SQL generation)")
+    parser.add_argument("--script", help="JSON file with the turns of a thread, see the module comment")
+    parser.add_argument("--queries", nargs="*", help="jsonl files mapping questions to ground_truth_query")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="fraction of requests answered with --error_status")
+    parser.add_argument("--error_status", type=int, default=429)
+    parser.add_argument("--stall_rate", type=float, default=0.0, help="fraction of answer streams that stall half way")
+    parser.add_argument("--stall_seconds", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    script = None
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    config = StubConfig(
+        tokens_per_second=args.tokens_per_second,
+        ttft=args.ttft,
+        api_latency=args.api_latency,
+        chat_latency=args.chat_latency,
+        script=script,
+        queries=load_queries(args.queries),
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+        seed=args.seed,
+    )
+    server, url = start_stub_server(config, args.host, args.port)
+    print(f"stub server listening on {url}, set OPENAI_API_BASE={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
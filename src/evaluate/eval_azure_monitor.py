@@ -190,7 +190,10 @@ async def main(kql_file, timestamp_file, log_analytics_workspace, app_insights_c
 if __name__ == "__main__":
     import argparse
     from dotenv import load_dotenv
+    from sales_data_insights.cassette import install as install_cassette
     load_dotenv(override=True)
+    # record or replay the calls of the evaluator with OPENAI_CASSETTE
+    install_cassette()
 
     # dial down the logs for azure monitor -- it is so chatty
     azmon_logger = logging.getLogger('azure')
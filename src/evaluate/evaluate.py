@@ -6,9 +6,12 @@ import pandas as pd
 from pprint import pprint
 
 from promptflow.client import load_flow
+from sales_data_insights.cassette import install as install_cassette
 from sales_data_insights.main import SalesDataInsights
 
 load_dotenv(override=True)
+# record or replay the model calls of the flow and the evaluators with OPENAI_CASSETTE
+install_cassette()
 
 def extract_execution_time(execution_time: float):
     return {"seconds": execution_time}
@@ -4,9 +4,12 @@ from openai import AzureOpenAI
 import pandas as pd
 import os, json, time
 from sales_data_insights.system_message import system_message
+from sales_data_insights.cassette import install as install_cassette
 import tiktoken
 
 load_dotenv(override=True)
+# record or replay the calls with OPENAI_CASSETTE, see sales_data_insights/cassette.py
+install_cassette()
 
 
 def upload_input_file(file_client, batch_input):
@@ -39,8 +39,14 @@ def save_to_csv(df, filename="data/order_data.csv"):
 
 def save_to_sql(df, filename="data/order_data.db"):
     import sqlite3
+    from sales_data_insights.indexes import build_indexes
+    from sales_data_insights.rollups import build_rollups
     conn = sqlite3.connect(filename)
     df.to_sql("order_data", conn, if_exists="replace", index=False)
+    # secondary indexes chosen with index_advisor.py
+    build_indexes(conn)
+    # pre-aggregated tables that SalesDataInsights rewrites aggregate queries to
+    build_rollups(conn)
     conn.close()
     print(f"Data saved to {filename}")
 
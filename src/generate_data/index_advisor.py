@@ -0,0 +1,249 @@
+# this script proposes secondary indexes for the order_data database by replaying
+# the ground truth queries of the test/train sets:
+#   1. collects the columns each query filters on (equality and range) and groups by
+#   2. derives a composite (and optionally covering) index candidate per query
+#   3. keeps the candidates used by the most queries
+#   4. builds them on a copy of the database and prints before/after timings and plans
+# the chosen set goes into sales_data_insights/indexes.py, which generate.py builds.
+
+import json
+import os
+import pathlib
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+
+from sales_data_insights.indexes import build_indexes, index_name
+from sales_data_insights.rollups import MEASURES, available_rollups, rewrite_query
+from sales_data_insights.sql import tokenize, unquote
+
+_EQUALITY_OPS = {"=", "==", "in", "is"}
+_RANGE_OPS = {"<", "<=", ">", ">=", "between", "like"}
+_CLAUSE_END = {"group", "order", "having", "limit", "window", "union", "intersect", "except"}
+
+
+def load_queries(files):
+    queries = []
+    for file in files:
+        with open(file) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    queries.append(json.loads(line)["ground_truth_query"])
+    return queries
+
+
+def table_columns(connection, table):
+    return [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+
+
+def query_table(query):
+    """The table named after the first FROM, or None."""
+    tokens = tokenize(query)
+    for i, token in enumerate(tokens[:-1]):
+        if token.value.lower() == "from" and tokens[i + 1].kind in ("ident", "qident"):
+            return unquote(tokens[i + 1])
+    return None
+
+
+def analyze_query(query, columns):
+    """
+    Return (equality columns, range columns, group by columns, measures) for a query,
+    based on tokens. columns are the columns of the table the query reads from.
+    """
+    lookup = {column.lower(): column for column in columns}
+    measures = {measure.lower() for measure in MEASURES}
+    tokens = tokenize(query)
+    names = [unquote(token).lower() if token.kind in ("ident", "qident") else token.value.lower() for token in tokens]
+
+    equality, ranges, group_by, used_measures = [], [], [], []
+    clause = None
+    depth = 0
+    for i, name in enumerate(names):
+        if name == "(":
+            depth += 1
+        elif name == ")":
+            depth -= 1
+        if depth == 0 and name in ("where", "group", "having", "order"):
+            clause = name
+        elif depth == 0 and name in _CLAUSE_END:
+            clause = name
+
+        column = lookup.get(name)
+        if column is None or (i + 1 < len(names) and names[i + 1] == "("):
+            continue
+        if name in measures:
+            used_measures.append(column)
+
+        following = names[i + 1] if i + 1 < len(names) else ""
+        if following == "not" and i + 2 < len(names):
+            following = names[i + 2]
+        if clause == "where" and name not in measures:
+            if following in _EQUALITY_OPS and column not in equality:
+                equality.append(column)
+            elif following in _RANGE_OPS and column not in ranges:
+                ranges.append(column)
+        elif clause == "group" and column not in group_by:
+            group_by.append(column)
+
+    return equality, ranges, group_by, used_measures
+
+
+def candidate_index(analysis, cardinality, covering=False, max_columns=6):
+    """Equality columns (most selective first), then one range column, then group by columns."""
+    equality, ranges, group_by, used_measures = analysis
+    columns = sorted(equality, key=lambda column: -cardinality.get(column, 0))
+    if ranges:
+        columns.append(ranges[0])
+    columns += [column for column in group_by if column not in columns]
+    if not columns:
+        return None
+    if covering:
+        columns += [measure for measure in used_measures if measure not in columns]
+    return tuple(columns[:max_columns])
+
+
+def propose_indexes(queries, connection, max_indexes=5, covering=False):
+    cardinality = {}
+    candidates = Counter()
+    # the queries of a candidate that only filter on equality, their column order is free
+    equality_only = Counter()
+    for query in queries:
+        try:
+            table = query_table(query)
+            if table is None:
+                continue
+            columns = table_columns(connection, table)
+            if not columns:
+                continue
+            for column in columns:
+                if (table, column) not in cardinality:
+                    cardinality[(table, column)] = connection.execute(
+                        f'SELECT COUNT(DISTINCT "{column}") FROM "{table}"'
+                    ).fetchone()[0]
+            table_cardinality = {column: cardinality[(table, column)] for column in columns}
+            analysis = analyze_query(query, columns)
+            candidate = candidate_index(analysis, table_cardinality, covering)
+            if candidate is not None:
+                candidates[(table, candidate)] += 1
+                if len(analysis[0]) == len(candidate):
+                    equality_only[(table, candidate)] += 1
+        except Exception as e:
+            print("skipping query", repr(query), e)
+
+    # (Month, Year) and (Year, Month) serve the same equality-only queries: count those for
+    # the permutation the most other queries need
+    for (table, columns), count in list(equality_only.items()):
+        permutations = [
+            key for key in candidates if key[0] == table and sorted(key[1]) == sorted(columns)
+        ]
+        target = max(permutations, key=lambda key: candidates[key] - equality_only[key])
+        if target != (table, columns):
+            candidates[target] += count
+            equality_only[target] += count
+            candidates[(table, columns)] -= count
+            equality_only[(table, columns)] = 0
+    candidates = +candidates
+
+    # an index also serves every query that uses one of its prefixes
+    chosen = []
+    for (table, columns), count in candidates.most_common():
+        if any(t == table and c[:len(columns)] == columns for t, c in chosen):
+            continue
+        chosen = [(t, c) for t, c in chosen if not (t == table and columns[:len(c)] == c)]
+        chosen.append((table, columns))
+        print(f"candidate {index_name(table, list(columns))}: used by {count} queries")
+        if len(chosen) >= max_indexes:
+            break
+
+    proposal = {}
+    for table, columns in chosen:
+        proposal.setdefault(table, []).append(list(columns))
+    return proposal
+
+
+def time_queries(connection, queries, repeat):
+    results = []
+    for query in queries:
+        try:
+            plan = " | ".join(row[-1] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}"))
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                connection.execute(query).fetchall()
+                timings.append(time.perf_counter() - start)
+            results.append((min(timings), plan))
+        except Exception as e:
+            results.append((None, f"error: {e}"))
+    return results
+
+
+def main(db, files, max_indexes, covering, repeat, use_rollups):
+    queries = load_queries(files)
+    print(f"loaded {len(queries)} queries from {', '.join(files)}")
+    if use_rollups:
+        # replay the queries the way SalesDataInsights runs them
+        rollups = available_rollups(db)
+        queries = [rewrite_query(query, rollups) for query in queries]
+
+    with tempfile.TemporaryDirectory() as d:
+        # work on a copy so the advisor never changes the real database
+        copy = os.path.join(d, "order_data.db")
+        shutil.copyfile(db, copy)
+        connection = sqlite3.connect(copy)
+
+        proposal = propose_indexes(queries, connection, max_indexes=max_indexes, covering=covering)
+        before = time_queries(connection, queries, repeat)
+        build_indexes(connection, proposal)
+        after = time_queries(connection, queries, repeat)
+        connection.close()
+
+    total_before = total_after = 0
+    print("\n-----Per Query Timings (ms)-----")
+    for query, (t_before, plan_before), (t_after, plan_after) in zip(queries, before, after):
+        if t_before is None or t_after is None:
+            print(f"{'error':>10}  {' '.join(query.split())[:100]}")
+            continue
+        total_before += t_before
+        total_after += t_after
+        print(f"{t_before * 1000:>8.2f} -> {t_after * 1000:>8.2f}  {' '.join(query.split())[:100]}")
+        if plan_before != plan_after:
+            print(f"{'':>22}plan: {plan_before} -> {plan_after}")
+    print(f"\ntotal: {total_before * 1000:.2f}ms -> {total_after * 1000:.2f}ms")
+
+    print("\n-----Proposed Indexes (sales_data_insights/indexes.py)-----")
+    print("INDEXES = {")
+    for table, column_lists in proposal.items():
+        print(f"    {json.dumps(table)}: [")
+        for columns in column_lists:
+            print(f"        {json.dumps(columns)},")
+        print("    ],")
+    print("}")
+    return proposal
+
+
+if __name__ == "__main__":
+    import argparse
+
+    data_dir = os.path.join(pathlib.Path(__file__).parent.resolve())
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--db",
+        help="the order_data database",
+        default=os.path.join(data_dir, "..", "sales_data_insights", "data", "order_data.db"),
+    )
+    parser.add_argument(
+        "--queries",
+        nargs="+",
+        help="jsonl files with a ground_truth_query field",
+        default=[os.path.join(data_dir, "test_set_xxl.jsonl"), os.path.join(data_dir, "train_set_xxl.jsonl")],
+    )
+    parser.add_argument("--max_indexes", type=int, default=5, help="the number of indexes to propose")
+    parser.add_argument("--covering", action="store_true", help="add the aggregated measures to make covering indexes")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per query, the fastest run is reported")
+    parser.add_argument("--rollups", action="store_true", help="replay the queries rewritten to the rollup tables")
+    args = parser.parse_args()
+
+    main(args.db, args.queries, args.max_indexes, args.covering, args.repeat, args.rollups)
@@ -0,0 +1,198 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from .db import db_version, get_pool
+from .sql import canonicalize, strip_statement
+
+# Bounded LRU/TTL cache for query results, keyed by the canonical form of the SQL.
+# Entries remember the version of the database file they were read from and are
+# dropped as soon as the file changes.
+#
+# The cache can be tuned with environment variables:
+#   SDI_RESULT_CACHE              set to 0 to disable the cache (default 1)
+#   SDI_RESULT_CACHE_MAX_ENTRIES  max number of cached results (default 512)
+#   SDI_RESULT_CACHE_MAX_BYTES    approximate max memory used by results (default 64MB)
+#   SDI_RESULT_CACHE_TTL          seconds a result is kept (default 3600)
+#
+# Rows stream from the cursor to the encoder (see encoding.py) on a miss, and only results
+# with at most SDI_RESULT_MAX_ROWS rows (the encoding budget, default 200) are cached; larger
+# results are truncated by the encoder anyway and are not worth keeping.
+
+
+def _estimate_size(columns: list, rows: list) -> int:
+    size = sys.getsizeof(rows) + sum(sys.getsizeof(column) for column in columns)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+class _Entry:
+    __slots__ = ("sql", "version", "columns", "rows", "size", "expires")
+
+    def __init__(self, sql, version, columns, rows, size, expires):
+        self.sql = sql
+        self.version = version
+        self.columns = columns
+        self.rows = rows
+        self.size = size
+        self.expires = expires
+
+
+class QueryCache:
+    def __init__(self, max_entries: int = None, max_bytes: int = None, ttl: float = None, max_rows: int = None):
+        self.max_entries = max_entries or int(os.getenv("SDI_RESULT_CACHE_MAX_ENTRIES", "512"))
+        self.max_rows = max_rows if max_rows is not None else int(os.getenv("SDI_RESULT_MAX_ROWS", "200"))
+        self.max_bytes = max_bytes or int(os.getenv("SDI_RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.ttl = ttl or float(os.getenv("SDI_RESULT_CACHE_TTL", "3600"))
+
+        self._entries: OrderedDict[tuple, _Entry] = OrderedDict()
+        self._columns: dict[tuple, set] = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self.bytes,
+            )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._columns.clear()
+            self.bytes = 0
+
+    def _table_columns(self, path: str, version: tuple) -> set:
+        # column names decide which aliases may be normalized, see canonicalize
+        key = (path, version)
+        with self._lock:
+            columns = self._columns.get(key)
+        if columns is None:
+            # read outside the lock, the first of concurrent readers of a version fills the map
+            columns = set()
+            with get_pool(path).connection() as connection:
+                tables = connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"
+                ).fetchall()
+                for (table,) in tables:
+                    columns.update(
+                        row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')
+                    )
+            with self._lock:
+                if key in self._columns:
+                    return self._columns[key]
+                for stale in [k for k in self._columns if k[0] == path]:
+                    del self._columns[stale]
+                self._columns[key] = columns
+        return columns
+
+    def _remove(self, key: tuple) -> None:
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+
+    def fetch(self, path: str, query: str, execute: Callable, consume: Callable = None):
+        """
+        Return consume(columns, rows) for a query, calling execute(query, consume=...) on a
+        miss, so the rows stream from the cursor. Without consume, returns (columns, rows).
+        """
+        consume = consume or (lambda columns, rows: (columns, list(rows)))
+        path = os.path.realpath(path)
+        version = db_version(path)
+        key = (path, canonicalize(query, self._table_columns(path, version)))
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.version != version or entry.expires < now):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            columns = entry.columns
+            if strip_statement(query) != entry.sql:
+                # same query spelled differently, the column labels might differ
+                columns = column_names(path, query)
+            return consume(columns, entry.rows)
+
+        # keep the rows while they stream to consume, up to max_rows
+        kept = []
+        overflow = False
+
+        def keep(rows):
+            nonlocal overflow
+            for row in rows:
+                if not overflow:
+                    if len(kept) < self.max_rows:
+                        kept.append(tuple(row))
+                    else:
+                        overflow = True
+                        kept.clear()
+                yield row
+
+        result_columns = []
+
+        def consume_and_keep(columns, rows):
+            result_columns.extend(columns)
+            return consume(columns, keep(rows))
+
+        result = execute(query, consume=consume_and_keep)
+        if overflow:
+            return result
+        columns, rows = result_columns, kept
+        size = _estimate_size(columns, rows)
+        if size > self.max_bytes:
+            return result
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(
+                strip_statement(query), version, columns, rows, size, now + self.ttl
+            )
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+        logging.debug(f"query cache: {self.stats()}")
+        return result
+
+
+def column_names(path: str, query: str) -> list[str]:
+    """Column labels of a query, without running it."""
+    with get_pool(path).connection() as connection:
+        cursor = connection.execute(f"SELECT * FROM ({strip_statement(query)}) LIMIT 0")
+        return [column[0] for column in cursor.description]
+
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryCache:
+    """Return the process-wide result cache, or None when SDI_RESULT_CACHE=0."""
+    global _query_cache
+    if os.getenv("SDI_RESULT_CACHE", "1") == "0":
+        return None
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                _query_cache = QueryCache()
+    return _query_cache
@@ -0,0 +1,435 @@
+# enable type annotation syntax on Python versions earlier than 3.10
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import httpx
+
+# Record/replay of the HTTP exchanges with the model endpoints, so benchmarks of our own code
+# (stream handling, SQL execution, serialization) run offline without network noise:
+#   OPENAI_CASSETTE        cassette file, recording and replay are off when unset
+#   OPENAI_CASSETTE_MODE   "replay" (default) or "record" (appends to the cassette)
+#   OPENAI_CASSETTE_SPEED  replay speed, 1 keeps the recorded timing (default), 10 is ten
+#                          times faster and 0 replays without any delay
+#
+# Covers everything on httpx (AzureOpenAI and AsyncAzureOpenAI, including the clients that
+# promptflow builds for the evaluators) and the requests session of ChatCompletionsClient
+# (see clients.py). Responses keep their chunks and the delays between them, so SSE streams
+# replay with their original pacing. install() patches the httpx transports of the whole
+# process until uninstall(); use_cassette() scopes a cassette and the patch to a block.
+#
+# The cassette is a SQLite database with one row per exchange, indexed by method, path (the
+# host is not part of it, so recordings replay against any endpoint) and request body hash.
+# The response body is stored compressed; request headers, and so keys, are never stored.
+# Replay takes the recorded exchanges of a method and path in order, preferring one with the
+# same body (bodies with timings, like tool outputs, never match exactly), and starts over
+# when they are all used.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS exchanges (
+    id INTEGER PRIMARY KEY,
+    method TEXT NOT NULL,
+    path TEXT NOT NULL,
+    body_sha256 TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    -- seconds until the response headers
+    delay REAL NOT NULL,
+    -- [[seconds since the previous chunk, length], ...]
+    chunks TEXT NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS exchanges_key ON exchanges (method, path, body_sha256);
+"""
+
+# not replayed: the body is stored decoded and without its framing
+_SKIPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "set-cookie", "date"}
+
+
+class CassetteMiss(Exception):
+    """No recorded exchange for a request in replay mode."""
+
+
+def request_key(method: str, url: str, body: bytes) -> tuple:
+    parts = urlsplit(str(url))
+    query = urlencode(sorted(parse_qsl(parts.query)))
+    path = parts.path + (f"?{query}" if query else "")
+    try:
+        # the same JSON in another key order is the same request
+        body = json.dumps(json.loads(body), sort_keys=True).encode("utf-8")
+    except (ValueError, UnicodeDecodeError):
+        pass
+    return method.upper(), path, hashlib.sha256(body or b"").hexdigest()
+
+
+class Exchange:
+    def __init__(self, status: int, headers: list, delay: float, chunks: list):
+        self.status = status
+        self.headers = headers
+        self.delay = delay
+        # [(seconds since the previous chunk, bytes)]
+        self.chunks = chunks
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str = "replay", speed: float = 1.0):
+        if mode not in ("replay", "record"):
+            raise ValueError(f"Unknown cassette mode: {mode}, use 'replay' or 'record'")
+        if mode == "replay" and not os.path.exists(path):
+            raise FileNotFoundError(f"Cassette {path} not found, record it with OPENAI_CASSETTE_MODE=record")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.executescript(_SCHEMA)
+        # (method, path) -> [(id, body_sha256)] in recording order, and the ids replayed so far
+        self._index = {}
+        self._used = {}
+        for id, method, path, body_sha256 in self._connection.execute(
+            "SELECT id, method, path, body_sha256 FROM exchanges ORDER BY id"
+        ):
+            self._index.setdefault((method, path), []).append((id, body_sha256))
+        logging.info(f"Opened cassette {path} for {mode} with {sum(map(len, self._index.values()))} exchanges")
+
+    def record(self, key: tuple, exchange: Exchange) -> None:
+        body = b"".join(chunk for _, chunk in exchange.chunks)
+        chunks = [[round(delay, 4), len(chunk)] for delay, chunk in exchange.chunks]
+        headers = [[name, value] for name, value in exchange.headers if name.lower() not in _SKIPPED_HEADERS]
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO exchanges (method, path, body_sha256, status, headers, delay, chunks, body) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, exchange.status, json.dumps(headers), round(exchange.delay, 4), json.dumps(chunks), zlib.compress(body)),
+            )
+            self._connection.commit()
+
+    def take(self, key: tuple) -> Exchange:
+        method, path, body_sha256 = key
+        with self._lock:
+            candidates = self._index.get((method, path))
+            if not candidates:
+                raise CassetteMiss(f"No recorded exchange for {method} {path} in {self.path}")
+            used = self._used.setdefault((method, path), set())
+            if len(used) == len(candidates):
+                used.clear()
+            unused = [id for id, _ in candidates if id not in used]
+            id = next((id for id, sha in candidates if id not in used and sha == body_sha256), unused[0])
+            used.add(id)
+            status, headers, delay, chunks, body = self._connection.execute(
+                "SELECT status, headers, delay, chunks, body FROM exchanges WHERE id = ?", (id,)
+            ).fetchone()
+        body = zlib.decompress(body)
+        split, offset = [], 0
+        for chunk_delay, length in json.loads(chunks):
+            split.append((chunk_delay, body[offset:offset + length]))
+            offset += length
+        return Exchange(status, json.loads(headers), delay, split)
+
+    def wait(self, seconds: float) -> float:
+        """The replay delay for a recorded delay."""
+        return seconds / self.speed if self.speed > 0 else 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+# the cassette of use_cassette, it takes precedence over OPENAI_CASSETTE
+_scoped_cassette = None
+
+
+def get_cassette() -> Cassette | None:
+    """The cassette of use_cassette or OPENAI_CASSETTE, None when recording and replay are off."""
+    global _cassette
+    if _scoped_cassette is not None:
+        return _scoped_cassette
+    path = os.getenv("OPENAI_CASSETTE")
+    if not path:
+        return None
+    with _cassette_lock:
+        if _cassette is None or _cassette.path != path:
+            _cassette = Cassette(
+                path,
+                mode=os.getenv("OPENAI_CASSETTE_MODE", "replay").lower(),
+                speed=float(os.getenv("OPENAI_CASSETTE_SPEED", "1")),
+            )
+        return _cassette
+
+
+# httpx
+
+
+class _ReplayStream(httpx.SyncByteStream):
+    def __init__(self, cassette: Cassette, exchange: Exchange):
+        self.cassette = cassette
+        self.exchange = exchange
+
+    def __iter__(self):
+        for delay, chunk in self.exchange.chunks:
+            time.sleep(self.cassette.wait(delay))
+            yield chunk
+
+
+class _AsyncReplayStream(httpx.AsyncByteStream):
+    def __init__(self, cassette: Cassette, exchange: Exchange):
+        self.cassette = cassette
+        self.exchange = exchange
+
+    async def __aiter__(self):
+        for delay, chunk in self.exchange.chunks:
+            await asyncio.sleep(self.cassette.wait(delay))
+            yield chunk
+
+
+class _Recorder:
+    """Collects the chunks of a response, recorded when the response is closed."""
+
+    def __init__(self, cassette: Cassette, key: tuple, status: int, headers: list, delay: float):
+        self.cassette = cassette
+        self.key = key
+        self.exchange = Exchange(status, headers, delay, [])
+        self.last = time.monotonic()
+        self.saved = False
+
+    def chunk(self, chunk: bytes) -> None:
+        now = time.monotonic()
+        self.exchange.chunks.append((now - self.last, chunk))
+        self.last = now
+
+    def save(self) -> None:
+        if not self.saved:
+            self.saved = True
+            self.cassette.record(self.key, self.exchange)
+
+
+class _RecordingStream(httpx.SyncByteStream):
+    def __init__(self, stream, recorder: _Recorder):
+        self.stream = stream
+        self.recorder = recorder
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self.recorder.chunk(chunk)
+            yield chunk
+
+    def close(self):
+        self.recorder.save()
+        self.stream.close()
+
+
+class _AsyncRecordingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, recorder: _Recorder):
+        self.stream = stream
+        self.recorder = recorder
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            self.recorder.chunk(chunk)
+            yield chunk
+
+    async def aclose(self):
+        self.recorder.save()
+        await self.stream.aclose()
+
+
+_handle_request = httpx.HTTPTransport.handle_request
+_handle_async_request = httpx.AsyncHTTPTransport.handle_async_request
+
+
+def _cassette_handle_request(transport, request: httpx.Request) -> httpx.Response:
+    cassette = get_cassette()
+    if cassette is None:
+        return _handle_request(transport, request)
+    key = request_key(request.method, request.url, request.read())
+    if cassette.mode == "replay":
+        exchange = cassette.take(key)
+        time.sleep(cassette.wait(exchange.delay))
+        return httpx.Response(exchange.status, headers=exchange.headers, stream=_ReplayStream(cassette, exchange), request=request)
+    # record the body as it is read, without compression
+    request.headers["Accept-Encoding"] = "identity"
+    start = time.monotonic()
+    response = _handle_request(transport, request)
+    recorder = _Recorder(cassette, key, response.status_code, response.headers.multi_items(), time.monotonic() - start)
+    return httpx.Response(
+        response.status_code,
+        headers=response.headers,
+        stream=_RecordingStream(response.stream, recorder),
+        extensions=response.extensions,
+        request=request,
+    )
+
+
+async def _cassette_handle_async_request(transport, request: httpx.Request) -> httpx.Response:
+    cassette = get_cassette()
+    if cassette is None:
+        return await _handle_async_request(transport, request)
+    key = request_key(request.method, request.url, await request.aread())
+    if cassette.mode == "replay":
+        exchange = cassette.take(key)
+        await asyncio.sleep(cassette.wait(exchange.delay))
+        return httpx.Response(exchange.status, headers=exchange.headers, stream=_AsyncReplayStream(cassette, exchange), request=request)
+    request.headers["Accept-Encoding"] = "identity"
+    start = time.monotonic()
+    response = await _handle_async_request(transport, request)
+    recorder = _Recorder(cassette, key, response.status_code, response.headers.multi_items(), time.monotonic() - start)
+    return httpx.Response(
+        response.status_code,
+        headers=response.headers,
+        stream=_AsyncRecordingStream(response.stream, recorder),
+        extensions=response.extensions,
+        request=request,
+    )
+
+
+def install() -> bool:
+    """
+    Route the httpx transports of the process through the cassette of OPENAI_CASSETTE, also
+    for the clients built by libraries. A no-op without OPENAI_CASSETTE, returns whether it is on.
+    """
+    if get_cassette() is None:
+        return False
+    httpx.HTTPTransport.handle_request = _cassette_handle_request
+    httpx.AsyncHTTPTransport.handle_async_request = _cassette_handle_async_request
+    return True
+
+
+def uninstall() -> None:
+    """Give the httpx transports their own request handling back."""
+    httpx.HTTPTransport.handle_request = _handle_request
+    httpx.AsyncHTTPTransport.handle_async_request = _handle_async_request
+
+
+@contextmanager
+def use_cassette(path: str, mode: str = "replay", speed: float = 1.0):
+    """Record to or replay from a cassette inside the block only, yields the Cassette."""
+    global _scoped_cassette
+    if _scoped_cassette is not None:
+        raise RuntimeError(f"Cassette {_scoped_cassette.path} is already in use")
+    patched = httpx.HTTPTransport.handle_request is _cassette_handle_request
+    _scoped_cassette = cassette = Cassette(path, mode=mode, speed=speed)
+    try:
+        install()
+        yield cassette
+    finally:
+        _scoped_cassette = None
+        # an OPENAI_CASSETTE installed before the block stays on
+        if not patched:
+            uninstall()
+        cassette.close()
+
+
+# requests (azure-core RequestsTransport of ChatCompletionsClient)
+
+
+@lru_cache(maxsize=None)
+def _adapter_class():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    class ReplayRaw:
+        """The raw response read by requests, chunk by chunk with the recorded delays."""
+
+        def __init__(self, cassette: Cassette, chunks: list):
+            self.cassette = cassette
+            self.chunks = list(chunks)
+
+        def read(self, amt=None, decode_content=None):
+            if not self.chunks:
+                return b""
+            delay, chunk = self.chunks.pop(0)
+            time.sleep(self.cassette.wait(delay))
+            return chunk
+
+        def close(self):
+            pass
+
+    class RecordingRaw:
+        def __init__(self, raw, recorder: _Recorder):
+            self.raw = raw
+            self.recorder = recorder
+
+        def read(self, amt=None, decode_content=None):
+            chunk = self.raw.read(amt, decode_content=True)
+            if chunk:
+                self.recorder.chunk(chunk)
+            else:
+                self.recorder.save()
+            return chunk
+
+        def close(self):
+            self.recorder.save()
+            self.raw.close()
+
+        def release_conn(self):
+            self.raw.release_conn()
+
+    class CassetteAdapter(HTTPAdapter):
+        def __init__(self, cassette: Cassette, **kwargs):
+            super().__init__(**kwargs)
+            self.cassette = cassette
+
+        def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+            key = request_key(request.method, request.url, request.body.encode("utf-8") if isinstance(request.body, str) else request.body)
+            if self.cassette.mode == "replay":
+                exchange = self.cassette.take(key)
+                time.sleep(self.cassette.wait(exchange.delay))
+                response = requests.Response()
+                response.status_code = exchange.status
+                response.headers = CaseInsensitiveDict(exchange.headers)
+                response.encoding = get_encoding_from_headers(response.headers)
+                response.raw = ReplayRaw(self.cassette, exchange.chunks)
+                response.url = request.url
+                response.request = request
+                response.connection = self
+                return response
+            request.headers["Accept-Encoding"] = "identity"
+            start = time.monotonic()
+            response = super().send(request, stream=True, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+            recorder = _Recorder(self.cassette, key, response.status_code, list(response.headers.items()), time.monotonic() - start)
+            response.raw = RecordingRaw(response.raw, recorder)
+            return response
+
+    return CassetteAdapter
+
+
+def requests_adapter(cassette: Cassette, **kwargs):
+    """A requests adapter recording to or replaying from the cassette, kwargs go to HTTPAdapter."""
+    return _adapter_class()(cassette, **kwargs)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summary of a cassette")
+    parser.add_argument("cassette")
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.cassette)
+    # (method, path) -> [exchanges, chunks, bytes, stored bytes, seconds]
+    summary = {}
+    for method, path, delay, chunks, stored in connection.execute(
+        "SELECT method, path, delay, chunks, LENGTH(body) FROM exchanges"
+    ):
+        chunks = json.loads(chunks)
+        totals = summary.setdefault((method, path), [0, 0, 0, 0, 0.0])
+        for index, value in enumerate((1, len(chunks), sum(length for _, length in chunks), stored, delay + sum(d for d, _ in chunks))):
+            totals[index] += value
+    print(f"{'exchanges':>9} {'chunks':>7} {'bytes':>10} {'stored':>10} {'seconds':>8}  request")
+    for (method, path), (count, chunks, size, stored, seconds) in sorted(summary.items(), key=lambda item: -item[1][0]):
+        print(f"{count:>9} {chunks:>7} {size:>10} {stored:>10} {seconds / count:>8.3f}  {method} {path}")
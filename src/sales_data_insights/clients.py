@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import inspect
+import logging
+import os
+import threading
+import weakref
+
+import httpx
+from openai import AsyncAzureOpenAI, AzureOpenAI
+
+from .cassette import get_cassette, install, requests_adapter
+
+# Process-wide registry of model clients. Building a client per call means a new
+# connection pool (and TLS handshake) per turn, so clients are created once per
+# endpoint and shared across sessions and the worker threads of AssistantAPI.
+#
+# Pool settings can be tuned with environment variables:
+#   CLIENT_POOL_MAX_CONNECTIONS   max open connections per client (default 100)
+#   CLIENT_POOL_MAX_KEEPALIVE     max idle keep-alive connections per client (default 20)
+#   CLIENT_POOL_KEEPALIVE_EXPIRY  seconds an idle connection is kept open (default 30)
+#
+# With OPENAI_CASSETTE set, the clients record to or replay from a cassette, see cassette.py.
+
+_lock = threading.Lock()
+_clients: dict = {}
+# async clients per event loop; the connections of a client refer to its loop, so the
+# clients of a closed loop are also dropped when the next async client is looked up
+_loop_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _pool_settings() -> dict:
+    return dict(
+        max_connections=int(os.getenv("CLIENT_POOL_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("CLIENT_POOL_MAX_KEEPALIVE", "20")),
+        keepalive_expiry=float(os.getenv("CLIENT_POOL_KEEPALIVE_EXPIRY", "30")),
+    )
+
+
+def _key_digest(key: str) -> str:
+    # never keep the raw key in the registry key, but still pick up rotated keys
+    return hashlib.sha256((key or "").encode("utf-8")).hexdigest()[:16]
+
+
+def _get_or_create(registry_key: tuple, factory: callable, clients: dict = None):
+    clients = _clients if clients is None else clients
+    client = clients.get(registry_key)
+    if client is not None:
+        return client
+    with _lock:
+        client = clients.get(registry_key)
+        if client is None:
+            # the httpx clients go through the cassette, if any
+            install()
+            client = factory()
+            clients[registry_key] = client
+        return client
+
+
+def _clients_of_loop(loop: asyncio.AbstractEventLoop) -> dict:
+    with _lock:
+        for closed in [other for other in _loop_clients.keys() if other.is_closed()]:
+            del _loop_clients[closed]
+        return _loop_clients.setdefault(loop, {})
+
+
+def get_azure_openai_client(
+    azure_endpoint: str = None,
+    api_key: str = None,
+    api_version: str = None,
+) -> AzureOpenAI:
+    """
+    Return the shared AzureOpenAI client for an endpoint. Defaults are read from
+    OPENAI_API_BASE, OPENAI_API_KEY and OPENAI_API_VERSION.
+    """
+    azure_endpoint = azure_endpoint or os.getenv("OPENAI_API_BASE")
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    api_version = api_version or os.getenv("OPENAI_API_VERSION")
+
+    def factory():
+        settings = _pool_settings()
+        logging.info(f"Creating pooled AzureOpenAI client for {azure_endpoint} ({settings})")
+        return AzureOpenAI(
+            azure_endpoint=azure_endpoint,
+            api_key=api_key,
+            api_version=api_version,
+            http_client=httpx.Client(limits=httpx.Limits(**settings)),
+        )
+
+    return _get_or_create(
+        ("azure_openai", azure_endpoint, api_version, _key_digest(api_key)), factory
+    )
+
+
+def get_async_azure_openai_client(
+    azure_endpoint: str = None,
+    api_key: str = None,
+    api_version: str = None,
+) -> AsyncAzureOpenAI:
+    """
+    Return the shared AsyncAzureOpenAI client for an endpoint, see get_azure_openai_client.
+    Async connections belong to an event loop, so there is one client per running loop.
+    """
+    azure_endpoint = azure_endpoint or os.getenv("OPENAI_API_BASE")
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    api_version = api_version or os.getenv("OPENAI_API_VERSION")
+    try:
+        clients = _clients_of_loop(asyncio.get_running_loop())
+    except RuntimeError:
+        clients = None
+
+    def factory():
+        settings = _pool_settings()
+        logging.info(f"Creating pooled AsyncAzureOpenAI client for {azure_endpoint} ({settings})")
+        return AsyncAzureOpenAI(
+            azure_endpoint=azure_endpoint,
+            api_key=api_key,
+            api_version=api_version,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(**settings)),
+        )
+
+    return _get_or_create(
+        ("async_azure_openai", azure_endpoint, api_version, _key_digest(api_key)), factory, clients
+    )
+
+
+def get_chat_completions_client(model_type: str):
+    """
+    Return the shared azure-ai-inference ChatCompletionsClient for a model type.
+    The endpoint and key are read from AZUREAI_<MODEL_TYPE>_URL and AZUREAI_<MODEL_TYPE>_KEY.
+    """
+    from azure.ai.inference import ChatCompletionsClient
+    from azure.core.credentials import AzureKeyCredential
+    from azure.core.pipeline.transport import RequestsTransport
+    import requests
+
+    endpoint = os.getenv(f"AZUREAI_{model_type.upper()}_URL")
+    key = os.getenv(f"AZUREAI_{model_type.upper()}_KEY")
+
+    def factory():
+        settings = _pool_settings()
+        logging.info(f"Creating pooled ChatCompletionsClient for {model_type} at {endpoint}")
+        # requests keeps connections alive by default, we only need to size the pool
+        session = requests.Session()
+        cassette = get_cassette()
+        if cassette is not None:
+            adapter = requests_adapter(cassette, pool_connections=1, pool_maxsize=settings["max_connections"])
+        else:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=settings["max_connections"]
+            )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return ChatCompletionsClient(
+            endpoint=endpoint,
+            credential=AzureKeyCredential(key),
+            transport=RequestsTransport(session=session, session_owner=False),
+        )
+
+    return _get_or_create(
+        ("azure_ai_inference", model_type.lower(), endpoint, _key_digest(key)), factory
+    )
+
+
+def close_clients() -> None:
+    """Close all pooled sync clients, e.g. on shutdown or in tests. Use aclose_clients for async ones."""
+    with _lock:
+        clients = {
+            key: client for key, client in _clients.items() if not inspect.iscoroutinefunction(client.close)
+        }
+        for key in clients:
+            del _clients[key]
+    for client in clients.values():
+        try:
+            client.close()
+        except Exception as e:
+            logging.warning(f"Failed to close client {client}: {e}")
+
+
+async def aclose_clients() -> None:
+    """Close all pooled clients and the async ones of the running loop, awaiting those."""
+    with _lock:
+        clients = list(_clients.values()) + list(_loop_clients.pop(asyncio.get_running_loop(), {}).values())
+        _clients.clear()
+    for client in clients:
+        try:
+            result = client.close()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logging.warning(f"Failed to close client {client}: {e}")
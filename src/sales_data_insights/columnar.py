@@ -0,0 +1,636 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from .db import db_version, get_pool
+from .sql import Token, strip_statement, tokenize, unquote
+
+# In-memory columnar engine for the queries the system message asks for: aggregates
+# (SUM/TOTAL/COUNT/AVG/MIN/MAX and arithmetic on them) over order_data with simple
+# AND-ed filters, GROUP BY, ORDER BY and LIMIT. order_data is exported once per
+# database version to .npy files next to the database and memory mapped; text
+# columns are dictionary encoded with sorted dictionaries, so codes sort like values.
+#
+# Anything outside that subset raises Unsupported and the caller falls back to SQLite.
+
+TABLE = "order_data"
+
+
+class Unsupported(Exception):
+    pass
+
+
+class ColumnarTable:
+    def __init__(self, path: str):
+        self.path = path
+        self.columns: dict[str, np.ndarray] = {}
+        self.dictionaries: dict[str, list] = {}
+        self.names: dict[str, str] = {}
+        self.rows = 0
+        self._bounds: dict[str, tuple] = {}
+        self._load()
+
+    def _cache_dir(self) -> str:
+        version = hashlib.sha1(repr(db_version(self.path)).encode()).hexdigest()[:16]
+        return os.path.join(os.path.dirname(self.path), ".columnar", f"{os.path.basename(self.path)}-{version}")
+
+    def _export(self, directory: str) -> None:
+        logging.info(f"exporting {TABLE} to {directory}")
+        os.makedirs(directory, exist_ok=True)
+        schema = {}
+        with get_pool(self.path).connection() as connection:
+            for _, name, declared_type, *_ in connection.execute(f'PRAGMA table_info("{TABLE}")').fetchall():
+                values = [row[0] for row in connection.execute(f'SELECT "{name}" FROM "{TABLE}" ORDER BY rowid')]
+                if any(value is None for value in values):
+                    # NULLs are not modelled, queries on this column go to SQLite
+                    continue
+                if all(isinstance(value, int) for value in values):
+                    array, dictionary = np.array(values, dtype=np.int64), None
+                elif all(isinstance(value, (int, float)) for value in values):
+                    array, dictionary = np.array(values, dtype=np.float64), None
+                elif all(isinstance(value, str) for value in values):
+                    dictionary, codes = np.unique(np.array(values, dtype=object).astype(str), return_inverse=True)
+                    array, dictionary = codes.astype(np.int32), dictionary.tolist()
+                else:
+                    continue
+                np.save(os.path.join(directory, f"{name}.npy"), array)
+                schema[name] = dictionary
+        # written last, its presence marks a complete export
+        with open(os.path.join(directory, "schema.json"), "w") as f:
+            json.dump(schema, f)
+
+        # exports of older versions of the database are no longer used
+        parent, prefix = os.path.dirname(directory), f"{os.path.basename(self.path)}-"
+        for name in os.listdir(parent):
+            if name.startswith(prefix) and os.path.join(parent, name) != directory:
+                shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+    def _load(self) -> None:
+        directory = self._cache_dir()
+        if not os.path.exists(os.path.join(directory, "schema.json")):
+            self._export(directory)
+        with open(os.path.join(directory, "schema.json")) as f:
+            schema = json.load(f)
+        for name, dictionary in schema.items():
+            self.columns[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            self.names[name.lower()] = name
+            if dictionary is not None:
+                self.dictionaries[name] = dictionary
+            self.rows = len(self.columns[name])
+
+    def column(self, name: str) -> str:
+        column = self.names.get(name.lower())
+        if column is None:
+            raise Unsupported(f"unknown column {name}")
+        return column
+
+    def bounds(self, column: str) -> tuple:
+        """(min, max) of an integer or dictionary encoded column."""
+        bounds = self._bounds.get(column)
+        if bounds is None:
+            values = np.asarray(self.columns[column])
+            bounds = self._bounds[column] = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+        return bounds
+
+
+# --- parsing ---------------------------------------------------------------------
+
+_AGGREGATES = {"sum", "total", "count", "avg", "min", "max"}
+_COMPARISONS = {"=", "==", "!=", "<>", "<", "<=", ">", ">="}
+_CLAUSES = {"from", "where", "group", "order", "limit", "having", "union", "window", "offset"}
+
+
+class _Parser:
+    def __init__(self, query: str, columns: set = frozenset()):
+        self.query = strip_statement(query)
+        self.columns = columns
+        self.tokens = tokenize(self.query)
+        self.i = 0
+
+    def peek(self, offset: int = 0) -> Token:
+        i = self.i + offset
+        return self.tokens[i] if i < len(self.tokens) else None
+
+    def word(self, offset: int = 0) -> str:
+        token = self.peek(offset)
+        if token is None:
+            return None
+        return unquote(token).lower() if token.kind in ("ident", "qident") else token.value.lower()
+
+    def accept(self, *words: str) -> bool:
+        if self.word() in words:
+            self.i += 1
+            return True
+        return False
+
+    def expect(self, word: str) -> None:
+        if not self.accept(word):
+            raise Unsupported(f"expected {word} at {self.word()}")
+
+    def identifier(self) -> str:
+        token = self.peek()
+        if token is None or token.kind not in ("ident", "qident"):
+            raise Unsupported(f"expected identifier at {self.word()}")
+        self.i += 1
+        # allow table qualified columns
+        if self.word() == "." and self.peek(1) is not None:
+            if unquote(token).lower() != TABLE:
+                raise Unsupported("unknown table qualifier")
+            self.i += 1
+            return self.identifier()
+        return unquote(token)
+
+    def literal(self):
+        negative = self.accept("-")
+        token = self.peek()
+        if token is None:
+            raise Unsupported("expected literal")
+        self.i += 1
+        if token.kind == "number":
+            value = float(token.value) if any(c in token.value for c in ".eE") else int(token.value)
+            return -value if negative else value
+        if token.kind == "string" and not negative:
+            return token.value[1:-1].replace("''", "'")
+        if token.kind == "qident" and token.value[0] == '"' and not negative:
+            # SQLite reads a double quoted name that is not a column as a string
+            if unquote(token).lower() in self.columns:
+                raise Unsupported(f"comparing columns {token.value}")
+            return unquote(token)
+        raise Unsupported(f"unsupported literal {token.value}")
+
+    # expressions are tuples: ("num", value) | ("col", name) | ("agg", fn, column) | ("op", op, left, right)
+    def expression(self):
+        node = self.term()
+        while self.word() in ("+", "-"):
+            op = self.word()
+            self.i += 1
+            node = ("op", op, node, self.term())
+        return node
+
+    def term(self):
+        node = self.factor()
+        while self.word() in ("*", "/"):
+            op = self.word()
+            self.i += 1
+            node = ("op", op, node, self.factor())
+        return node
+
+    def factor(self):
+        token = self.peek()
+        if token is None:
+            raise Unsupported("unexpected end of query")
+        if token.kind == "number":
+            return ("num", self.literal())
+        if self.word() == "(":
+            self.i += 1
+            node = self.expression()
+            self.expect(")")
+            return node
+        if token.kind == "ident" and self.word() in _AGGREGATES and self.word(1) == "(":
+            function = self.word()
+            self.i += 2
+            if function == "count" and self.accept("*"):
+                column = None
+            else:
+                if self.word() == "distinct":
+                    raise Unsupported("aggregate over DISTINCT")
+                column = self.identifier()
+            self.expect(")")
+            return ("agg", function, column)
+        if token.kind in ("ident", "qident") and self.word(1) != "(":
+            return ("col", self.identifier())
+        raise Unsupported(f"unsupported expression at {token.value}")
+
+    def select_item(self):
+        start = self.peek().start
+        node = self.expression()
+        end = self.tokens[self.i - 1].end
+        alias = None
+        if self.accept("as"):
+            alias = unquote(self.peek())
+            self.i += 1
+        elif self.peek() is not None and self.peek().kind in ("ident", "qident") and self.word() not in _CLAUSES:
+            alias = unquote(self.peek())
+            self.i += 1
+        if alias is None and node[0] != "col":
+            # SQLite labels expressions with their text, bare columns are labelled in execute
+            alias = self.query[start:end]
+        return node, alias, self.query[start:end]
+
+    def predicate(self):
+        if self.accept("("):
+            predicates = self.condition()
+            self.expect(")")
+            return predicates
+        column = self.identifier()
+        negate = self.accept("not")
+        if self.accept("in"):
+            self.expect("(")
+            values = [self.literal()]
+            while self.accept(","):
+                values.append(self.literal())
+            self.expect(")")
+            return [("in", column, values, negate)]
+        if self.accept("between"):
+            low = self.literal()
+            self.expect("and")
+            high = self.literal()
+            return [("between", column, (low, high), negate)]
+        if negate:
+            raise Unsupported("NOT without IN/BETWEEN")
+        op = self.word()
+        if op not in _COMPARISONS:
+            raise Unsupported(f"unsupported operator {op}")
+        self.i += 1
+        return [("cmp", column, (op, self.literal()), False)]
+
+    def condition(self):
+        predicates = self.predicate()
+        while self.accept("and"):
+            predicates += self.predicate()
+        if self.word() == "or":
+            raise Unsupported("OR")
+        return predicates
+
+    def parse(self) -> dict:
+        self.expect("select")
+        distinct = self.accept("distinct")
+        items = [self.select_item()]
+        while self.accept(","):
+            items.append(self.select_item())
+
+        self.expect("from")
+        if self.identifier().lower() != TABLE:
+            raise Unsupported("only order_data is supported")
+
+        where, group_by, order_by, limit, offset = [], [], [], None, 0
+        if self.accept("where"):
+            where = self.condition()
+        if self.accept("group"):
+            self.expect("by")
+            group_by.append(self.group_key())
+            while self.accept(","):
+                group_by.append(self.group_key())
+        if self.accept("order"):
+            self.expect("by")
+            order_by.append(self.order_key())
+            while self.accept(","):
+                order_by.append(self.order_key())
+        if self.accept("limit"):
+            limit = self.literal()
+            if self.accept("offset"):
+                offset = self.literal()
+        if self.peek() is not None:
+            raise Unsupported(f"unsupported clause {self.word()}")
+        return dict(distinct=distinct, items=items, where=where, group_by=group_by,
+                    order_by=order_by, limit=limit, offset=offset)
+
+    def group_key(self):
+        token = self.peek()
+        if token is not None and token.kind == "number":
+            return ("position", self.literal())
+        return ("name", self.identifier())
+
+    def order_key(self):
+        token = self.peek()
+        if token is not None and token.kind == "number":
+            key = ("position", self.literal())
+        else:
+            start = token.start if token is not None else 0
+            node = self.expression()
+            key = ("expression", node, self.query[start:self.tokens[self.i - 1].end])
+        descending = False
+        if self.accept("desc"):
+            descending = True
+        else:
+            self.accept("asc")
+        return key, descending
+
+
+# --- execution -------------------------------------------------------------------
+
+
+class _Value:
+    """A column of results with SQLite typing: integer or real, and a NULL mask."""
+
+    def __init__(self, values: np.ndarray, integer: bool, null: np.ndarray = None):
+        self.values = values
+        self.integer = integer
+        self.null = null if null is not None else np.zeros(len(values), dtype=bool)
+
+
+def _arith(op: str, left: _Value, right: _Value) -> _Value:
+    null = left.null | right.null
+    integer = left.integer and right.integer
+    a, b = left.values, right.values
+    if op == "/":
+        zero = b == 0
+        null = null | zero
+        safe = np.where(zero, 1, b)
+        if integer:
+            # SQLite integer division truncates toward zero
+            quotient = np.abs(a) // np.abs(safe)
+            values = np.where((a < 0) != (safe < 0), -quotient, quotient)
+        else:
+            values = a.astype(np.float64) / safe
+    elif op == "*":
+        values = a * b
+    elif op == "+":
+        values = a + b
+    else:
+        values = a - b
+    if not integer:
+        values = values.astype(np.float64)
+    return _Value(values, integer, null)
+
+
+class _Groups:
+    def __init__(self, table: ColumnarTable, rows: np.ndarray, keys: list[str]):
+        self.table = table
+        self.rows = rows
+        if keys:
+            codes = [np.asarray(table.columns[key])[rows] for key in keys]
+            packed = self._pack(table, keys, codes)
+            if not len(rows):
+                self.inverse = np.empty(0, dtype=np.int64)
+                self.keys = {key: np.empty(0, dtype=code.dtype) for key, code in zip(keys, codes)}
+            elif packed is not None:
+                # one int64 per row, a 1-D unique is much faster than a row-wise one
+                unique, inverse = np.unique(packed[0], return_inverse=True)
+                self.inverse = inverse.reshape(-1)
+                self.keys = {
+                    key: (index + low).astype(code.dtype)
+                    for key, code, low, index in zip(keys, codes, packed[1], np.unravel_index(unique, packed[2]))
+                }
+            else:
+                # group on the positions of each key in its own sorted uniques: stacking the
+                # keys themselves would turn dictionary codes into floats next to a float key
+                uniques, positions = zip(*(np.unique(code, return_inverse=True) for code in codes))
+                stacked = np.stack([position.reshape(-1) for position in positions], axis=1)
+                unique, inverse = np.unique(stacked, axis=0, return_inverse=True)
+                self.inverse = inverse.reshape(-1)
+                self.keys = {key: values[unique[:, i]] for i, (key, values) in enumerate(zip(keys, uniques))}
+            self.count = len(next(iter(self.keys.values())))
+        else:
+            # aggregates over the whole selection are one group, even if it is empty
+            self.inverse = np.zeros(len(rows), dtype=np.int64)
+            self.keys = {}
+            self.count = 1
+        # stable order keeps the scan order inside each group, like SQLite
+        self.order = np.argsort(self.inverse, kind="stable")
+        self.sizes = np.bincount(self.inverse, minlength=self.count)
+        self.starts = np.concatenate(([0], np.cumsum(self.sizes)[:-1])).astype(np.int64)
+
+    @staticmethod
+    def _pack(table: ColumnarTable, keys: list[str], codes: list[np.ndarray]):
+        """Pack integer group keys into one int64 per row, or None if they do not fit."""
+        if any(code.dtype.kind not in "iu" for code in codes):
+            return None
+        lows, shape = [], []
+        for key in keys:
+            low, high = table.bounds(key)
+            lows.append(low)
+            shape.append(high - low + 1)
+        if np.prod([float(size) for size in shape]) >= 2 ** 62:
+            return None
+        offsets = [code.astype(np.int64) - low for code, low in zip(codes, lows)]
+        return np.ravel_multi_index(offsets, shape), lows, tuple(shape)
+
+    def reduce(self, ufunc, values: np.ndarray) -> np.ndarray:
+        present = self.sizes > 0
+        result = np.zeros(self.count, dtype=values.dtype)
+        if present.any():
+            ordered = values[self.rows][self.order]
+            result[present] = ufunc.reduceat(ordered, self.starts[present])
+        return result
+
+    def aggregate(self, function: str, column: str) -> _Value:
+        empty = self.sizes == 0
+        if function == "count":
+            return _Value(self.sizes.astype(np.int64), True)
+        if column in self.table.dictionaries:
+            raise Unsupported(f"{function} over a text column")
+        values = np.asarray(self.table.columns[column])
+        integer = values.dtype.kind == "i"
+        if function in ("sum", "total"):
+            result = self.reduce(np.add, values)
+            if function == "total":
+                return _Value(result.astype(np.float64), False)
+            return _Value(result, integer, empty)
+        if function == "avg":
+            total = self.reduce(np.add, values).astype(np.float64)
+            return _Value(total / np.maximum(self.sizes, 1), False, empty)
+        ufunc = np.minimum if function == "min" else np.maximum
+        return _Value(self.reduce(ufunc, values), integer, empty)
+
+
+def _column_value(table: ColumnarTable, groups: _Groups, column: str) -> _Value:
+    if column not in groups.keys:
+        raise Unsupported(f"{column} is neither grouped nor aggregated")
+    values = groups.keys[column]
+    if column in table.dictionaries:
+        return _Value(values, False)
+    return _Value(values, np.asarray(table.columns[column]).dtype.kind == "i")
+
+
+def _evaluate(node, table: ColumnarTable, groups: _Groups) -> _Value:
+    kind = node[0]
+    if kind == "num":
+        return _Value(np.full(groups.count, node[1]), isinstance(node[1], int))
+    if kind == "col":
+        return _column_value(table, groups, table.column(node[1]))
+    if kind == "agg":
+        return groups.aggregate(node[1], table.column(node[2]) if node[2] else None)
+    left = _evaluate(node[2], table, groups)
+    right = _evaluate(node[3], table, groups)
+    if node[2][0] == "col" and table.column(node[2][1]) in table.dictionaries:
+        raise Unsupported("arithmetic on text")
+    if node[3][0] == "col" and table.column(node[3][1]) in table.dictionaries:
+        raise Unsupported("arithmetic on text")
+    return _arith(node[1], left, right)
+
+
+def _compare(op: str, a, b):
+    if op in ("=", "=="):
+        return a == b
+    if op in ("!=", "<>"):
+        return a != b
+    if op == "<":
+        return a < b
+    if op == "<=":
+        return a <= b
+    if op == ">":
+        return a > b
+    return a >= b
+
+
+def _filter(table: ColumnarTable, predicates: list) -> np.ndarray:
+    mask = np.ones(table.rows, dtype=bool)
+    for kind, name, argument, negate in predicates:
+        column = table.column(name)
+        values = np.asarray(table.columns[column])
+        dictionary = table.dictionaries.get(column)
+        if dictionary is not None:
+            # evaluate the predicate once per dictionary entry, then look up by code
+            def test(value):
+                if kind == "in":
+                    return value in [str(v) for v in argument]
+                if kind == "between":
+                    return str(argument[0]) <= value <= str(argument[1])
+                return _compare(argument[0], value, str(argument[1]))
+            lookup = np.array([test(value) for value in dictionary], dtype=bool)
+            selected = lookup[values] if len(lookup) else np.zeros(table.rows, dtype=bool)
+        else:
+            def number(value):
+                if isinstance(value, str):
+                    try:
+                        return float(value) if any(c in value for c in ".eE") else int(value)
+                    except ValueError:
+                        raise Unsupported(f"comparing a number column with {value!r}")
+                return value
+            if kind == "in":
+                selected = np.isin(values, [number(v) for v in argument])
+            elif kind == "between":
+                selected = (values >= number(argument[0])) & (values <= number(argument[1]))
+            else:
+                selected = _compare(argument[0], values, number(argument[1]))
+        mask &= ~selected if negate else selected
+    return np.flatnonzero(mask)
+
+
+def _python(value: _Value, table: ColumnarTable, column: str = None) -> list:
+    dictionary = table.dictionaries.get(column) if column else None
+    result = []
+    for v, null in zip(value.values.tolist(), value.null.tolist()):
+        if null:
+            result.append(None)
+        elif dictionary is not None:
+            result.append(dictionary[v])
+        elif value.integer:
+            result.append(int(v))
+        else:
+            result.append(float(v))
+    return result
+
+
+def execute(table: ColumnarTable, query: str) -> tuple[list, list]:
+    """Run a query on the columnar table, returns (columns, rows) or raises Unsupported."""
+    plan = _Parser(query, set(table.names)).parse()
+    # bare columns are labelled with their declared name, like SQLite does
+    items = [
+        (node, alias if alias is not None else table.column(node[1]), text)
+        for node, alias, text in plan["items"]
+    ]
+
+    aggregated = any(_has_aggregate(node) for node, _, _ in items)
+    group_by = []
+    for kind, key in plan["group_by"]:
+        if kind == "position":
+            if not 1 <= key <= len(items) or items[key - 1][0][0] != "col":
+                raise Unsupported("GROUP BY position must point to a column")
+            key = items[key - 1][0][1]
+        elif not any(node == ("col", key) for node, _, _ in items) and key.lower() not in table.names:
+            # GROUP BY an alias
+            matches = [node for node, alias, _ in items if alias.lower() == key.lower()]
+            if len(matches) != 1 or matches[0][0] != "col":
+                raise Unsupported(f"GROUP BY {key}")
+            key = matches[0][1]
+        group_by.append(table.column(key))
+
+    if not aggregated and not group_by:
+        if not plan["distinct"] or any(node[0] != "col" for node, _, _ in items):
+            raise Unsupported("only aggregates or SELECT DISTINCT columns are supported")
+        group_by = [table.column(node[1]) for node, _, _ in items]
+    elif plan["distinct"] and not group_by:
+        raise Unsupported("DISTINCT with aggregates")
+
+    rows = _filter(table, plan["where"])
+    groups = _Groups(table, rows, group_by)
+    if not group_by and not aggregated:
+        raise Unsupported("nothing to aggregate")
+
+    columns = [alias for _, alias, _ in items]
+    values = [_evaluate(node, table, groups) for node, _, _ in items]
+    python_values = [
+        _python(value, table, table.column(node[1]) if node[0] == "col" else None)
+        for value, (node, _, _) in zip(values, items)
+    ]
+    result = list(zip(*python_values)) if python_values else []
+    if plan["distinct"]:
+        seen, unique = set(), []
+        for row in result:
+            if row not in seen:
+                seen.add(row)
+                unique.append(row)
+        result = unique
+
+    if plan["order_by"]:
+        result = _order(result, plan["order_by"], items)
+
+    offset = plan["offset"] or 0
+    if plan["limit"] is not None and plan["limit"] >= 0:
+        result = result[offset:offset + plan["limit"]]
+    elif offset:
+        result = result[offset:]
+    return columns, result
+
+
+def _has_aggregate(node) -> bool:
+    if node[0] == "agg":
+        return True
+    if node[0] == "op":
+        return _has_aggregate(node[2]) or _has_aggregate(node[3])
+    return False
+
+
+def _order(result: list, order_by: list, items: list) -> list:
+    positions = []
+    for key, descending in order_by:
+        if key[0] == "position":
+            position = key[1] - 1
+        else:
+            node, text = key[1], key[2]
+            position = next(
+                (i for i, (item_node, alias, item_text) in enumerate(items)
+                 if item_node == node or (node[0] == "col" and alias.lower() == node[1].lower())
+                 or item_text.replace(" ", "").lower() == text.replace(" ", "").lower()),
+                None,
+            )
+        if position is None or not 0 <= position < len(items):
+            raise Unsupported("ORDER BY must refer to a selected column")
+        positions.append((position, descending))
+
+    # SQLite sorts NULLs first, numbers before text; apply keys from last to first
+    for position, descending in reversed(positions):
+        result.sort(
+            key=lambda row: (
+                row[position] is not None,
+                isinstance(row[position], str),
+                row[position] if row[position] is not None else 0,
+            ),
+            reverse=descending,
+        )
+    return result
+
+
+_tables: dict[str, tuple] = {}
+_tables_lock = threading.Lock()
+
+
+def get_table(path: str) -> ColumnarTable:
+    """The columnar copy of order_data for a database, reloaded when the file changes."""
+    path = os.path.realpath(path)
+    version = db_version(path)
+    cached = _tables.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _tables_lock:
+        cached = _tables.get(path)
+        if cached is None or cached[0] != version:
+            cached = _tables[path] = (version, ColumnarTable(path))
+        return cached[1]
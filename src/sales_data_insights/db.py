@@ -0,0 +1,108 @@
+import logging
+import os
+import pathlib
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Pool of read-only SQLite connections, shared by all SalesDataInsights instances
+# that point to the same database file. Connections are opened once and reused,
+# so the schema is parsed once and the prepared-statement cache stays warm.
+#
+# The pool can be tuned with environment variables:
+#   SDI_DB_POOL_SIZE        max idle connections kept per database (default 8)
+#   SDI_DB_MMAP_SIZE        bytes of the database to memory map (default 256MB)
+#   SDI_DB_CACHE_SIZE_KB    page cache per connection in KiB (default 64MB)
+#   SDI_DB_STATEMENT_CACHE  prepared statements cached per connection (default 256)
+#   SDI_DB_IMMUTABLE        set to 1 to open the file with immutable=1 (no locking)
+
+
+def db_version(path: str) -> tuple:
+    """Cheap fingerprint of the database file, changes whenever the file is rewritten."""
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+class ConnectionPool:
+    def __init__(self, path: str, max_size: int = None):
+        self.path = path
+        self.max_size = max_size or int(os.getenv("SDI_DB_POOL_SIZE", "8"))
+        self.version = None
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        uri = f"{pathlib.Path(self.path).as_uri()}?mode=ro"
+        if os.getenv("SDI_DB_IMMUTABLE", "0") == "1":
+            uri += "&immutable=1"
+
+        connection = sqlite3.connect(
+            uri,
+            uri=True,
+            check_same_thread=False,
+            cached_statements=int(os.getenv("SDI_DB_STATEMENT_CACHE", "256")),
+        )
+        connection.execute("PRAGMA query_only = 1")
+        connection.execute(f"PRAGMA mmap_size = {int(os.getenv('SDI_DB_MMAP_SIZE', str(256 * 1024 * 1024)))}")
+        connection.execute(f"PRAGMA cache_size = -{int(os.getenv('SDI_DB_CACHE_SIZE_KB', str(64 * 1024)))}")
+        # load the schema now rather than on the first query
+        connection.execute("SELECT name FROM sqlite_master").fetchall()
+        return connection
+
+    def _check_version(self) -> tuple:
+        version = db_version(self.path)
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    if self.version is not None:
+                        logging.info(f"{self.path} changed, dropping pooled connections")
+                    self.version = version
+                    self._drain()
+        return version
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait()[1].close()
+            except queue.Empty:
+                return
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the with block."""
+        version = self._check_version()
+        try:
+            connection_version, connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection_version, connection = version, self._connect()
+        if connection_version != version:
+            connection.close()
+            connection_version, connection = version, self._connect()
+
+        try:
+            yield connection
+        finally:
+            # connections opened against an older file are not returned to the pool
+            if connection_version == self.version and self._idle.qsize() < self.max_size:
+                self._idle.put((connection_version, connection))
+            else:
+                connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._drain()
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path: str) -> ConnectionPool:
+    """Return the process-wide connection pool for a database file."""
+    path = os.path.realpath(path)
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
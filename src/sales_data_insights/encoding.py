@@ -0,0 +1,63 @@
+import json
+import os
+from typing import Iterable
+
+# Compact, budgeted encoding of query results for the tool output sent back to the
+# assistant. Column names are written once, rows are arrays and floats are rounded:
+#
+#   {"columns": ["Region", "revenue"], "rows": [["EUROPE", 1234.57], ...],
+#    "row_count": 1200, "truncated": true}
+#
+# Rows are consumed one at a time, so a cursor can be streamed without materializing
+# the whole result; rows past the budget are only counted. The budget is configured
+# with environment variables:
+#   SDI_RESULT_MAX_ROWS      max rows returned (default 200)
+#   SDI_RESULT_MAX_BYTES     max bytes of encoded rows (default 16384)
+#   SDI_RESULT_MAX_TOKENS    max prompt tokens of encoded rows (default 4000)
+#   SDI_RESULT_FLOAT_DIGITS  decimals floats are rounded to (default 4)
+
+# JSON of numbers and short names is roughly 4 characters per token for the GPT tokenizers
+CHARS_PER_TOKEN = 4
+
+
+def _round(value, digits: int):
+    if isinstance(value, float):
+        return round(value, digits)
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
+
+
+def encode_result(
+    columns: list[str],
+    rows: Iterable,
+    max_rows: int = None,
+    max_bytes: int = None,
+    max_tokens: int = None,
+    float_digits: int = None,
+) -> dict:
+    """Encode (columns, rows) within the row, byte and token budget, see the module comment."""
+    max_rows = max_rows if max_rows is not None else int(os.getenv("SDI_RESULT_MAX_ROWS", "200"))
+    max_bytes = max_bytes if max_bytes is not None else int(os.getenv("SDI_RESULT_MAX_BYTES", "16384"))
+    max_tokens = max_tokens if max_tokens is not None else int(os.getenv("SDI_RESULT_MAX_TOKENS", "4000"))
+    float_digits = float_digits if float_digits is not None else int(os.getenv("SDI_RESULT_FLOAT_DIGITS", "4"))
+    budget = min(max_bytes, max_tokens * CHARS_PER_TOKEN)
+
+    rows = iter(rows)
+    encoded = []
+    size = 0
+    truncated = False
+    for row in rows:
+        row = [_round(value, float_digits) for value in row]
+        # the row plus its separating comma
+        row_size = len(json.dumps(row, separators=(",", ":"))) + 1
+        if len(encoded) >= max_rows or size + row_size > budget:
+            truncated = True
+            break
+        encoded.append(row)
+        size += row_size
+
+    # the rest of the rows are only counted
+    row_count = len(encoded) + (1 + sum(1 for _ in rows) if truncated else 0)
+
+    return {"columns": list(columns), "rows": encoded, "row_count": row_count, "truncated": truncated}
@@ -0,0 +1,52 @@
+import os
+import pathlib
+import sqlite3
+import time
+
+# Secondary indexes built with the order_data database. The set was chosen with
+# generate_data/index_advisor.py by replaying the ground truth queries of the test
+# and train sets; rerun the advisor when the prompt or the schema changes.
+
+INDEXES = {
+    "order_data": [
+        ["product_type", "sub_category", "Month", "main_category", "Year"],
+        ["main_category"],
+        ["Region"],
+        ["Year", "Month"],
+    ],
+}
+
+
+def index_name(table: str, columns: list[str]) -> str:
+    return f"idx_{table}_{'_'.join(column.lower() for column in columns)}"
+
+
+def build_indexes(connection: sqlite3.Connection, indexes: dict[str, list[list[str]]] = None) -> None:
+    """Create the indexes (if missing) and refresh the planner statistics."""
+    indexes = INDEXES if indexes is None else indexes
+    for table, column_lists in indexes.items():
+        for columns in column_lists:
+            start = time.time()
+            name = index_name(table, columns)
+            connection.execute(
+                f'CREATE INDEX IF NOT EXISTS {name} ON "{table}" ({", ".join(columns)})'
+            )
+            print(f"built index {name} in {time.time() - start:.2f}s")
+    connection.execute("ANALYZE")
+    connection.commit()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the order_data indexes")
+    parser.add_argument(
+        "--db",
+        help="Path to the order_data database",
+        default=os.path.join(pathlib.Path(__file__).parent.resolve(), "data", "order_data.db"),
+    )
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.db)
+    build_indexes(connection)
+    connection.close()
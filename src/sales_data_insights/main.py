@@ -1,13 +1,18 @@
+import logging
 import os
 import pathlib
-import sqlite3
-from openai import AzureOpenAI
-import pandas as pd
+import time
 from promptflow.tracing import trace
 import json
-from azure.ai.inference import ChatCompletionsClient
 from azure.ai.inference.models import SystemMessage, UserMessage
-from azure.core.credentials import AzureKeyCredential
+from .clients import get_azure_openai_client, get_chat_completions_client
+from .cache import get_query_cache
+from .columnar import Unsupported, execute, get_table
+from .db import get_pool
+from .encoding import encode_result
+from .metrics import TimedRows, db_duration, duration, llm_duration, serialization_duration
+from .question_cache import fingerprint, get_question_cache
+from .rollups import available_rollups, rewrite_query
 from .system_message import system_message, system_message_short
 
 from typing import TypedDict
@@ -15,7 +20,11 @@ class Result(TypedDict):
     data: dict
     error: str
     query: str
+    # seconds: the whole call, generating the SQL (0 when cached) and running the query
     execution_time: float
+    llm_time: float
+    db_time: float
+    cached: bool
 
 # Callable class with @trace decorator on the __call__ method
 class SalesDataInsights:
@@ -26,37 +35,93 @@ class SalesDataInsights:
     full end-to-end assistant experience.
     """
 
-    def __init__(self, data=None, model_type="azure_openai"):
+    def __init__(self, data=None, model_type="azure_openai", question_cache=None, engine=None):
         self.data = data if data else os.path.join(
             pathlib.Path(__file__).parent.resolve(), "data", "order_data.db"
         )
         self.model_type = model_type
+        # "sqlite" or "columnar" (NumPy, falls back to SQLite), defaults to SDI_ENGINE
+        self.engine = (engine or os.getenv("SDI_ENGINE", "sqlite")).lower()
+        if self.engine not in ("sqlite", "columnar"):
+            raise ValueError(f"Unknown engine: {self.engine}, use 'sqlite' or 'columnar'")
+        # "memory" or "sqlite" to reuse SQL generated for earlier questions, defaults to SDI_QUESTION_CACHE
+        self.question_cache = get_question_cache(question_cache)
 
     @trace
     def __call__(self, *, question: str, **kwargs) -> Result:
 
-        if self.model_type == "azure_openai":
-            client = AzureOpenAI(
-                                api_key = os.getenv("OPENAI_API_KEY"),
-                                azure_endpoint = os.getenv("OPENAI_API_BASE"),
-                                api_version = os.getenv("OPENAI_API_VERSION")
-                            )
-        else:
-            endpoint = os.getenv(f"AZUREAI_{self.model_type.upper()}_URL")
-            key = os.getenv(f"AZUREAI_{self.model_type.upper()}_KEY")
-            print("endpoint", endpoint)
-            print("key", key)
-            client = ChatCompletionsClient(
-                endpoint=endpoint,
-                credential=AzureKeyCredential(key),
-            )
         # Code to get time to execute the function
-        import time
-        start = time.time()
+        start = time.perf_counter()
+        # seconds per step, also recorded as metrics (see metrics.py)
+        timings = {"llm": 0.0, "db": 0.0, "serialization": 0.0}
         
         print("getting sales data insights")
         print("question", question)
 
+        query = None
+        if self.question_cache is not None:
+            query = self.question_cache.get(question, self.model_type, self.prompt_fingerprint())
+        cached = query is not None
+        if not cached:
+            llm_start = time.perf_counter()
+            status = "error"
+            try:
+                query = self.generate_query(question)
+                status = "error" if query.lower().startswith("error") else "ok"
+            finally:
+                timings["llm"] = time.perf_counter() - llm_start
+                llm_duration.record(timings["llm"], self._attributes(status))
+
+        if query.lower().startswith("error"):
+            return self._result(start, timings, data=None, error=query, query=query, cached=cached)
+        
+        db_start = time.perf_counter()
+        try:
+            data = self.query_db(query, timings)
+        except Exception as e:
+            timings["db"] = time.perf_counter() - db_start
+            db_duration.record(timings["db"], self._attributes("error"))
+            result = self._result(start, timings, data=None, error=f"{e}", query=query, cached=cached)
+            print("Execution time:", result["execution_time"])
+            return result
+        db_duration.record(timings["db"], self._attributes("ok"))
+        serialization_duration.record(timings["serialization"], self._attributes("ok"))
+
+        # only remember queries that actually ran
+        if not cached and self.question_cache is not None:
+            self.question_cache.put(question, self.model_type, self.prompt_fingerprint(), query)
+
+        return self._result(start, timings, data=data, error=str(None), query=query, cached=cached)
+
+    def _attributes(self, status: str) -> dict:
+        return {"model_type": self.model_type, "status": status}
+
+    def _result(self, start: float, timings: dict, **result) -> Result:
+        execution_time = time.perf_counter() - start
+        duration.record(execution_time, self._attributes("ok" if result["error"] == str(None) else "error"))
+        return Result(
+            **result,
+            execution_time=round(execution_time, 2),
+            llm_time=round(timings["llm"], 3),
+            db_time=round(timings["db"], 3),
+        )
+
+    def prompt_fingerprint(self) -> str:
+        # anything that changes the generated SQL besides the question itself
+        if self.model_type == "azure_openai":
+            return fingerprint(system_message, os.getenv("OPENAI_ANALYST_CHAT_MODEL"))
+        elif self.model_type.lower() == "phi3_mini":
+            return fingerprint(system_message_short, os.getenv("AZUREAI_PHI3_MINI_URL"))
+        else:
+            return fingerprint(system_message, os.getenv(f"AZUREAI_{self.model_type.upper()}_URL"))
+
+    def generate_query(self, question: str) -> str:
+        # clients are pooled per endpoint, so connections are reused across calls
+        if self.model_type == "azure_openai":
+            client = get_azure_openai_client()
+        else:
+            client = get_chat_completions_client(self.model_type)
+
         if self.model_type == "azure_openai":
             messages = [{"role": "system", "content": system_message}]
         
@@ -87,31 +152,56 @@ class SalesDataInsights:
         if query.startswith("```sql") and query.endswith("```"):
             query = query[6:-3].strip()
 
-        if query.lower().startswith("error"):
-            end = time.time()
-            execution_time = round(end - start, 2)
-            return {"data": None, "error": query, "query": query, "execution_time": 0}
-        
-        try:
-            data = self.query_db(query)
-        except Exception as e:
-            end = time.time()
-            execution_time = round(end - start, 2)
-            print("Execution time:", execution_time)
-            return {"data": None, "error": f"{e}", "query": query, "execution_time": execution_time}
-
-        end = time.time()
-        execution_time = round(end - start, 2)
-
-        return {"data": data, "error": str(None), "query": query, "execution_time": execution_time}
+        return query
     
     @trace
-    def query_db(self, query: str) -> dict:
-        sql_connection = sqlite3.connect(self.data)
-
-        df = pd.read_sql(query, sql_connection)
-
-        return df.to_dict(orient='records')
+    def query_db(self, query: str, timings: dict = None) -> dict:
+        # results are encoded compactly and within the SDI_RESULT_* budget, see encoding.py
+        # timings gets the seconds spent in the database ("db") and encoding ("serialization")
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+
+        def consume(columns, rows):
+            # rows are fetched while they are encoded, split the time between the two
+            executed = time.perf_counter()
+            rows = TimedRows(rows)
+            encoded = encode_result(columns, rows)
+            timings["db"] = executed - start + rows.elapsed
+            timings["serialization"] = time.perf_counter() - executed - rows.elapsed
+            return encoded
+
+        # the result cache streams misses through consume too, see cache.py
+        query_cache = get_query_cache()
+        if query_cache is None:
+            return self.execute_query(query, consume=consume)
+        return query_cache.fetch(self.data, query, self.execute_query, consume=consume)
+
+    def execute_query(self, query: str, consume=None):
+        """
+        Run a query and return consume(columns, rows), called while the cursor is still open so
+        rows can be streamed. Without consume, returns (columns, rows) with all rows fetched.
+        """
+        consume = consume or (lambda columns, rows: (columns, list(rows)))
+
+        if self.engine == "columnar":
+            try:
+                columns, rows = execute(get_table(self.data), query)
+            except Unsupported as e:
+                logging.debug(f"columnar engine falls back to SQLite: {e}")
+            else:
+                return consume(columns, rows)
+
+        # aggregate queries are answered from the smallest rollup table that fits
+        if os.getenv("SDI_ROLLUPS", "1") != "0":
+            query = rewrite_query(query, available_rollups(self.data))
+
+        # connections are pooled per database file and opened read-only
+        with get_pool(self.data).connection() as sql_connection:
+            cursor = sql_connection.execute(query)
+            if cursor.description is None:
+                return consume([], [])
+            columns = [column[0] for column in cursor.description]
+            return consume(columns, cursor)
  
 if __name__ == "__main__":
 
@@ -122,5 +212,5 @@ if __name__ == "__main__":
         sdi = SalesDataInsights(model_type=model)
         result = sdi(question="for 2024 Query the average number of orders per day grouped by Month")
         result["data"] = None
-        print("execution_time:", result['execution_time'])
+        print("execution_time:", result['execution_time'], "llm_time:", result['llm_time'], "db_time:", result['db_time'])
         print("query", result['query'])
@@ -0,0 +1,42 @@
+import time
+
+from opentelemetry import metrics
+
+# Latency metrics of SalesDataInsights (OpenTelemetry meter "sales_data_insights.metrics"),
+# in seconds, tagged with model_type and status (ok or error):
+#   sales_data_insights.llm.duration            generating the SQL (not recorded for cached questions)
+#   sales_data_insights.db.duration             running the query and fetching the rows
+#   sales_data_insights.serialization.duration  encoding the rows for the assistant
+#   sales_data_insights.duration                the whole tool call
+
+meter = metrics.get_meter(__name__)
+llm_duration = meter.create_histogram(
+    "sales_data_insights.llm.duration", unit="s", description="Time to generate the SQL query"
+)
+db_duration = meter.create_histogram(
+    "sales_data_insights.db.duration", unit="s", description="Time to run the SQL query and fetch its rows"
+)
+serialization_duration = meter.create_histogram(
+    "sales_data_insights.serialization.duration", unit="s", description="Time to encode the query result"
+)
+duration = meter.create_histogram(
+    "sales_data_insights.duration", unit="s", description="Duration of a SalesDataInsights call"
+)
+
+
+class TimedRows:
+    """Iterate rows, adding up the time spent fetching them in elapsed."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.elapsed = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.rows)
+        finally:
+            self.elapsed += time.perf_counter() - start
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Optional cache from a question to the SQL the model generated for it, so repeated
+# questions skip the chat completion. The key combines the normalized question, the
+# model type and a fingerprint of the prompt, so prompt changes never reuse old SQL.
+#
+# The cache is configured with environment variables:
+#   SDI_QUESTION_CACHE              "memory", "sqlite" or unset/empty to disable
+#   SDI_QUESTION_CACHE_PATH         file used by the sqlite store (default data/question_cache.db)
+#   SDI_QUESTION_CACHE_MAX_ENTRIES  max entries of the memory store (default 1024)
+
+# words that never change the meaning of a data question ("us" and "a" can: the US, grade A)
+_FILLER_WORDS = {"an", "the", "please", "kindly", "me", "can", "could", "would", "you"}
+
+# comparison operators, signed numbers (with decimals, thousands separators, %) and
+# words (with inner dots, dashes and apostrophes); the rest is punctuation
+_TOKEN_RE = re.compile(r"[<>!=]+|[-+]?[$]?\d+(?:[.,]\d+)*%?|\w+(?:[.'-]\w+)*|[%$]")
+
+
+def normalize_question(question: str) -> str:
+    """Case, whitespace, punctuation and filler word insensitive form of a question."""
+    question = unicodedata.normalize("NFKC", question).lower()
+    return " ".join(word for word in _TOKEN_RE.findall(question) if word not in _FILLER_WORDS)
+
+
+def fingerprint(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class MemoryQuestionStore:
+    """In-process LRU store."""
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries or int(os.getenv("SDI_QUESTION_CACHE_MAX_ENTRIES", "1024"))
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            query = self._entries.get(key)
+            if query is not None:
+                self._entries.move_to_end(key)
+            return query
+
+    def put(self, key: str, question: str, query: str) -> None:
+        with self._lock:
+            self._entries[key] = query
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteQuestionStore:
+    """On-disk store that survives restarts."""
+
+    def __init__(self, path: str):
+        self.path = path
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS question_sql ("
+            "key TEXT PRIMARY KEY, question TEXT, query TEXT, created REAL)"
+        )
+        self._connection.commit()
+
+    def get(self, key: str) -> str:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT query FROM question_sql WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, question: str, query: str) -> None:
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO question_sql (key, question, query, created) VALUES (?, ?, ?, ?)",
+                (key, question, query, time.time()),
+            )
+            self._connection.commit()
+
+
+class QuestionCache:
+    def __init__(self, store):
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, question: str, model_type: str, prompt_fingerprint: str) -> str:
+        return fingerprint(normalize_question(question), model_type.lower(), prompt_fingerprint)
+
+    def get(self, question: str, model_type: str, prompt_fingerprint: str) -> str:
+        query = self.store.get(self.key(question, model_type, prompt_fingerprint))
+        if query is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return query
+
+    def put(self, question: str, model_type: str, prompt_fingerprint: str, query: str) -> None:
+        self.store.put(self.key(question, model_type, prompt_fingerprint), question, query)
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses)
+
+
+_question_caches: dict[tuple, QuestionCache] = {}
+_question_caches_lock = threading.Lock()
+
+
+def get_question_cache(kind: str = None, path: str = None) -> QuestionCache:
+    """
+    Return the process-wide question cache for a store kind ("memory" or "sqlite"),
+    defaulting to SDI_QUESTION_CACHE. Returns None when the cache is disabled.
+    """
+    kind = (kind if kind is not None else os.getenv("SDI_QUESTION_CACHE", "")).lower()
+    if not kind:
+        return None
+
+    if kind == "sqlite":
+        path = path or os.getenv("SDI_QUESTION_CACHE_PATH") or os.path.join(
+            pathlib.Path(__file__).parent.resolve(), "data", "question_cache.db"
+        )
+    elif kind != "memory":
+        raise ValueError(f"Unknown question cache: {kind}, use 'memory' or 'sqlite'")
+
+    with _question_caches_lock:
+        cache = _question_caches.get((kind, path))
+        if cache is None:
+            store = SQLiteQuestionStore(path) if kind == "sqlite" else MemoryQuestionStore()
+            cache = _question_caches[(kind, path)] = QuestionCache(store)
+        return cache
@@ -0,0 +1,248 @@
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from .db import db_version, get_pool
+from .sql import Token, tokenize, unquote
+
+# Pre-aggregated rollups of order_data. All measures in order_data are additive, so a
+# query that only groups/filters on the dimensions of a rollup and only uses measures
+# inside SUM()/TOTAL() returns exactly the same result from the (much smaller) rollup.
+# Rollups are built next to order_data by build_rollups, see generate_data/generate.py,
+# and queries are rewritten to the smallest rollup that can answer them.
+#
+# Set SDI_ROLLUPS=0 to always query the base table.
+
+BASE_TABLE = "order_data"
+
+MEASURES = [
+    "Number_of_Orders",
+    "Sum_of_Order_Value_USD",
+    "Sum_of_Number_of_Items",
+    "Number_of_Orders_with_Discount",
+    "Sum_of_Discount_Percentage",
+    "Sum_of_Shipping_Cost_USD",
+    "Number_of_Orders_Returned",
+    "Number_of_Orders_Cancelled",
+    "Sum_of_Time_to_Fulfillment",
+    "Number_of_Orders_Repeat_Customers",
+]
+
+DIMENSIONS = [
+    "Year",
+    "Month",
+    "Day",
+    "Date",
+    "Day_of_Week",
+    "main_category",
+    "sub_category",
+    "product_type",
+    "Region",
+]
+
+ROLLUPS = {
+    "order_data_by_day_region_category": ["Year", "Month", "Day", "Date", "Day_of_Week", "Region", "main_category"],
+    "order_data_by_month_region_category": ["Year", "Month", "Region", "main_category"],
+    "order_data_by_month_region": ["Year", "Month", "Region"],
+    "order_data_by_month_category": ["Year", "Month", "main_category"],
+}
+
+_ADDITIVE_FUNCTIONS = {"sum", "total"}
+_CLAUSE_KEYWORDS = {
+    "where", "group", "order", "having", "limit", "join", "inner", "left", "right", "full",
+    "cross", "natural", "on", "using", "union", "intersect", "except", "window",
+}
+_AGGREGATE_FUNCTIONS = {"avg", "count", "min", "max", "group_concat", "string_agg", "median", "over"}
+
+
+def build_rollups(connection: sqlite3.Connection) -> None:
+    """(Re)build all rollup tables from order_data."""
+    base_rows = connection.execute(f"SELECT COUNT(*) FROM {BASE_TABLE}").fetchone()[0]
+    connection.execute("DROP TABLE IF EXISTS rollup_info")
+    connection.execute("CREATE TABLE rollup_info (name TEXT PRIMARY KEY, dimensions TEXT, rows INTEGER, base_rows INTEGER)")
+
+    for name, dimensions in ROLLUPS.items():
+        start = time.time()
+        columns = ", ".join(dimensions)
+        measures = ", ".join(f"SUM({measure}) AS {measure}" for measure in MEASURES)
+        connection.execute(f"DROP TABLE IF EXISTS {name}")
+        connection.execute(
+            f"CREATE TABLE {name} AS SELECT {columns}, {measures} FROM {BASE_TABLE} GROUP BY {columns}"
+        )
+        rows = connection.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        connection.execute(
+            "INSERT INTO rollup_info (name, dimensions, rows, base_rows) VALUES (?, ?, ?, ?)",
+            (name, ",".join(dimensions), rows, base_rows),
+        )
+        print(f"built rollup {name}: {rows} rows ({base_rows} base rows) in {time.time() - start:.2f}s")
+
+    connection.commit()
+
+
+_available = {}
+_available_lock = threading.Lock()
+
+
+def available_rollups(path: str) -> list[tuple[str, set, int]]:
+    """
+    The rollups built for a database as (name, lower-case dimensions, rows), smallest first.
+    Rollups built from a different number of base rows are stale and ignored.
+    """
+    path = os.path.realpath(path)
+    version = db_version(path)
+    cached = _available.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    rollups = []
+    with get_pool(path).connection() as connection:
+        has_info = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup_info'"
+        ).fetchone()
+        if has_info:
+            base_rows = connection.execute(f"SELECT COUNT(*) FROM {BASE_TABLE}").fetchone()[0]
+            for name, dimensions, rows, built_from in connection.execute(
+                "SELECT name, dimensions, rows, base_rows FROM rollup_info ORDER BY rows"
+            ):
+                if built_from != base_rows:
+                    logging.warning(f"rollup {name} is stale, rebuild it with build_rollups")
+                    continue
+                rollups.append((name, {d.lower() for d in dimensions.split(",")}, rows))
+
+    with _available_lock:
+        _available[path] = (version, rollups)
+    return rollups
+
+
+def _name(token: Token) -> str:
+    return unquote(token).lower() if token.kind in ("ident", "qident") else None
+
+
+def _referenced_dimensions(tokens: list[Token]) -> set:
+    """
+    Dimensions a query depends on, or None if it cannot be answered from a rollup:
+    it touches another table, selects *, uses a non-additive aggregate, uses a
+    measure other than as SUM(measure)/TOTAL(measure), or sums anything else.
+    """
+    measures = {measure.lower() for measure in MEASURES}
+    dimensions = {dimension.lower() for dimension in DIMENSIONS}
+    names = [_name(token) for token in tokens]
+    values = [token.value for token in tokens]
+    referenced = set()
+
+    # a single SELECT whose rows do not depend on how many base rows there are:
+    # it has to be grouped, DISTINCT, or an aggregate over the whole table
+    selects = [i for i, name in enumerate(names) if name == "select"]
+    if len(selects) != 1:
+        return None
+    grouped = any(
+        name == "group" and i + 1 < len(names) and names[i + 1] == "by" for i, name in enumerate(names)
+    )
+    distinct = selects[0] + 1 < len(names) and names[selects[0] + 1] == "distinct"
+    aggregated = any(
+        name in _ADDITIVE_FUNCTIONS and i + 1 < len(values) and values[i + 1] == "("
+        for i, name in enumerate(names)
+    )
+    if not (grouped or distinct or aggregated):
+        return None
+
+    for i, name in enumerate(names):
+        previous = values[i - 1].lower() if i > 0 else ""
+        following = values[i + 1] if i + 1 < len(tokens) else ""
+
+        if values[i] == "*" and previous in ("select", ",", "(", ".", "distinct", "all", ""):
+            return None
+        if name is None:
+            continue
+        if name in _AGGREGATE_FUNCTIONS and (following == "(" or name == "over"):
+            return None
+        if (previous in ("from", "join") and name != BASE_TABLE) or name in ROLLUPS or name == "rollup_info":
+            return None
+        if name in _ADDITIVE_FUNCTIONS and following == "(":
+            # the whole argument has to be a measure, SUM(measure) or SUM(table.measure):
+            # constants, expressions and dimensions add up differently on a rollup
+            argument = values[i + 2:i + 6]
+            if len(argument) >= 2 and argument[1] == ")" and names[i + 2] in measures:
+                continue
+            if (
+                len(argument) == 4
+                and names[i + 2] is not None
+                and argument[1] == "."
+                and argument[3] == ")"
+                and names[i + 4] in measures
+            ):
+                continue
+            return None
+        if following == "(":
+            # a function call, not a column
+            continue
+
+        if name in measures:
+            # allow SUM(measure) and SUM(table.measure)
+            j = i - 1
+            if j >= 1 and values[j] == "." and names[j - 1] is not None:
+                j -= 2
+            if not (
+                j >= 1
+                and values[j] == "("
+                and names[j - 1] in _ADDITIVE_FUNCTIONS
+                and following == ")"
+            ):
+                return None
+        elif name in dimensions:
+            referenced.add(name)
+
+    return referenced
+
+
+def rewrite_query(query: str, rollups: list[tuple[str, set, int]]) -> str:
+    """Point a query at the smallest rollup that answers it exactly, or return it unchanged."""
+    if not rollups:
+        return query
+
+    tokens = tokenize(query)
+    if not any(_name(token) == BASE_TABLE for token in tokens):
+        return query
+
+    referenced = _referenced_dimensions(tokens)
+    if referenced is None:
+        return query
+
+    for name, dimensions, _ in rollups:
+        if referenced <= dimensions:
+            # only the FROM/JOIN target changes; keeping order_data as the table alias
+            # leaves qualified references and the column labels untouched
+            rewritten = []
+            position = 0
+            for i, token in enumerate(tokens):
+                previous = tokens[i - 1].value.lower() if i > 0 else ""
+                if _name(token) == BASE_TABLE and previous in ("from", "join"):
+                    following = _name(tokens[i + 1]) if i + 1 < len(tokens) else None
+                    aliased = following == "as" or (following is not None and following not in _CLAUSE_KEYWORDS)
+                    rewritten.append(query[position:token.start])
+                    rewritten.append(name if aliased else f"{name} AS {BASE_TABLE}")
+                    position = token.end
+            rewritten.append(query[position:])
+            logging.info(f"rewrote query to use rollup {name}")
+            return "".join(rewritten)
+
+    return query
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the order_data rollup tables")
+    parser.add_argument(
+        "--db",
+        help="Path to the order_data database",
+        default=os.path.join(pathlib.Path(__file__).parent.resolve(), "data", "order_data.db"),
+    )
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.db)
+    build_rollups(connection)
+    connection.close()
@@ -0,0 +1,115 @@
+import re
+from typing import NamedTuple
+
+# A small SQLite tokenizer. It is not a parser, but it is enough to normalize the
+# queries generated by the model and to reason about which columns they touch.
+
+
+class Token(NamedTuple):
+    kind: str
+    value: str
+    start: int
+    end: int
+
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?(?:\*/|$))
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<qident>"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])
+  | (?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<ident>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<op><=|>=|<>|!=|==|\|\||<<|>>|[-+*/%(),.;=<>&|~])
+  | (?P<other>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+_PLAIN_IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def tokenize(sql: str, skip_whitespace: bool = True) -> list[Token]:
+    """Split a SQL string into tokens. Whitespace and comments are dropped by default."""
+    tokens = []
+    for match in _TOKEN_RE.finditer(sql):
+        kind = match.lastgroup
+        if skip_whitespace and kind in ("ws", "comment"):
+            continue
+        tokens.append(Token(kind, match.group(), match.start(), match.end()))
+    return tokens
+
+
+def unquote(token: Token) -> str:
+    """Return the name of an identifier token without its quotes."""
+    if token.kind != "qident":
+        return token.value
+    value = token.value
+    if value[0] == "[":
+        return value[1:-1]
+    return value[1:-1].replace(value[0] * 2, value[0])
+
+
+def strip_statement(sql: str) -> str:
+    """Remove surrounding whitespace and trailing semicolons from a single statement."""
+    sql = sql.strip()
+    while sql.endswith(";"):
+        sql = sql[:-1].rstrip()
+    return sql
+
+
+def canonicalize(sql: str, columns: set[str] = None) -> str:
+    """
+    Normalize a query so that trivially different spellings map to the same string:
+    whitespace and comments, keyword and identifier case, identifier quoting, the
+    optional AS keyword and the names of result aliases.
+
+    Aliases are renamed to positional names, unless they collide with one of the
+    given table columns (SQLite would resolve some references to the column then).
+    Double-quoted names keep their exact spelling unless they are table columns.
+    Note that the canonical form only identifies the query, it is not meant to run.
+    """
+    columns = {column.lower() for column in (columns or ())}
+    tokens = tokenize(sql)
+    while tokens and tokens[-1].value == ";":
+        tokens.pop()
+
+    words = []
+    for token in tokens:
+        if token.kind == "qident" and _PLAIN_IDENT_RE.match(unquote(token)) and (
+            # SQLite reads a double-quoted name that is not a column as a string literal,
+            # so only the quotes of known columns can be dropped
+            token.value[0] != '"' or unquote(token).lower() in columns
+        ):
+            words.append(unquote(token).lower())
+        elif token.kind == "ident":
+            words.append(token.value.lower())
+        else:
+            words.append(token.value)
+
+    # collect aliases introduced with AS, then drop the optional AS keyword;
+    # the AS inside CAST(x AS type) is not an alias and is kept
+    aliases = {}
+    alias_as = set()
+    parens = []
+    for i, word in enumerate(words):
+        if word == "(":
+            parens.append(i > 0 and words[i - 1] == "cast")
+        elif word == ")" and parens:
+            parens.pop()
+        elif word == "as" and not (parens and parens[-1]):
+            alias_as.add(i)
+            alias = words[i + 1] if i + 1 < len(words) else ""
+            if _PLAIN_IDENT_RE.match(alias) and alias not in columns and alias not in aliases:
+                aliases[alias] = f"_a{len(aliases)}"
+
+    canonical = []
+    for i, word in enumerate(words):
+        if i in alias_as:
+            continue
+        # function calls are never renamed, even if an alias shares the name
+        if word in aliases and not (i + 1 < len(words) and words[i + 1] == "("):
+            word = aliases[word]
+        canonical.append(word)
+
+    return " ".join(canonical)
@@ -0,0 +1,181 @@
+# Export of spans and log records (evaluation events) off the request path. Every exporter
+# sits behind a batch processor with a bounded queue that a background thread drains, so
+# ending a span or logging a vote only appends to a queue, even when the collector is slow.
+# When the queue is full items are dropped, the oldest by default. Pending items are
+# flushed when the provider shuts down (at exit).
+#
+# Configured with environment variables:
+#   TELEMETRY_MAX_QUEUE        max items waiting per exporter (default 2048)
+#   TELEMETRY_BATCH_SIZE       max items per export call (default 512)
+#   TELEMETRY_EXPORT_INTERVAL  seconds between exports of a partial batch (default 5)
+#   TELEMETRY_EXPORT_TIMEOUT   seconds the flush on shutdown may take (default 30)
+#   TELEMETRY_DROP_POLICY      "oldest" or "newest", what to drop when the queue is full (default oldest)
+#   TELEMETRY_SPANS_FILE       file the spans and logs are also written to (default spans.json, empty disables)
+#
+# Metrics (meter "telemetry"), by pipeline: telemetry.exported, telemetry.dropped and
+# telemetry.failed items.
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from opentelemetry import metrics
+from opentelemetry.sdk._logs import LogRecordProcessor
+from opentelemetry.sdk.trace import SpanProcessor
+
+meter = metrics.get_meter("telemetry")
+_exported_counter = meter.create_counter("telemetry.exported", unit="{item}", description="Telemetry items exported")
+_dropped_counter = meter.create_counter(
+    "telemetry.dropped", unit="{item}", description="Telemetry items dropped because the export queue was full"
+)
+_failed_counter = meter.create_counter("telemetry.failed", unit="{item}", description="Telemetry items that failed to export")
+
+
+class BatchExporter:
+    """Bounded queue of items exported in batches by a daemon thread."""
+
+    def __init__(
+        self,
+        name: str,
+        exporter,
+        max_queue: int = None,
+        batch_size: int = None,
+        interval: float = None,
+        drop_policy: str = None,
+    ):
+        self.name = name
+        self.exporter = exporter
+        self.max_queue = max_queue or int(os.getenv("TELEMETRY_MAX_QUEUE", "2048"))
+        self.batch_size = batch_size or int(os.getenv("TELEMETRY_BATCH_SIZE", "512"))
+        self.interval = interval or float(os.getenv("TELEMETRY_EXPORT_INTERVAL", "5"))
+        self.drop_policy = (drop_policy or os.getenv("TELEMETRY_DROP_POLICY", "oldest")).lower()
+        if self.drop_policy not in ("oldest", "newest"):
+            raise ValueError(f"Unknown drop policy: {self.drop_policy}, use 'oldest' or 'newest'")
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = deque()
+        self._condition = threading.Condition()
+        # set by force_flush, the worker exports everything queued before it
+        self._flush_requests = []
+        self._shutdown = False
+        self._thread = threading.Thread(target=self._loop, name=f"telemetry-{name}", daemon=True)
+        self._thread.start()
+
+    def put(self, item) -> None:
+        with self._condition:
+            if self._shutdown:
+                return
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                _dropped_counter.add(1, {"pipeline": self.name})
+                if self.drop_policy == "newest":
+                    return
+                self._queue.popleft()
+            self._queue.append(item)
+            if len(self._queue) >= self.batch_size:
+                self._condition.notify()
+
+    def _loop(self) -> None:
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + self.interval
+                while (
+                    len(self._queue) < self.batch_size
+                    and not self._flush_requests
+                    and not self._shutdown
+                    and time.monotonic() < deadline
+                ):
+                    self._condition.wait(deadline - time.monotonic())
+                flush_requests, self._flush_requests = self._flush_requests, []
+                # a flush drains the queue, otherwise one batch per wake up
+                count = len(self._queue) if flush_requests or self._shutdown else min(len(self._queue), self.batch_size)
+                items = [self._queue.popleft() for _ in range(count)]
+                shutdown = self._shutdown
+            for start in range(0, len(items), self.batch_size):
+                self._export(items[start:start + self.batch_size])
+            for event in flush_requests:
+                event.set()
+            if shutdown:
+                return
+
+    def _export(self, batch: list) -> None:
+        try:
+            result = self.exporter.export(batch)
+            # SpanExportResult and LogExportResult
+            ok = getattr(result, "name", "SUCCESS") == "SUCCESS"
+        except Exception as e:
+            logging.warning(f"telemetry export to {self.name} failed: {e}")
+            ok = False
+        if ok:
+            self.exported += len(batch)
+            _exported_counter.add(len(batch), {"pipeline": self.name})
+        else:
+            self.failed += len(batch)
+            _failed_counter.add(len(batch), {"pipeline": self.name})
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        event = threading.Event()
+        with self._condition:
+            if self._shutdown:
+                return True
+            self._flush_requests.append(event)
+            self._condition.notify()
+        return event.wait(timeout_millis / 1000)
+
+    def shutdown(self) -> None:
+        with self._condition:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            self._condition.notify()
+        self._thread.join(float(os.getenv("TELEMETRY_EXPORT_TIMEOUT", "30")))
+        self.exporter.shutdown()
+        logging.info(f"telemetry {self.name}: exported {self.exported}, dropped {self.dropped}, failed {self.failed}")
+
+
+class BatchSpanExportProcessor(SpanProcessor):
+    """Span processor on a BatchExporter, ending a span only queues it."""
+
+    def __init__(self, name: str, exporter, **options):
+        self.batch = BatchExporter(name, exporter, **options)
+
+    def on_start(self, span, parent_context=None) -> None:
+        pass
+
+    def on_end(self, span) -> None:
+        if span.context is not None and span.context.trace_flags.sampled:
+            self.batch.put(span)
+
+    def shutdown(self) -> None:
+        self.batch.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.batch.force_flush(timeout_millis)
+
+
+class BatchLogExportProcessor(LogRecordProcessor):
+    """Log record processor on a BatchExporter, emitting a record only queues it."""
+
+    def __init__(self, name: str, exporter, **options):
+        self.batch = BatchExporter(name, exporter, **options)
+
+    def on_emit(self, log_data) -> None:
+        self.batch.put(log_data)
+
+    # the name of the hook in older SDK versions
+    emit = on_emit
+
+    def shutdown(self) -> None:
+        self.batch.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.batch.force_flush(timeout_millis)
+
+
+def spans_file():
+    """The file of the console exporters, None if disabled. They run on the export threads, so the writes do too."""
+    path = os.getenv("TELEMETRY_SPANS_FILE", "spans.json")
+    return open(path, "w") if path else None
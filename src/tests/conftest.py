@@ -0,0 +1,36 @@
+import os
+import random
+import sqlite3
+import sys
+
+import pytest
+
+# the modules are imported from src, like the app and the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sales_data_insights.rollups import DIMENSIONS, MEASURES, build_rollups  # noqa: E402
+
+
+@pytest.fixture
+def order_db(tmp_path):
+    """A small order_data database with its rollups."""
+    path = str(tmp_path / "order_data.db")
+    rng = random.Random(0)
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE order_data ({})".format(", ".join(f'"{column}"' for column in MEASURES + DIMENSIONS))
+    )
+    rows = []
+    for day in range(1, 29):
+        for region in ("EUROPE", "NORTH AMERICA", "ASIA"):
+            for category, sub_category in (("APPAREL", "Shirts"), ("APPAREL", "Shoes"), ("ELECTRONICS", "Phones")):
+                measures = [rng.randint(1, 100) for _ in MEASURES]
+                date = f"2024-02-{day:02d} 00:00:00"
+                rows.append(measures + [2024, 2, day, date, day % 7, category, sub_category, sub_category.lower(), region])
+    connection.executemany(
+        f"INSERT INTO order_data VALUES ({', '.join('?' * (len(MEASURES) + len(DIMENSIONS)))})", rows
+    )
+    connection.commit()
+    build_rollups(connection)
+    connection.close()
+    return path
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from assistant_flow.admission import AdmissionController, AdmissionRejected
+
+
+def _run(slot, fail: bool):
+    # how the runs use their slot: released when the run is done, whatever happened
+    try:
+        if fail:
+            raise RuntimeError("the run failed")
+    finally:
+        slot.release()
+
+
+def test_per_user_cap():
+    controller = AdmissionController(max_concurrency=8, max_per_user=2)
+    first, second = controller.admit("alice"), controller.admit("alice")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit("alice")
+    assert rejected.value.reason == "too many runs for this user"
+    # other users and anonymous runs are not limited by alice's runs
+    controller.admit("bob")
+    controller.admit()
+    first.release()
+    controller.admit("alice")
+    assert controller.stats() == dict(active=4, queued=0, rejected=1)
+    second.release()
+
+
+def test_queue_timeout_and_rejection_message():
+    controller = AdmissionController(max_concurrency=1, max_queue=4)
+    slot = controller.admit("alice")
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit("bob", timeout=0.1)
+    assert rejected.value.reason == "timed out in queue"
+    assert rejected.value.retry_after >= 1
+    assert str(rejected.value) == (
+        f"The assistant is busy (timed out in queue), please retry in {rejected.value.retry_after} seconds."
+    )
+    # the waiter left the queue and no longer counts for its user
+    assert controller.stats() == dict(active=1, queued=0, rejected=1)
+    assert controller._per_user == {"alice": 1}
+    slot.release()
+
+
+def test_full_queue_rejects_right_away():
+    controller = AdmissionController(max_concurrency=1, max_queue=0)
+    controller.admit()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.admit(timeout=10)
+    assert rejected.value.reason == "queue full"
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_slot_is_released_when_the_run_ends(fail):
+    controller = AdmissionController(max_concurrency=1, max_queue=4)
+    slot = controller.admit("alice")
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(controller.admit("bob", timeout=5)))
+    waiter.start()
+    while controller.stats()["queued"] == 0:
+        time.sleep(0.01)
+
+    if fail:
+        with pytest.raises(RuntimeError):
+            _run(slot, fail)
+    else:
+        _run(slot, fail)
+    waiter.join(5)
+    assert len(admitted) == 1 and not admitted[0].released
+    # releasing twice is a no-op
+    slot.release()
+    assert controller.stats()["active"] == 1
+    assert controller._per_user == {"bob": 1}
+    admitted[0].release()
+    assert controller.stats() == dict(active=0, queued=0, rejected=0)
+    assert controller._per_user == {}
+
+
+def test_async_per_user_cap_and_queue_timeout():
+    async def main():
+        controller = AdmissionController(max_concurrency=1, max_queue=4, max_per_user=1)
+        slot = await controller.admit_async("alice")
+        with pytest.raises(AdmissionRejected) as per_user:
+            await controller.admit_async("alice")
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await controller.admit_async("bob", timeout=0.1)
+        slot.release()
+        return controller, per_user.value, timed_out.value
+
+    controller, per_user, timed_out = asyncio.run(main())
+    assert per_user.reason == "too many runs for this user"
+    assert timed_out.reason == "timed out in queue"
+    assert controller.stats() == dict(active=0, queued=0, rejected=2)
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_async_slot_is_released_when_the_run_ends(fail):
+    async def main():
+        controller = AdmissionController(max_concurrency=1, max_queue=4)
+        slot = await controller.admit_async("alice")
+        waiter = asyncio.create_task(controller.admit_async("bob", timeout=5))
+        await asyncio.sleep(0)
+        assert controller.stats()["queued"] == 1
+
+        async def run():
+            try:
+                await asyncio.sleep(0)
+                if fail:
+                    raise RuntimeError("the run failed")
+            finally:
+                slot.release()
+
+        results = await asyncio.gather(run(), return_exceptions=True)
+        assert isinstance(results[0], RuntimeError) == fail
+        admitted = await asyncio.wait_for(waiter, 5)
+        admitted.release()
+        return controller
+
+    controller = asyncio.run(main())
+    assert controller.stats() == dict(active=0, queued=0, rejected=0)
+    assert controller._per_user == {}
+
+
+def test_async_cancelled_waiter_gives_back_its_slot():
+    async def main():
+        controller = AdmissionController(max_concurrency=1, max_queue=4)
+        slot = await controller.admit_async("alice")
+        waiting = asyncio.create_task(controller.admit_async("bob"))
+        granted = asyncio.create_task(controller.admit_async("carol"))
+        await asyncio.sleep(0)
+
+        # cancelled while queued
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert controller.stats()["queued"] == 1
+        # cancelled after the slot was granted, before the waiter woke up
+        slot.release()
+        granted.cancel()
+        await asyncio.gather(granted, return_exceptions=True)
+        return controller
+
+    controller = asyncio.run(main())
+    assert controller.stats() == dict(active=0, queued=0, rejected=0)
+    assert controller._per_user == {}
@@ -0,0 +1,44 @@
+import json
+import threading
+
+from assistant_flow import attributes
+from assistant_flow.attributes import BlobStore, flush_blobs, set_attribute
+
+
+class Span:
+    def __init__(self):
+        self.attributes = {}
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+def test_large_attribute_is_written_off_the_request_path(monkeypatch, tmp_path):
+    monkeypatch.setenv("TELEMETRY_BLOB_DIR", str(tmp_path))
+    writes = []
+    monkeypatch.setattr(BlobStore, "write", lambda store, digest, data: writes.append((digest, threading.current_thread())))
+    span = Span()
+    set_attribute(span, "output", "small", max_chars=10)
+    set_attribute(span, "inputs", "x" * 100, max_chars=10)
+    assert span.attributes["output"] == "small"
+    reference = json.loads(span.attributes["inputs"])
+    assert reference["blob"] == f"blob://sha256/{reference['sha256']}"
+    assert reference["size"] == 100 and reference["preview"] == "x" * 100
+    # only queued, the exporter thread writes it
+    assert flush_blobs()
+    [(digest, thread)] = writes
+    assert digest == reference["sha256"] and thread.name == "telemetry-blobs"
+
+
+def test_queued_blob_lands_in_the_store(monkeypatch, tmp_path):
+    monkeypatch.setenv("TELEMETRY_BLOB_DIR", str(tmp_path))
+    reference = attributes.image_reference(b"png bytes", "file_1")
+    assert flush_blobs()
+    assert BlobStore(str(tmp_path)).get(reference["sha256"]) == b"png bytes"
+    assert reference["file_id"] == "file_1" and reference["mime_type"] == "image/png"
+
+
+def test_no_store_only_hashes(monkeypatch):
+    monkeypatch.setenv("TELEMETRY_BLOB_DIR", "")
+    reference = attributes.blob_reference(b"data")
+    assert "blob" not in reference and reference["size"] == 4
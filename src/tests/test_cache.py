@@ -0,0 +1,58 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from sales_data_insights.cache import QueryCache
+from sales_data_insights.encoding import encode_result
+
+
+def _execute(path, calls):
+    def execute(query, consume):
+        calls.append(query)
+        with sqlite3.connect(path) as connection:
+            cursor = connection.execute(query)
+            return consume([column[0] for column in cursor.description], cursor)
+
+    return execute
+
+
+def _encode(columns, rows):
+    # the cursor streams to the encoder, it is never a list
+    assert not isinstance(rows, list) or len(rows) <= 10
+    return encode_result(columns, rows, max_rows=10)
+
+
+def test_results_within_the_row_budget_are_cached(order_db):
+    calls = []
+    cache = QueryCache(max_rows=10)
+    query = "SELECT Region, SUM(Number_of_Orders) FROM order_data GROUP BY Region"
+    first = cache.fetch(order_db, query, _execute(order_db, calls), consume=_encode)
+    second = cache.fetch(order_db, query, _execute(order_db, calls), consume=_encode)
+    assert first == second
+    assert len(calls) == 1
+    assert cache.stats()["entries"] == 1
+
+
+def test_results_over_the_row_budget_stream_and_are_not_cached(order_db):
+    calls = []
+    cache = QueryCache(max_rows=10)
+    query = "SELECT * FROM order_data"
+    result = cache.fetch(order_db, query, _execute(order_db, calls), consume=_encode)
+    assert result["truncated"]
+    assert len(result["rows"]) == 10
+    assert result["row_count"] == 28 * 3 * 3
+    assert cache.stats()["entries"] == 0
+    cache.fetch(order_db, query, _execute(order_db, calls), consume=_encode)
+    assert len(calls) == 2
+
+
+def test_concurrent_fetches_share_the_column_map(order_db):
+    # fetch is called from the tool thread pool
+    calls = []
+    cache = QueryCache(max_rows=10)
+    queries = [f"SELECT Region, SUM(Number_of_Orders) AS n{i % 4} FROM order_data GROUP BY Region" for i in range(64)]
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda query: cache.fetch(order_db, query, _execute(order_db, calls), consume=_encode), queries))
+    assert all(result == results[i % 4] for i, result in enumerate(results))
+    assert len(cache._columns) == 1
+    [columns] = cache._columns.values()
+    assert {"Region", "Number_of_Orders"} <= columns
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from benchmark.stub_server import StubConfig, start_stub_server
+from sales_data_insights import cassette
+from sales_data_insights.cassette import CassetteMiss, use_cassette
+
+QUERY = {"api-version": "2024-05-01-preview"}
+
+
+@pytest.fixture
+def stub():
+    server, url = start_stub_server(StubConfig(tokens_per_second=1000, ttft="0", api_latency="0", seed=1))
+    yield server, url
+    server.shutdown()
+
+
+def _create_thread(client, url, name):
+    response = client.post(f"{url}/threads", params=QUERY, json={"metadata": {"name": name}})
+    return response.json()["id"]
+
+
+def _stream_run(client, url, thread_id):
+    client.post(f"{url}/threads/{thread_id}/messages", params=QUERY, json={"role": "user", "content": "revenue?"})
+    with client.stream(
+        "POST", f"{url}/threads/{thread_id}/runs", params=QUERY, json={"assistant_id": "a", "stream": True}
+    ) as response:
+        return [chunk for chunk in response.iter_bytes()]
+
+
+def test_record_and_replay(stub, tmp_path):
+    server, url = stub
+    path = str(tmp_path / "cassette.db")
+    with use_cassette(path, mode="record"), httpx.Client() as client:
+        recorded = [_create_thread(client, url, "a"), _create_thread(client, url, "b")]
+        stream = _stream_run(client, url, recorded[0])
+    server.shutdown()
+
+    # the server is gone, the answers come from the cassette
+    with use_cassette(path, speed=0), httpx.Client() as client:
+        # the same body is preferred over the recording order
+        assert _create_thread(client, url, "b") == recorded[1]
+        assert _create_thread(client, url, "a") == recorded[0]
+        # other bodies take the exchanges in recording order, starting over when all were used
+        assert [_create_thread(client, url, name) for name in "xyz"] == [recorded[0], recorded[1], recorded[0]]
+        replayed = _stream_run(client, url, recorded[0])
+        assert b"".join(replayed) == b"".join(stream)
+        assert len(replayed) > 1 and replayed[-1].endswith(b"data: [DONE]\n\n")
+        with pytest.raises(CassetteMiss):
+            client.get(f"{url}/files/file_1/content", params=QUERY)
+
+
+def test_async_replay(stub, tmp_path):
+    server, url = stub
+    path = str(tmp_path / "cassette.db")
+    with use_cassette(path, mode="record"), httpx.Client() as client:
+        recorded = _create_thread(client, url, "a")
+    server.shutdown()
+
+    async def replay():
+        async with httpx.AsyncClient() as client:
+            response = await client.post(f"{url}/threads", params=QUERY, json={"metadata": {"name": "a"}})
+            return response.json()["id"]
+
+    with use_cassette(path, speed=0):
+        assert asyncio.run(replay()) == recorded
+
+
+def test_the_patch_ends_with_the_block(stub, tmp_path):
+    server, url = stub
+    original = httpx.HTTPTransport.handle_request, httpx.AsyncHTTPTransport.handle_async_request
+    with use_cassette(str(tmp_path / "cassette.db"), mode="record"):
+        assert httpx.HTTPTransport.handle_request is not original[0]
+        with pytest.raises(RuntimeError):
+            with use_cassette(str(tmp_path / "other.db"), mode="record"):
+                pass
+    assert (httpx.HTTPTransport.handle_request, httpx.AsyncHTTPTransport.handle_async_request) == original
+    assert cassette.get_cassette() is None
+    # requests go to the server again
+    with httpx.Client() as client:
+        assert json.loads(client.post(f"{url}/threads", params=QUERY, json={}).content)["object"] == "thread"
+
+
+def test_install_and_uninstall(monkeypatch, tmp_path):
+    original = httpx.HTTPTransport.handle_request
+    assert not cassette.install()
+    assert httpx.HTTPTransport.handle_request is original
+
+    monkeypatch.setenv("OPENAI_CASSETTE", str(tmp_path / "cassette.db"))
+    monkeypatch.setenv("OPENAI_CASSETTE_MODE", "record")
+    try:
+        assert cassette.install()
+        assert httpx.HTTPTransport.handle_request is not original
+    finally:
+        cassette.uninstall()
+    assert httpx.HTTPTransport.handle_request is original
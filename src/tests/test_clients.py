@@ -0,0 +1,26 @@
+import asyncio
+
+from sales_data_insights import clients
+
+
+async def _client():
+    return clients.get_async_azure_openai_client("http://localhost:1", "key", "2024-05-01-preview")
+
+
+def test_async_clients_belong_to_their_loop():
+    async def twice():
+        return await _client(), await _client()
+
+    first, again = asyncio.run(twice())
+    assert first is again
+    # a new loop, even one reusing the address of the closed one, gets its own client
+    second = asyncio.run(_client())
+    assert second is not first
+
+    async def loops():
+        await _client()
+        return list(clients._loop_clients.keys()), asyncio.get_running_loop()
+
+    # the clients of closed loops are dropped
+    registered, running = asyncio.run(loops())
+    assert registered == [running]
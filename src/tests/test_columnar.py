@@ -0,0 +1,62 @@
+import sqlite3
+
+import pytest
+
+from sales_data_insights.columnar import Unsupported, execute, get_table
+
+
+@pytest.fixture
+def columnar_db(order_db):
+    """order_data with two real measures; quarters keep the sums exact in any order."""
+    with sqlite3.connect(order_db) as connection:
+        connection.execute(
+            "UPDATE order_data SET Sum_of_Order_Value_USD = Sum_of_Order_Value_USD * 10.25,"
+            " Sum_of_Discount_Percentage = Sum_of_Discount_Percentage / 4.0"
+        )
+    return order_db
+
+
+def _sqlite(path, query):
+    with sqlite3.connect(path) as connection:
+        cursor = connection.execute(query)
+        return [column[0] for column in cursor.description], cursor.fetchall()
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT DISTINCT Region, Sum_of_Discount_Percentage FROM order_data",
+        "SELECT Region, Sum_of_Order_Value_USD, COUNT(*) FROM order_data GROUP BY Region, Sum_of_Order_Value_USD",
+        "SELECT DISTINCT main_category FROM order_data ORDER BY main_category",
+        "SELECT Year, Month, TOTAL(Sum_of_Order_Value_USD) FROM order_data GROUP BY Year, Month",
+        "SELECT Region, SUM(Number_of_Orders) FROM order_data GROUP BY Region ORDER BY 2 DESC",
+        "SELECT main_category, sub_category, COUNT(*), AVG(Sum_of_Order_Value_USD) FROM order_data"
+        " WHERE Day BETWEEN 3 AND 10 GROUP BY main_category, sub_category",
+        "SELECT Region, SUM(Number_of_Orders) AS orders FROM order_data WHERE main_category = 'APPAREL'"
+        " GROUP BY Region ORDER BY orders DESC LIMIT 2",
+        "SELECT SUM(Number_of_Orders) / COUNT(*) FROM order_data WHERE Region = 'EUROPE'",
+        "SELECT MIN(Sum_of_Discount_Percentage), MAX(Sum_of_Discount_Percentage) FROM order_data"
+        " WHERE Region IN ('ASIA', 'EUROPE')",
+        "SELECT SUM(Number_of_Orders), COUNT(*) FROM order_data WHERE Region = 'MARS'",
+    ],
+)
+def test_columnar_matches_sqlite(columnar_db, query):
+    columns, rows = execute(get_table(columnar_db), query)
+    expected_columns, expected_rows = _sqlite(columnar_db, query)
+    assert columns == expected_columns
+    if "order by" not in query.lower():
+        rows, expected_rows = sorted(rows), sorted(expected_rows)
+    assert rows == [pytest.approx(row) for row in expected_rows]
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT Region, SUM(Number_of_Orders) FROM order_data WHERE Region = 'ASIA' OR Day = 1 GROUP BY Region",
+        "SELECT SUM(Region) FROM order_data",
+        "SELECT Region FROM order_data",
+    ],
+)
+def test_columnar_leaves_the_rest_to_sqlite(columnar_db, query):
+    with pytest.raises(Unsupported):
+        execute(get_table(columnar_db), query)
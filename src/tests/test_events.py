@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+from assistant_flow.events import AsyncEventChannel, EventChannel, ImageEvent, TextDelta, ToolCallDone
+
+# text deltas around other events, adjacent ones are merged
+EVENTS = ["a", ToolCallDone("call_1"), "b", "c", ImageEvent("file_1", b"png"), "d", "", "e"]
+RECEIVED = [TextDelta("a"), ToolCallDone("call_1"), TextDelta("bc"), ImageEvent("file_1", b"png"), TextDelta("de")]
+
+
+def test_full_channel_blocks_the_producer():
+    channel = EventChannel(capacity=2)
+    assert channel.send(ToolCallDone("call_1")) and channel.send("a")
+    # text is merged into a waiting text delta even when the channel is full
+    assert channel.send("b")
+    sent = threading.Event()
+    producer = threading.Thread(target=lambda: channel.send(ToolCallDone("call_3")) and sent.set())
+    producer.start()
+    assert not sent.wait(0.2)
+
+    events = channel.iter()
+    assert next(events) == ToolCallDone("call_1")
+    assert sent.wait(2)
+    channel.end()
+    assert list(events) == [TextDelta("ab"), ToolCallDone("call_3")]
+    producer.join()
+
+
+def test_coalesced_text_keeps_the_order():
+    channel = EventChannel(capacity=16)
+    for event in EVENTS:
+        channel.send(event)
+    channel.end()
+    assert list(channel.iter()) == RECEIVED
+
+
+def test_closing_the_consumer_cancels_the_run():
+    channel = EventChannel(capacity=1)
+    results = []
+
+    def produce():
+        for i in range(100):
+            results.append(channel.send(ToolCallDone(f"call_{i}")))
+            if channel.cancelled:
+                # the run stops at this point, see AssistantAPI
+                return
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    events = channel.iter()
+    assert next(events) == ToolCallDone("call_0")
+    events.close()
+    producer.join(2)
+    assert not producer.is_alive()
+    assert channel.cancelled and results[-1] is False
+    assert not channel.send("late")
+
+
+def test_transcript_is_capped():
+    channel = EventChannel(transcript_max_chars=10)
+    channel.send("hello world, this is long")
+    channel.send("more")
+    assert "".join(channel.transcript) == "hello worl\n[transcript truncated]"
+    # the consumer still gets everything
+    channel.end()
+    assert "".join(str(event) for event in channel.iter()) == "hello world, this is longmore"
+
+
+def test_async_full_channel_blocks_the_producer():
+    async def main():
+        channel = AsyncEventChannel(capacity=2)
+        await channel.send(ToolCallDone("call_1"))
+        await channel.send("a")
+        assert await channel.send("b")
+        producer = asyncio.create_task(channel.send(ToolCallDone("call_3")))
+        await asyncio.sleep(0.1)
+        assert not producer.done()
+
+        events = channel.iter()
+        assert await events.__anext__() == ToolCallDone("call_1")
+        assert await asyncio.wait_for(producer, 2)
+        channel.end()
+        assert [event async for event in events] == [TextDelta("ab"), ToolCallDone("call_3")]
+
+    asyncio.run(main())
+
+
+def test_async_coalesced_text_keeps_the_order():
+    async def main():
+        channel = AsyncEventChannel(capacity=16)
+        for event in EVENTS:
+            await channel.send(event)
+        channel.end()
+        return [event async for event in channel.iter()]
+
+    assert asyncio.run(main()) == RECEIVED
+
+
+def test_async_closing_the_consumer_cancels_the_run():
+    async def main():
+        channel = AsyncEventChannel(capacity=1)
+        await channel.send(ToolCallDone("call_0"))
+        producer = asyncio.create_task(channel.send(ToolCallDone("call_1")))
+        events = channel.iter()
+        assert await events.__anext__() == ToolCallDone("call_0")
+        await events.aclose()
+        # a producer waiting for room gives up
+        assert await asyncio.wait_for(producer, 2) is False
+        assert channel.cancelled
+        assert not await channel.send("late")
+
+    asyncio.run(main())
+
+
+def test_async_transcript_is_capped():
+    async def main():
+        channel = AsyncEventChannel(transcript_max_chars=10)
+        await channel.send("hello world, this is long")
+        await channel.send("more")
+        return "".join(channel.transcript)
+
+    assert asyncio.run(main()) == "hello worl\n[transcript truncated]"
@@ -0,0 +1,15 @@
+import sqlite3
+
+from generate_data.index_advisor import propose_indexes
+
+
+def test_permutations_of_equality_filters_are_one_index(order_db):
+    queries = [
+        "SELECT SUM(Number_of_Orders) FROM order_data WHERE Month = 2 AND Year = 2024",
+        "SELECT SUM(Number_of_Orders) FROM order_data WHERE Year = 2024 AND Month = 2",
+        "SELECT Month, SUM(Number_of_Orders) FROM order_data WHERE Year = 2024 GROUP BY Month",
+    ]
+    with sqlite3.connect(order_db) as connection:
+        proposal = propose_indexes(queries, connection)
+    # the equality-only queries go with the order the GROUP BY query needs
+    assert proposal == {"order_data": [["Year", "Month"]]}
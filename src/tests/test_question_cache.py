@@ -0,0 +1,48 @@
+import pytest
+
+from sales_data_insights.question_cache import MemoryQuestionStore, QuestionCache, SQLiteQuestionStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "sqlite":
+        return QuestionCache(SQLiteQuestionStore(str(tmp_path / "question_cache.db")))
+    return QuestionCache(MemoryQuestionStore())
+
+
+@pytest.mark.parametrize(
+    "question, same",
+    [
+        ("What was the revenue in 2023?", "what  was THE revenue in 2023"),
+        ("Can you show me the total orders by region, please?", "show total orders by region"),
+        ("Revenue in Q1 2024.", "revenue in q1 2024"),
+        ("Orders with a discount >= 10%", "orders with a discount >= 10%"),
+    ],
+)
+def test_rephrased_questions_hit(cache, question, same):
+    cache.put(question, "azure_openai", "prompt", "SELECT 1")
+    assert cache.get(same, "azure_openai", "prompt") == "SELECT 1"
+    assert cache.stats() == dict(hits=1, misses=0)
+
+
+@pytest.mark.parametrize(
+    "question, other",
+    [
+        ("Orders > 100", "Orders < 100"),
+        ("Orders >= 100", "Orders > 100"),
+        ("Orders != 100", "Orders = 100"),
+        ("Months with growth of -5%", "Months with growth of 5%"),
+        ("Show US revenue", "Show revenue"),
+        ("Sales of grade A products", "Sales of grade products"),
+        ("Revenue in 2023", "Revenue in 2024"),
+    ],
+)
+def test_near_miss_questions_miss(cache, question, other):
+    cache.put(question, "azure_openai", "prompt", "SELECT 1")
+    assert cache.get(other, "azure_openai", "prompt") is None
+
+
+def test_model_and_prompt_are_part_of_the_key(cache):
+    cache.put("Revenue by region", "azure_openai", "prompt", "SELECT 1")
+    assert cache.get("Revenue by region", "phi3", "prompt") is None
+    assert cache.get("Revenue by region", "azure_openai", "new prompt") is None
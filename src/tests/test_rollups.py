@@ -0,0 +1,43 @@
+import sqlite3
+
+import pytest
+
+from sales_data_insights.rollups import available_rollups, rewrite_query
+
+
+def _rows(path, query):
+    with sqlite3.connect(path) as connection:
+        return connection.execute(query).fetchall()
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT SUM(1) FROM order_data",
+        "SELECT Month, TOTAL(2.5) FROM order_data GROUP BY Month",
+        "SELECT SUM(CASE WHEN Region = 'EUROPE' THEN 1 ELSE 0 END) FROM order_data",
+        "SELECT SUM(Day) FROM order_data",
+        "SELECT Region, SUM(Number_of_Orders * 2) FROM order_data GROUP BY Region",
+        "SELECT SUM(Number_of_Orders + Number_of_Orders_Returned) FROM order_data",
+        "SELECT SUM(DISTINCT Number_of_Orders) FROM order_data",
+    ],
+)
+def test_other_sums_stay_on_the_base_table(order_db, query):
+    rewritten = rewrite_query(query, available_rollups(order_db))
+    assert rewritten == query
+    assert _rows(order_db, rewritten) == _rows(order_db, query)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        "SELECT SUM(Number_of_Orders) FROM order_data",
+        "SELECT Region, SUM(order_data.Sum_of_Order_Value_USD) FROM order_data GROUP BY Region ORDER BY Region",
+        "SELECT Month, main_category, TOTAL(Number_of_Orders_Returned) FROM order_data GROUP BY Month, main_category ORDER BY 1, 2",
+        "SELECT SUM(Number_of_Orders) / SUM(Sum_of_Order_Value_USD) FROM order_data WHERE Region = 'EUROPE'",
+    ],
+)
+def test_rollup_results_match_the_base_table(order_db, query):
+    rewritten = rewrite_query(query, available_rollups(order_db))
+    assert rewritten != query
+    assert _rows(order_db, rewritten) == _rows(order_db, query)
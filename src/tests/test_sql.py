@@ -0,0 +1,39 @@
+import sqlite3
+
+from sales_data_insights.cache import QueryCache
+from sales_data_insights.sql import canonicalize
+
+
+def _execute(path):
+    def execute(query, consume=None):
+        consume = consume or (lambda columns, rows: (columns, list(rows)))
+        with sqlite3.connect(path) as connection:
+            cursor = connection.execute(query)
+            return consume([column[0] for column in cursor.description], cursor)
+
+    return execute
+
+
+def test_canonicalize_folds_quoted_columns():
+    columns = {"Region", "main_category"}
+    assert canonicalize('SELECT "Region" FROM order_data', columns) == canonicalize(
+        "select region from ORDER_DATA", columns
+    )
+
+
+def test_canonicalize_keeps_double_quoted_literals():
+    # not a column, so SQLite reads "APPAREL" as the string 'APPAREL'
+    columns = {"Region", "main_category"}
+    upper = canonicalize('SELECT SUM(Number_of_Orders) FROM order_data WHERE main_category = "APPAREL"', columns)
+    lower = canonicalize('SELECT SUM(Number_of_Orders) FROM order_data WHERE main_category = "Apparel"', columns)
+    assert upper != lower
+
+
+def test_query_cache_keeps_quoted_literals_apart(order_db):
+    cache = QueryCache()
+    execute = _execute(order_db)
+    upper = 'SELECT SUM(Number_of_Orders) FROM order_data WHERE main_category = "APPAREL"'
+    lower = 'SELECT SUM(Number_of_Orders) FROM order_data WHERE main_category = "Apparel"'
+    assert cache.fetch(order_db, upper, execute) == execute(upper)
+    assert cache.fetch(order_db, lower, execute) == execute(lower)
+    assert execute(lower)[1] == [(None,)]